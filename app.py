@@ -1,10 +1,9 @@
 import os
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event, text, or_
+from sqlalchemy import event, or_
+from sqlalchemy.orm import scoped_session, sessionmaker
 from flask_login import LoginManager
-from flask_migrate import Migrate
-from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 from dotenv import load_dotenv
 import logging
@@ -12,6 +11,8 @@ import atexit
 import secrets
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+# Registra o esquema shm:// (contadores compartilhados entre workers do gunicorn)
+import utils.shm_limiter  # noqa: F401
 
 # Setup logging
 logging.basicConfig(
@@ -26,18 +27,26 @@ load_dotenv()
 # Initialize Flask extensions
 db = SQLAlchemy()
 login_manager = LoginManager()
-migrate = Migrate()
+
+def _app_ctx_id():
+    from flask.globals import app_ctx
+    return id(app_ctx._get_current_object())
+
+# Sessão somente leitura para dashboard e relatórios (ligada ao engine read-only em create_app)
+read_session = scoped_session(sessionmaker(), scopefunc=_app_ctx_id)
+
 limiter = Limiter(
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'shm://'),
+    strategy=os.environ.get('RATELIMIT_STRATEGY', 'fixed-window'),
     enabled=os.environ.get('ENABLE_RATE_LIMITING', 'True').lower() == 'true'
 )
 
-# Criar o scheduler como variável global, mas inicializar apenas uma vez
-scheduler = None
+# Runner de manutenção (cleanup, checkpoints); apenas o processo líder executa as tarefas
+maintenance_runner = None
 
-def create_app():
+def create_app(start_maintenance=True):
     app = Flask(__name__)
     
     # Configuration
@@ -58,7 +67,11 @@ def create_app():
     # Initialize extensions with app
     db.init_app(app)
     login_manager.init_app(app)
-    migrate.init_app(app, db)
+    # Flask-Migrate (alembic) só é útil no CLI "flask db ..."; importá-lo custa ~100 ms por processo
+    app.config['ENABLE_FLASK_MIGRATE'] = os.environ.get('ENABLE_FLASK_MIGRATE', 'False').lower() == 'true'
+    if app.config['ENABLE_FLASK_MIGRATE']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     limiter.init_app(app)
     
     # Configure LoginManager
@@ -66,74 +79,45 @@ def create_app():
     login_manager.login_message = 'Please log in to access this page.'
     login_manager.login_message_category = 'info'
     
-    # Aplicar otimizações SQLite com pragmas mais simples
-    if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
-        with app.app_context():
-            db.session.execute(text("PRAGMA journal_mode=WAL"))
-            db.session.execute(text("PRAGMA synchronous=NORMAL"))
-            db.session.execute(text("PRAGMA temp_store=memory"))
-            db.session.execute(text("PRAGMA foreign_keys=ON"))
-            db.session.commit()
+    # Perfil de performance do SQLite aplicado em cada conexão do pool,
+    # mais um pool separado somente leitura para dashboard e relatórios
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            from utils.sqlite_profile import apply_sqlite_profile, create_read_engine
+            apply_sqlite_profile(db.engine)
+            read_engine = create_read_engine(db.engine)
+        else:
+            read_engine = db.engine
+        read_session.configure(bind=read_engine)
+        # Latência por endpoint e tempo de SQL por endpoint, agregados entre workers em /metrics
+        from utils import metrics
+        metrics.init_app(app, engines={db.engine, read_engine})
+    
+    @app.teardown_appcontext
+    def remove_read_session(exception=None):
+        read_session.remove()
     
     # Register Blueprints
     with app.app_context():
-        from routes import main, auth, api, probes, jobs
+        from routes import main, auth, api, probes, jobs, reports, metrics as metrics_routes
         
         app.register_blueprint(main.main_blueprint)
         app.register_blueprint(auth.auth_blueprint)
         app.register_blueprint(api.api_blueprint)
         app.register_blueprint(probes.probes_blueprint)
         app.register_blueprint(jobs.jobs_blueprint)
+        app.register_blueprint(reports.reports_blueprint)
+        app.register_blueprint(metrics_routes.metrics_blueprint)
 
         @login_manager.user_loader
         def load_user(user_id):
             from models import User
             return User.query.get(int(user_id))
     
-    # Initialize database if it doesn't exist
+    # Verificação de schema versionada: um único SELECT quando já está atualizado
     with app.app_context():
-        # Adicionar as colunas faltantes na tabela users
-        try:
-            db.session.execute(text("""
-                ALTER TABLE users ADD COLUMN failed_login_attempts INTEGER DEFAULT 0;
-            """))
-            db.session.commit()
-            app.logger.info('Added failed_login_attempts column to users table')
-        except Exception as e:
-            db.session.rollback()
-            app.logger.info(f'Column might already exist: {str(e)}')
-        
-        try:
-            db.session.execute(text("""
-                ALTER TABLE users ADD COLUMN last_failed_login TIMESTAMP;
-            """))
-            db.session.commit()
-            app.logger.info('Added last_failed_login column to users table')
-        except Exception as e:
-            db.session.rollback()
-            app.logger.info(f'Column might already exist: {str(e)}')
-        
-        try:
-            db.session.execute(text("""
-                ALTER TABLE users ADD COLUMN locked_until TIMESTAMP;
-            """))
-            db.session.commit()
-            app.logger.info('Added locked_until column to users table')
-        except Exception as e:
-            db.session.rollback()
-            app.logger.info(f'Column might already exist: {str(e)}')
-        
-        # Create tables if they don't exist
-        db.create_all()
-        
-        # Create admin user if not exists - remove this part since we're using init_db.py
-        # from models import User
-        # if not User.query.filter(db.or_(User.username == 'admin', User.email == 'admin@example.com')).first():
-        #     admin_user = User(username='admin', email='admin@example.com', is_admin=True)
-        #     admin_user.set_password('admin')
-        #     db.session.add(admin_user)
-        #     db.session.commit()
-        #     app.logger.info('Admin user created with username: admin and password: admin')
+        from utils.schema import ensure_schema
+        ensure_schema(db)
     
     # Error handlers
     @app.errorhandler(404)
@@ -144,61 +128,41 @@ def create_app():
     def internal_server_error(e):
         return render_template('errors/500.html'), 500
     
-    # Inicializa o scheduler uma única vez na aplicação principal
-    global scheduler
-    if scheduler is None or not scheduler.running:
-        scheduler = BackgroundScheduler()
-        start_scheduler(app)
-        # Garantir que o scheduler seja encerrado adequadamente
-        atexit.register(lambda: shutdown_scheduler())
+    # Inicia o runner de manutenção uma única vez por processo; a eleição por
+    # file lock garante que só um processo entre todos os workers execute as tarefas
+    if start_maintenance:
+        from utils.maintenance import maintenance_mode
+        if maintenance_mode() == 'embedded':
+            start_maintenance_runner(app)
+            # Pushes do modo 'server' ao Uptime Kuma: um único processo eleito envia os de todos
+            # (no modo 'external' quem envia é o maintenance.py)
+            from utils.kuma_dispatcher import start_dispatch_runner
+            start_dispatch_runner(app)
             
     return app
 
-def shutdown_scheduler():
-    """Shut down the scheduler safely"""
-    global scheduler
-    if scheduler and scheduler.running:
-        try:
-            logger.info("Shutting down scheduler...")
-            scheduler.shutdown(wait=False)
-            logger.info("Scheduler shutdown complete.")
-        except:
-            pass
-
-def start_scheduler(app):
-    """Start the scheduler for periodic tasks"""
-    global scheduler
-    if not scheduler or not scheduler.running:
-        return
-    
-    # Criar uma função wrapper que executa dentro do contexto da aplicação
-    # e com menos frequência (para reduzir o impacto no sistema)
-    def cleanup_logs_job():
-        try:
-            with app.app_context():
-                from utils.log_cleaner import cleanup_old_logs
-                cleanup_old_logs()
-        except Exception as e:
-            logger.error(f"Error in cleanup_logs_job: {str(e)}")
+def start_maintenance_runner(app):
+    """Start the leader-elected maintenance thread for this process"""
+    global maintenance_runner
+    if maintenance_runner is not None and maintenance_runner.is_alive():
+        return maintenance_runner
     
-    # Agendar para executar uma vez por dia, mas não imediatamente
-    # para evitar sobrecarga no início da aplicação
-    scheduler.add_job(
-        cleanup_logs_job, 
-        'interval', 
-        hours=24, 
-        id='cleanup_logs',
-        replace_existing=True,
-        max_instances=1,  # Limitar a uma instância para evitar execuções paralelas
-        coalesce=True     # Combinar execuções perdidas
+    from utils.maintenance import MaintenanceRunner, default_lock_path
+    with app.app_context():
+        lock_path = os.environ.get('MAINTENANCE_LOCK_FILE') or default_lock_path(db.engine)
+    maintenance_runner = MaintenanceRunner(
+        app, lock_path, poll_interval=int(os.environ.get('MAINTENANCE_POLL_INTERVAL', 15))
     )
-    
-    # Start the scheduler
-    try:
-        scheduler.start()
-        logger.info("Log cleanup scheduler started. Logs older than 24 hours will be automatically removed once a day.")
-    except Exception as e:
-        logger.error(f"Failed to start scheduler: {str(e)}")
+    maintenance_runner.start()
+    atexit.register(shutdown_maintenance)
+    return maintenance_runner
+
+def shutdown_maintenance():
+    """Stop the maintenance runner and release the leader lock"""
+    if maintenance_runner and maintenance_runner.is_alive():
+        logger.info("Shutting down maintenance runner...")
+        maintenance_runner.stop()
+        maintenance_runner.join(timeout=5)
 
 if __name__ == '__main__':
     app = create_app()
@@ -0,0 +1,339 @@
+"""Database micro-benchmarks of the hot operations, with stored baselines.
+
+Seeds a SQLite database with a realistic volume of results (``--rows``, e.g.
+``1M``, ``10M`` or ``50M``, spread over ``--jobs`` jobs and the last
+``--hours`` hours, plus probe logs) and times each operation through the real
+code path, counting the SQL statements it issues:
+
+* ``single_insert`` -- ``POST /api/probe/<key>/results`` (Flask route);
+* ``bulk_insert`` -- ``utils.probe_ingest.write_batch`` with 500 results;
+* ``get_probe_jobs`` -- ``GET /api/probe/<key>/jobs``;
+* ``dashboard`` -- ``GET /``;
+* ``view_results`` -- ``GET /jobs/results/<id>``;
+* ``view_probe_logs`` -- ``GET /probes/<id>/logs``;
+* ``cleanup_old_logs`` -- one run of the cleanup task (archives the results
+  older than 24 hours; runs last, once, since it changes the data).
+
+Results are compared with ``benchmarks/baselines/db_operations.json`` (per
+row count): more statements per operation, or a median more than 25% slower,
+is reported as a regression (exit status 1 with ``--check``).
+``--save-baseline`` stores the current run. Seeded databases can be kept in
+``--cache-dir`` to skip seeding on the next run.
+
+Usage:
+    python benchmarks/db_operations.py [--rows 1M,10M] [--only dashboard,view_results] [--check]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baselines', 'db_operations.json')
+TIME_TOLERANCE = 0.25
+PROBES = 20
+ERRORS = ['Request timeout', 'Destination host unreachable', 'Network is unreachable',
+          'Connection error: [Errno 111] Connection refused']
+
+BENCHMARKS = []
+
+
+def benchmark(name, rounds=20, warmup=True):
+    """Register func(ctx) as a benchmark run rounds times (after one warm-up call)"""
+    def register(func):
+        BENCHMARKS.append((name, rounds, warmup, func))
+        return func
+    return register
+
+
+def parse_count(value):
+    value = value.strip().upper()
+    for suffix, factor in (('K', 1000), ('M', 1000000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def seed(path, rows, jobs, hours, logs):
+    """Create the schema through create_app, then bulk load with sqlite3"""
+    os.environ['DATABASE_URI'] = f'sqlite:///{path}'
+    from app import create_app, db
+    from models import EPOCH, User
+
+    app = create_app(start_maintenance=False)
+    with app.app_context():
+        user = User(username='bench', is_admin=True)
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+    now = datetime.utcnow()
+    now_us = (now - EPOCH) // timedelta(microseconds=1)
+    span_us = hours * 3600 * 1000000
+    conn.executemany(
+        "INSERT INTO probes (id, name, api_key, is_active, kuma_push_mode, config_version, overloaded, last_seen, "
+        "created_at) VALUES (?, ?, ?, 1, 'probe', 1, 0, ?, ?)",
+        [(i, f'probe-{i}', f'bench-key-{i}', now - timedelta(minutes=i), now) for i in range(1, PROBES + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO jobs (id, name, job_type, target_host, kuma_url, interval_seconds, timeout_seconds, retries, "
+        "priority, is_active, created_at, updated_at, probe_id) "
+        "VALUES (?, ?, 'ping', ?, ?, 60, 10, 3, 0, 1, ?, ?, ?)",
+        [(i, f'job-{i}', f'10.{i // 65536}.{i // 256 % 256}.{i % 256}', f'http://kuma/api/push/{i}', now, now,
+          1 + i % PROBES) for i in range(1, jobs + 1)],
+    )
+    conn.executemany("INSERT INTO result_messages (id, hash, text, last_used) VALUES (?, ?, ?, ?)",
+                     [(i + 1, i + 1, text, int(time.time())) for i, text in enumerate(ERRORS)])
+
+    per_job = max(rows // jobs, 1)
+    step = max(span_us // per_job, 1)
+    random.seed(42)
+    latencies = [int(random.lognormvariate(9.5, 0.6)) for _ in range(4096)]
+
+    def result_rows(job_id):
+        start = now_us - per_job * step
+        for i in range(per_job):
+            if (job_id * 7919 + i) % 50:
+                yield job_id, start + i * step, 3, latencies[(job_id + i) % 4096], (3 << 16) | 3, None
+            else:
+                yield job_id, start + i * step, 2, None, (3 << 16), 1 + (job_id + i) % len(ERRORS)
+
+    insert = ("INSERT INTO job_results (job_id, timestamp, flags, response_time_us, packets, error_id) "
+              "VALUES (?, ?, ?, ?, ?, ?)")
+    for job_id in range(1, jobs + 1):
+        conn.executemany(insert, result_rows(job_id))
+        if job_id % 100 == 0:
+            conn.commit()
+
+    log_step = timedelta(seconds=hours * 3600 / max(logs, 1))
+    conn.executemany(
+        "INSERT INTO probe_logs (probe_id, timestamp, action, ip_address, details) VALUES (?, ?, ?, '10.0.0.1', ?)",
+        ((1 + i % PROBES, (now - log_step * i).strftime('%Y-%m-%d %H:%M:%S.%f'),
+          'heartbeat' if i % 3 else 'job_result_submission', 'Heartbeat received') for i in range(logs)),
+    )
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def prepared_database(args, rows, workdir):
+    name = f'bench-{rows}-{args.jobs}-{args.hours}-{args.logs}.db'
+    path = os.path.join(workdir, name)
+    if args.cache_dir:
+        cached = os.path.join(args.cache_dir, name)
+        if not os.path.exists(cached):
+            os.makedirs(args.cache_dir, exist_ok=True)
+            started = time.perf_counter()
+            seed(cached + '.tmp', rows, args.jobs, args.hours, args.logs)
+            os.replace(cached + '.tmp', cached)
+            print(f"seeded {rows} results in {time.perf_counter() - started:.1f}s ({cached})")
+        shutil.copyfile(cached, path)
+    else:
+        started = time.perf_counter()
+        seed(path, rows, args.jobs, args.hours, args.logs)
+        print(f"seeded {rows} results in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.count += 1
+
+
+class Context:
+    def __init__(self, app, jobs):
+        self.app = app
+        self.client = app.test_client()
+        self.jobs = jobs
+        with self.client.session_transaction() as session:
+            session['_user_id'] = '1'
+            session['_fresh'] = True
+
+    def job_id(self):
+        return random.randint(1, self.jobs)
+
+    def probe_id(self):
+        return random.randint(1, PROBES)
+
+    def get(self, path):
+        response = self.client.get(path)
+        assert response.status_code == 200, f'GET {path}: {response.status_code}'
+        return response
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        assert response.status_code == 200, f'POST {path}: {response.status_code}'
+        return response
+
+
+@benchmark('single_insert', rounds=200)
+def single_insert(ctx):
+    job_id = ctx.job_id()
+    ctx.post(f'/api/probe/bench-key-{1 + job_id % PROBES}/results', {
+        'job_id': job_id, 'success': True, 'response_time_ms': 12.5, 'packets_sent': 3, 'packets_received': 3,
+    })
+
+
+@benchmark('bulk_insert', rounds=20)
+def bulk_insert(ctx):
+    from app import db
+    from models import to_epoch_us
+    from utils import probe_ingest
+
+    timestamp_us = to_epoch_us(datetime.utcnow())
+    rows = [probe_ingest.result_row({
+        'job_id': ctx.job_id(), 'success': i % 20 != 0, 'response_time_ms': 10.0 + i % 50,
+        'packets_sent': 3, 'packets_received': 3, 'error_message': None if i % 20 else ERRORS[0],
+        'kuma_success': True, 'kuma_error': None, 'aggregated': False,
+    }, timestamp_us + i, False) for i in range(500)]
+    with ctx.app.app_context():
+        probe_ingest.write_batch(db.engine, rows)
+
+
+@benchmark('get_probe_jobs', rounds=50)
+def get_probe_jobs(ctx):
+    ctx.get(f'/api/probe/bench-key-{ctx.probe_id()}/jobs')
+
+
+@benchmark('dashboard', rounds=50)
+def dashboard(ctx):
+    ctx.get('/')
+
+
+@benchmark('view_results', rounds=50)
+def view_results(ctx):
+    ctx.get(f'/jobs/results/{ctx.job_id()}')
+
+
+@benchmark('view_probe_logs', rounds=10)
+def view_probe_logs(ctx):
+    ctx.get(f'/probes/{ctx.probe_id()}/logs')
+
+
+@benchmark('cleanup_old_logs', rounds=1, warmup=False)
+def cleanup_old_logs(ctx):
+    from utils.log_cleaner import cleanup_old_logs as cleanup
+    with ctx.app.app_context():
+        cleanup()
+
+
+def run_benchmarks(ctx, counter, selected):
+    report = {}
+    for name, rounds, warmup, func in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        if warmup:
+            func(ctx)  # aquecimento (caches, plano de consultas)
+        times, queries = [], []
+        for _ in range(rounds):
+            before = counter.count
+            started = time.perf_counter()
+            func(ctx)
+            times.append(time.perf_counter() - started)
+            queries.append(counter.count - before)
+        times.sort()
+        report[name] = {
+            'rounds': rounds,
+            'median_ms': round(statistics.median(times) * 1000, 3),
+            'min_ms': round(times[0] * 1000, 3),
+            'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 3),
+            'queries': int(statistics.median(queries)),
+        }
+        entry = report[name]
+        print(f"  {name:<18} median {entry['median_ms']:>10.2f} ms   p95 {entry['p95_ms']:>10.2f} ms   "
+              f"queries {entry['queries']}")
+    return report
+
+
+def compare(report, baseline):
+    problems = []
+    for name, entry in report.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if entry['queries'] > previous['queries']:
+            problems.append(f"{name}: queries {previous['queries']} -> {entry['queries']}")
+        if entry['median_ms'] > previous['median_ms'] * (1 + TIME_TOLERANCE):
+            problems.append(f"{name}: median {previous['median_ms']} ms -> {entry['median_ms']} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='1M', help='Comma separated result counts (1M, 10M, 50M...)')
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--hours', type=int, default=48, help='Time span of the seeded results')
+    parser.add_argument('--logs', type=int, default=100000, help='Probe log rows')
+    parser.add_argument('--only', help='Comma separated benchmark names')
+    parser.add_argument('--cache-dir', help='Keep seeded databases here between runs')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='Exit 1 on regressions')
+    args = parser.parse_args()
+
+    selected = set(args.only.split(',')) if args.only else None
+    os.environ.update({'MAINTENANCE_MODE': 'off', 'ENABLE_RATE_LIMITING': 'False', 'RESULT_ARCHIVE': 'on'})
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    results, problems = {}, []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            'JOB_HEALTH_PATH': os.path.join(tmp, 'job-health'),
+            'RESULT_ARCHIVE_DIR': os.path.join(tmp, 'archive'),
+        })
+        counter = QueryCounter()
+        counter.install()
+        for rows in [parse_count(value) for value in args.rows.split(',')]:
+            path = prepared_database(args, rows, tmp)
+            os.environ['DATABASE_URI'] = f'sqlite:///{path}'
+            from app import create_app, db
+            app = create_app(start_maintenance=False)
+            print(f"{rows} results, {args.jobs} jobs, {args.logs} probe logs:")
+            results[str(rows)] = run_benchmarks(Context(app, args.jobs), counter, selected)
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+            found = compare(results[str(rows)], baselines.get(str(rows), {}))
+            problems += [f"[{rows}] {problem}" for problem in found]
+            os.unlink(path)
+
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    if args.save_baseline:
+        baselines.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"saved baseline {args.baseline}")
+    if args.check and problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Probe ingest throughput: Flask API vs the asyncio fast path (ingest_server.py).
+
+Seeds a scratch database with one probe and its jobs, starts each server in a
+subprocess and drives ``POST /api/probe/<key>/results`` (plus a heartbeat
+every ``--heartbeat-every`` requests) from keep-alive connections for a fixed
+time, then prints requests/s and latency percentiles. The Flask side runs on
+gunicorn with gunicorn_config.py when it is installed, otherwise on waitress.
+Rate limiting is disabled on both so the whole run is measured.
+
+Usage:
+    python benchmarks/ingest_fastpath.py [--connections 64] [--duration 10] [--jobs 500]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+API_KEY = 'bench-key'
+
+
+def seed(jobs):
+    from app import create_app, db
+    from models import Job, Probe
+
+    app = create_app(start_maintenance=False)
+    with app.app_context():
+        probe = Probe(name='bench', api_key=API_KEY)
+        db.session.add(probe)
+        db.session.flush()
+        db.session.execute(
+            Job.__table__.insert(),
+            [{'name': f'job-{i}', 'target_host': f'10.0.{i // 250}.{i % 250}', 'kuma_url': 'http://kuma/p',
+              'probe_id': probe.id}
+             for i in range(jobs)],
+        )
+        db.session.commit()
+        return [job_id for (job_id,) in db.session.query(Job.id)]
+
+
+def start_flask(port):
+    if shutil.which('gunicorn'):
+        command = ['gunicorn', '--config=gunicorn_config.py', 'wsgi:app', '--bind', f'127.0.0.1:{port}',
+                   '--access-logfile', '/dev/null']
+    else:
+        command = [sys.executable, '-c',
+                   f"from waitress import serve; from wsgi import app; serve(app, host='127.0.0.1', port={port}, threads=8)"]
+    return subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_fastpath(port):
+    env = dict(os.environ, INGEST_HOST='127.0.0.1', INGEST_PORT=str(port))
+    return subprocess.Popen([sys.executable, 'ingest_server.py'], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def _request(method, path, body=b''):
+    return (f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def worker(port, job_ids, deadline, heartbeat_every, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    sent = 0
+    try:
+        while time.monotonic() < deadline:
+            sent += 1
+            if heartbeat_every and sent % heartbeat_every == 0:
+                request = _request('POST', f'/api/probe/{API_KEY}/heartbeat')
+            else:
+                success = random.random() > 0.05
+                request = _request('POST', f'/api/probe/{API_KEY}/results', json.dumps({
+                    'job_id': random.choice(job_ids),
+                    'success': success,
+                    'response_time_ms': round(random.uniform(1, 80), 2) if success else None,
+                    'packets_sent': 3,
+                    'packets_received': 3 if success else 0,
+                    'error_message': None if success else 'Request timeout',
+                }).encode('utf-8'))
+            started = time.perf_counter()
+            writer.write(request)
+            status = await _read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def drive(port, job_ids, connections, duration, heartbeat_every):
+    await wait_ready(port)
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(port, job_ids, deadline, heartbeat_every, latencies, errors)
+                           for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else float('nan')
+
+    return len(latencies) / elapsed, percentile(0.5), percentile(0.99), len(errors)
+
+
+def run(name, start, port, args, job_ids):
+    process = start(port)
+    try:
+        rate, p50, p99, errors = asyncio.run(drive(port, job_ids, args.connections, args.duration,
+                                                   args.heartbeat_every))
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    print(f"{name:<10} {rate:>9.0f} req/s   p50 {p50:6.1f} ms   p99 {p99:6.1f} ms   errors {errors}")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--heartbeat-every', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5901)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            'DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'uptime.db')}",
+            'MAINTENANCE_MODE': 'off',
+            'ENABLE_RATE_LIMITING': 'False',
+            'JOB_HEALTH_PATH': os.path.join(tmp, 'job-health'),
+        })
+        job_ids = seed(args.jobs)
+        flask_rate = run('flask', start_flask, args.port, args, job_ids)
+        fast_rate = run('fastpath', start_fastpath, args.port + 1, args, job_ids)
+        print(f"speedup: {fast_rate / flask_rate:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
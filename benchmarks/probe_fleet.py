@@ -0,0 +1,412 @@
+"""Capacity load test: a fleet of simulated probes against a local server.
+
+Seeds N probes with M jobs each, starts the server in a subprocess (gunicorn
+with gunicorn_config.py when installed, otherwise waitress; ``--server
+fastpath`` adds ingest_server.py for the probe endpoints) and runs every probe
+as the real one does (probe/probe.py): the job list every ``--fetch-interval``,
+a heartbeat every ``--heartbeat-interval`` and one result per job every
+``--job-interval`` seconds, with random phases and one HTTP connection per
+request. ``--legacy-ratio`` of the probes report through ``POST /api/results``.
+``--speedup`` divides every interval, to reach a given load in a short run.
+
+While the fleet runs, a sampler measures how long the server's SQLite file
+takes to grant the write lock (``BEGIN IMMEDIATE``), i.e. the busy waits a
+request writer sees. The report has, per endpoint, throughput, p50/p99/max
+latency, error, 429 and connection-failure rates, plus the lock wait
+percentiles; it is printed and saved as JSON, and ``--compare`` flags
+regressions against a previous report:
+
+    python benchmarks/probe_fleet.py --probes 200 --jobs 50 --speedup 20 --output fleet.json
+    python benchmarks/probe_fleet.py --probes 200 --jobs 50 --speedup 20 --compare fleet.json
+
+``--url`` and ``--database`` run against an already started server instead
+(the probes are seeded into that database).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ENDPOINTS = ('jobs', 'heartbeat', 'results', 'legacy_results')
+# Piora tolerada em --compare antes de acusar regressão (latências: relativa e absoluta)
+REGRESSION_TOLERANCE = 0.20
+LATENCY_FLOOR_MS = 5.0
+
+
+def seed(probes, jobs, job_interval):
+    """Create the fleet in DATABASE_URI; returns ([(api_key, [job ids])], database file)"""
+    from app import create_app, db
+    from models import Job, Probe
+
+    app = create_app(start_maintenance=False)
+    fleet = []
+    with app.app_context():
+        for index in range(probes):
+            probe = Probe(name=f'fleet-{index}-{random.getrandbits(32):08x}')
+            probe.generate_api_key()
+            db.session.add(probe)
+            db.session.flush()
+            db.session.execute(Job.__table__.insert(), [{
+                'name': f'{probe.name}-job-{i}',
+                'target_host': f'10.{index // 250}.{index % 250}.{i % 250}',
+                'kuma_url': 'http://127.0.0.1:9/api/push/fleet',
+                'interval_seconds': job_interval,
+                'probe_id': probe.id,
+            } for i in range(jobs)])
+            fleet.append((probe.api_key, probe.id))
+        db.session.commit()
+        job_ids = {}
+        for job_id, probe_id in db.session.query(Job.id, Job.probe_id):
+            job_ids.setdefault(probe_id, []).append(job_id)
+        database = db.engine.url.database
+    return [(api_key, job_ids.get(probe_id, [])) for api_key, probe_id in fleet], database
+
+
+def start_servers(kind, port, rate_limiting):
+    env = dict(os.environ, ENABLE_RATE_LIMITING='True' if rate_limiting else 'False')
+    if shutil.which('gunicorn'):
+        command = ['gunicorn', '--config=gunicorn_config.py', 'wsgi:app', '--bind', f'127.0.0.1:{port}',
+                   '--access-logfile', '/dev/null']
+    else:
+        command = [sys.executable, '-c',
+                   f"from waitress import serve; from wsgi import app; serve(app, host='127.0.0.1', port={port}, threads=8)"]
+    processes = [subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    urls = {'web': f'http://127.0.0.1:{port}', 'probe': f'http://127.0.0.1:{port}'}
+    if kind == 'fastpath':
+        processes.append(subprocess.Popen(
+            [sys.executable, 'ingest_server.py'], cwd=ROOT,
+            env=dict(env, INGEST_HOST='127.0.0.1', INGEST_PORT=str(port + 1)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+        urls['probe'] = f'http://127.0.0.1:{port + 1}'
+    return processes, urls
+
+
+async def wait_ready(url, timeout=60):
+    parsed = urlparse(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} did not start')
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.status = {name: {} for name in ENDPOINTS}
+        self.connection_errors = {name: 0 for name in ENDPOINTS}
+        self.late = 0
+
+    def record(self, endpoint, status, seconds):
+        self.latencies[endpoint].append(seconds)
+        self.status[endpoint][status] = self.status[endpoint].get(status, 0) + 1
+
+
+async def request(url, method, path, stats, endpoint, body=None, headers=None, timeout=30):
+    """One request on a new connection, like the probe's requests.get/post"""
+    parsed = urlparse(url)
+    payload = b'' if body is None else json.dumps(body).encode('utf-8')
+    head = f"{method} {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\nConnection: close\r\n"
+    for name, value in (headers or {}).items():
+        head += f"{name}: {value}\r\n"
+    if body is not None:
+        head += "Content-Type: application/json\r\n"
+    head += f"Content-Length: {len(payload)}\r\n\r\n"
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(parsed.hostname, parsed.port), timeout)
+        try:
+            writer.write(head.encode('latin-1') + payload)
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            await asyncio.wait_for(reader.read(), timeout)
+        finally:
+            writer.close()
+        status = int(line.split(b' ', 2)[1])
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        stats.connection_errors[endpoint] += 1
+        return
+    stats.record(endpoint, status, time.perf_counter() - started)
+
+
+def _result(job_id):
+    success = random.random() > 0.03
+    return {
+        'job_id': job_id,
+        'success': success,
+        'response_time_ms': round(random.lognormvariate(3, 0.6), 2) if success else None,
+        'packets_sent': 3,
+        'packets_received': 3 if success else random.randint(0, 2),
+        'error_message': None if success else random.choice(
+            ['Request timeout', 'Destination host unreachable', 'Network is unreachable']),
+        'kuma_success': True,
+    }
+
+
+async def every(interval, deadline, stats, action):
+    """Run action every interval seconds from a random phase until deadline"""
+    next_run = time.monotonic() + random.uniform(0, interval)
+    tasks = set()
+    while next_run < deadline:
+        delay = next_run - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -interval:
+            stats.late += 1
+        # Cada envio roda em paralelo, como os jobs de um probe real não esperam uns pelos outros
+        task = asyncio.ensure_future(action())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        next_run += interval
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+async def run_probe(api_key, job_ids, urls, args, deadline, stats, legacy):
+    scale = args.speedup
+    cycle = iter(range(1 << 62))
+
+    async def fetch_jobs():
+        await request(urls['probe'], 'GET', f'/api/probe/{api_key}/jobs', stats, 'jobs')
+
+    async def heartbeat():
+        await request(urls['probe'], 'POST', f'/api/probe/{api_key}/heartbeat', stats, 'heartbeat')
+
+    async def submit():
+        job_id = job_ids[next(cycle) % len(job_ids)]
+        if legacy:
+            await request(urls['web'], 'POST', '/api/results', stats, 'legacy_results', _result(job_id),
+                          {'Authorization': f'Bearer {api_key}'})
+        else:
+            await request(urls['probe'], 'POST', f'/api/probe/{api_key}/results', stats, 'results', _result(job_id))
+
+    loops = [every(args.fetch_interval / scale, deadline, stats, fetch_jobs),
+             every(args.heartbeat_interval / scale, deadline, stats, heartbeat)]
+    if job_ids:
+        # Os M jobs do probe espalhados pelo intervalo: um resultado a cada intervalo / M
+        loops.append(every(args.job_interval / scale / len(job_ids), deadline, stats, submit))
+    await fetch_jobs()
+    await asyncio.gather(*loops)
+
+
+class LockSampler(threading.Thread):
+    """Samples how long the database takes to grant the write lock"""
+
+    def __init__(self, database, interval=0.2):
+        super().__init__(daemon=True)
+        self.database = database
+        self.interval = interval
+        self.waits = []
+        self.timeouts = 0
+        self._done = threading.Event()
+
+    def run(self):
+        conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        try:
+            while not self._done.wait(self.interval):
+                started = time.perf_counter()
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    self.waits.append(time.perf_counter() - started)
+                    conn.execute('ROLLBACK')
+                except sqlite3.OperationalError:
+                    self.timeouts += 1
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+
+def summarize(stats, sampler, elapsed):
+    endpoints = {}
+    for name in ENDPOINTS:
+        latencies = sorted(stats.latencies[name])
+        statuses = stats.status[name]
+        total = len(latencies) + stats.connection_errors[name]
+        if not total:
+            continue
+        rejected = statuses.get(429, 0)
+        errors = sum(count for status, count in statuses.items() if status >= 400 and status != 429)
+        endpoints[name] = {
+            'requests': total,
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': _percentile(latencies, 0.50),
+            'p99_ms': _percentile(latencies, 0.99),
+            'max_ms': _percentile(latencies, 1.0),
+            'error_rate': round((errors + stats.connection_errors[name]) / total, 4),
+            'rate_limited_rate': round(rejected / total, 4),
+            'connection_errors': stats.connection_errors[name],
+            'status': {str(status): count for status, count in sorted(statuses.items())},
+        }
+    waits = sorted(sampler.waits)
+    return {
+        'endpoints': endpoints,
+        'total_rps': round(sum(len(values) for values in stats.latencies.values()) / elapsed, 1),
+        'late_schedules': stats.late,
+        'sqlite_lock_wait': {
+            'samples': len(waits),
+            'p50_ms': _percentile(waits, 0.50),
+            'p99_ms': _percentile(waits, 0.99),
+            'max_ms': _percentile(waits, 1.0),
+            'over_100ms': sum(1 for wait in waits if wait > 0.1),
+            'timeouts': sampler.timeouts,
+        },
+    }
+
+
+def compare(report, baseline):
+    """Lines describing regressions of report against baseline"""
+    problems = []
+    changed = sorted(key for key, value in report['parameters'].items()
+                     if key in baseline.get('parameters', {}) and baseline['parameters'][key] != value)
+    if changed:
+        print(f"warning: parameters differ from the baseline ({', '.join(changed)})")
+    for name, current in report['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if (previous.get(key) and current.get(key) and current[key] > previous[key] * (1 + REGRESSION_TOLERANCE)
+                    and current[key] - previous[key] > LATENCY_FLOOR_MS):
+                problems.append(f"{name} {key}: {previous[key]} -> {current[key]}")
+        if previous.get('throughput_rps') and current['throughput_rps'] < previous['throughput_rps'] * (1 - REGRESSION_TOLERANCE):
+            problems.append(f"{name} throughput_rps: {previous['throughput_rps']} -> {current['throughput_rps']}")
+        for key in ('error_rate', 'rate_limited_rate'):
+            if current[key] > previous.get(key, 0) + 0.01:
+                problems.append(f"{name} {key}: {previous.get(key, 0)} -> {current[key]}")
+    previous_wait = baseline.get('sqlite_lock_wait', {}).get('p99_ms')
+    current_wait = report['sqlite_lock_wait']['p99_ms']
+    if (previous_wait and current_wait and current_wait > previous_wait * (1 + REGRESSION_TOLERANCE)
+            and current_wait - previous_wait > LATENCY_FLOOR_MS):
+        problems.append(f"sqlite_lock_wait p99_ms: {previous_wait} -> {current_wait}")
+    return problems
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(fleet, urls, args):
+    await wait_ready(urls['web'])
+    await wait_ready(urls['probe'])
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    legacy_count = int(round(len(fleet) * args.legacy_ratio))
+    started = time.perf_counter()
+    await asyncio.gather(*(run_probe(api_key, job_ids, urls, args, deadline, stats, index < legacy_count)
+                           for index, (api_key, job_ids) in enumerate(fleet)))
+    return stats, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--probes', type=int, default=50)
+    parser.add_argument('--jobs', type=int, default=20, help='Jobs per probe')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds')
+    parser.add_argument('--job-interval', type=int, default=60, help='Seconds between results of a job')
+    parser.add_argument('--fetch-interval', type=float, default=60)
+    parser.add_argument('--heartbeat-interval', type=float, default=300)
+    parser.add_argument('--speedup', type=float, default=1.0, help='Divides every interval')
+    parser.add_argument('--legacy-ratio', type=float, default=0.1)
+    parser.add_argument('--server', choices=('flask', 'fastpath'), default='flask')
+    parser.add_argument('--rate-limiting', action='store_true', help='Keep the server rate limits enabled')
+    parser.add_argument('--port', type=int, default=5801)
+    parser.add_argument('--url', help='Already running server (probe and legacy endpoints)')
+    parser.add_argument('--database', help='SQLite file of the server given with --url')
+    parser.add_argument('--output', help='Save the report as JSON')
+    parser.add_argument('--compare', help='Previous JSON report; exit 1 on regressions')
+    args = parser.parse_args()
+    if args.url and not args.database:
+        parser.error('--url needs --database (the probes are seeded there)')
+
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.abspath(args.database) if args.database else os.path.join(tmp, 'uptime.db')
+        os.environ.update({
+            'DATABASE_URI': f'sqlite:///{database}',
+            'JOB_HEALTH_PATH': os.environ.get('JOB_HEALTH_PATH', os.path.join(tmp, 'job-health')),
+            'RATELIMIT_STORAGE_URI': os.environ.get('RATELIMIT_STORAGE_URI', f"shm://{os.path.join(tmp, 'ratelimit')}"),
+        })
+        fleet, database = seed(args.probes, args.jobs, args.job_interval)
+        expected = args.probes * (args.jobs / args.job_interval + 1 / args.fetch_interval
+                                  + 1 / args.heartbeat_interval) * args.speedup
+        print(f"fleet: {args.probes} probes x {args.jobs} jobs, ~{expected:.0f} req/s offered, {args.duration:.0f}s")
+
+        processes = []
+        if args.url:
+            urls = {'web': args.url.rstrip('/'), 'probe': args.url.rstrip('/')}
+        else:
+            processes, urls = start_servers(args.server, args.port, args.rate_limiting)
+        sampler = LockSampler(database)
+        sampler.start()
+        try:
+            stats, elapsed = asyncio.run(drive(fleet, urls, args))
+        finally:
+            sampler.stop()
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=30)
+
+    report = summarize(stats, sampler, elapsed)
+    report.update({
+        'created_at': datetime.utcnow().isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'offered_rps': round(expected, 1),
+    })
+
+    for name, entry in report['endpoints'].items():
+        print(f"{name:<15} {entry['throughput_rps']:>8} req/s  p50 {entry['p50_ms']} ms  p99 {entry['p99_ms']} ms  "
+              f"errors {entry['error_rate']:.2%}  429 {entry['rate_limited_rate']:.2%}")
+    wait = report['sqlite_lock_wait']
+    print(f"sqlite write lock wait: p50 {wait['p50_ms']} ms  p99 {wait['p99_ms']} ms  max {wait['max_ms']} ms  "
+          f"(>100ms: {wait['over_100ms']}, timeouts: {wait['timeouts']})")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"saved {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(report, json.load(f))
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"no regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
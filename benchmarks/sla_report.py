@@ -0,0 +1,114 @@
+"""SLA report benchmark (utils.analytics).
+
+Builds a scratch database with the last 24 hours of results in the live table
+and the previous days in the columnar archive (the layout produced by the
+cleanup task), then times ``analytics.sla_report`` for all jobs. The archived
+days of one job are generated once and copied to the others, so seeding stays
+fast; the report still reads and processes every file.
+
+Usage:
+    python benchmarks/sla_report.py [--jobs 2000] [--days 30] [--interval 300]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def synthetic_rows(start_us, count, interval_us):
+    rows = []
+    for i in range(count):
+        success = random.random() > 0.02
+        rows.append((
+            start_us + i * interval_us,
+            1 | 2 if success else 0,
+            int(random.lognormvariate(9.5, 0.6)) if success else None,
+            (3 << 16) | (3 if success else random.randint(0, 2)),
+            None if success else 'Request timeout',
+        ))
+    return rows
+
+
+def seed(app, jobs, days, interval):
+    from app import db
+    from models import Job, Probe, to_epoch_us
+    from sqlalchemy import text
+    from utils import result_archive
+
+    archive_root = result_archive.archive_dir(db.engine)
+    now = datetime.utcnow()
+    live_start = to_epoch_us(now - timedelta(days=1))
+    interval_us = interval * 1000000
+    per_day = 86400 // interval
+
+    probe = Probe(name='bench', api_key='bench')
+    db.session.add(probe)
+    db.session.flush()
+    db.session.execute(
+        Job.__table__.insert(),
+        [{'name': f'job-{i}', 'target_host': f'10.0.{i // 250}.{i % 250}', 'kuma_url': 'http://kuma/p',
+          'probe_id': probe.id} for i in range(jobs)],
+    )
+    db.session.commit()
+    job_ids = [job_id for (job_id,) in db.session.query(Job.id).order_by(Job.id)]
+
+    # Dias arquivados do primeiro job, copiados para os demais
+    first_day = live_start - (days - 1) * 86400 * 1000000
+    result_archive.append_rows(
+        archive_root, job_ids[0], synthetic_rows(first_day, (days - 1) * per_day, interval_us)
+    )
+    for job_id in job_ids[1:]:
+        shutil.copytree(os.path.join(archive_root, str(job_ids[0])), os.path.join(archive_root, str(job_id)))
+
+    insert = text("INSERT INTO job_results (job_id, timestamp, flags, response_time_us, packets) "
+                  "VALUES (:job_id, :timestamp, :flags, :response_time_us, :packets)")
+    template = synthetic_rows(live_start, per_day, interval_us)
+    for job_id in job_ids:
+        db.session.execute(insert, [
+            {'job_id': job_id, 'timestamp': row[0], 'flags': row[1], 'response_time_us': row[2], 'packets': row[3]}
+            for row in template
+        ])
+    db.session.commit()
+    return job_ids, jobs * days * per_day
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=300, help='Seconds between checks')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URI'] = f"sqlite:///{os.path.join(tmp, 'uptime.db')}"
+        os.environ['MAINTENANCE_MODE'] = 'off'
+        from app import create_app, db, read_session
+        from models import Job
+        from utils import analytics, result_archive
+
+        app = create_app()
+        with app.app_context():
+            started = time.perf_counter()
+            _, rows = seed(app, args.jobs, args.days, args.interval)
+            print(f"seeded {args.jobs} jobs x {args.days} days ({rows} results) in {time.perf_counter() - started:.1f}s")
+
+            jobs = read_session.query(Job.id, Job.name).order_by(Job.id).all()
+            for run in range(args.runs):
+                started = time.perf_counter()
+                report = analytics.sla_report(read_session, result_archive.archive_dir(db.engine), jobs,
+                                              days=args.days)
+                elapsed = time.perf_counter() - started
+                print(f"run {run + 1}: {len(report)} jobs in {elapsed:.2f}s ({rows / elapsed / 1e6:.1f}M results/s)")
+
+
+if __name__ == '__main__':
+    main()
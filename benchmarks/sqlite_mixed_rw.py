@@ -0,0 +1,170 @@
+"""Mixed read/write throughput benchmark for the SQLite connection profile.
+
+Runs the same workload twice against a scratch database:
+
+* ``baseline``: the old setup -- one pool, only ``journal_mode=WAL`` set once,
+  every other pragma left at SQLite defaults on the remaining connections;
+* ``tuned``: ``utils.sqlite_profile`` applied on every connection, with the
+  readers on the separate read-only pool.
+
+Writers insert single job results in their own transactions (like the probe
+results endpoint); readers run the dashboard/result-page queries.
+
+Usage:
+    python benchmarks/sqlite_mixed_rw.py [--seconds 10] [--writers 4] [--readers 4] [--rows 200000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sqlite_profile import apply_sqlite_profile, create_read_engine  # noqa: E402
+
+JOBS = 500
+
+SCHEMA = [
+    """CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY, name VARCHAR(100), probe_id INTEGER, is_active BOOLEAN
+    )""",
+    """CREATE TABLE job_results (
+        id INTEGER PRIMARY KEY, job_id INTEGER NOT NULL, timestamp DATETIME,
+        success BOOLEAN, response_time_ms FLOAT, packets_sent INTEGER,
+        packets_received INTEGER, error_message TEXT, kuma_success BOOLEAN, kuma_error TEXT
+    )""",
+    "CREATE INDEX ix_job_results_job_ts ON job_results (job_id, timestamp)",
+]
+
+INSERT = text(
+    "INSERT INTO job_results (job_id, timestamp, success, response_time_ms, packets_sent, "
+    "packets_received, error_message, kuma_success) VALUES "
+    "(:job_id, :timestamp, :success, :rtt, 3, :received, :error, 1)"
+)
+READS = [
+    text("SELECT count(*) FROM jobs WHERE is_active = 1"),
+    text("SELECT * FROM job_results WHERE job_id = :job_id ORDER BY timestamp DESC LIMIT 100"),
+    text("SELECT job_id, avg(response_time_ms), sum(success) FROM job_results "
+         "WHERE job_id = :job_id AND timestamp >= :since GROUP BY job_id"),
+]
+
+
+def seed(path, rows):
+    engine = create_engine(f'sqlite:///{path}')
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(text('PRAGMA journal_mode=WAL'))
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO jobs (id, name, probe_id, is_active) VALUES (:id, :name, 1, 1)"),
+                     [{'id': i, 'name': f'job-{i}'} for i in range(1, JOBS + 1)])
+        conn.execute(INSERT, [_row(now - timedelta(seconds=i)) for i in range(rows)])
+    engine.dispose()
+
+
+def _row(timestamp):
+    success = random.random() > 0.05
+    return {
+        'job_id': random.randint(1, JOBS),
+        'timestamp': timestamp,
+        'success': success,
+        'rtt': random.uniform(1, 80) if success else None,
+        'received': 3 if success else 0,
+        'error': None if success else 'Connection error: Network is unreachable',
+    }
+
+
+def run(write_engine, read_engine, seconds, writers, readers):
+    stop = threading.Event()
+    latencies = {'write': [], 'read': []}
+    errors = {'write': 0, 'read': 0}
+    lock = threading.Lock()
+
+    def writer():
+        local = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                with write_engine.begin() as conn:
+                    conn.execute(INSERT, _row(datetime.utcnow()))
+                local.append(time.perf_counter() - started)
+            except Exception:
+                with lock:
+                    errors['write'] += 1
+        with lock:
+            latencies['write'].extend(local)
+
+    def reader():
+        local = []
+        since = datetime.utcnow() - timedelta(hours=1)
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                with read_engine.connect() as conn:
+                    for query in READS:
+                        conn.execute(query, {'job_id': random.randint(1, JOBS), 'since': since}).fetchall()
+                local.append(time.perf_counter() - started)
+            except Exception:
+                with lock:
+                    errors['read'] += 1
+        with lock:
+            latencies['read'].extend(local)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    report = {}
+    for kind, values in latencies.items():
+        values.sort()
+        report[kind] = {
+            'ops_per_sec': round(len(values) / seconds, 1),
+            'p50_ms': round(statistics.median(values) * 1000, 2) if values else None,
+            'p99_ms': round(values[int(len(values) * 0.99) - 1] * 1000, 2) if values else None,
+            'errors': errors[kind],
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in ('baseline', 'tuned'):
+            path = os.path.join(tmp, f'{profile}.db')
+            seed(path, args.rows)
+            engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 30, 'check_same_thread': False})
+            if profile == 'tuned':
+                apply_sqlite_profile(engine)
+                read_engine = create_read_engine(engine)
+            else:
+                read_engine = engine
+            report = run(engine, read_engine, args.seconds, args.writers, args.readers)
+            print(f"{profile:>8}: " + ' | '.join(
+                f"{kind} {stats['ops_per_sec']}/s p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms err={stats['errors']}"
+                for kind, stats in report.items()
+            ))
+            if read_engine is not engine:
+                read_engine.dispose()
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
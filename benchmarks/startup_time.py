@@ -0,0 +1,81 @@
+"""Cold start benchmark for the server application.
+
+Each run starts a fresh interpreter (like a gunicorn worker restart or a
+container start), imports ``app`` and calls ``create_app()``. The import and
+``create_app`` times are reported separately, together with the number of SQL
+statements issued and how many of them failed.
+
+Usage:
+    python benchmarks/startup_time.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import json, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+stats = {'statements': 0, 'failed': 0, 'db_seconds': 0.0}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before(conn, cursor, statement, parameters, context, executemany):
+    conn.info['started'] = time.perf_counter()
+    stats['statements'] += 1
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after(conn, cursor, statement, parameters, context, executemany):
+    stats['db_seconds'] += time.perf_counter() - conn.info.pop('started', time.perf_counter())
+
+@event.listens_for(Engine, 'handle_error')
+def failed(context):
+    stats['failed'] += 1
+
+from app import create_app, shutdown_maintenance
+imported = time.perf_counter()
+create_app()
+created = time.perf_counter()
+shutdown_maintenance()
+stats.update(import_seconds=imported - started, create_app_seconds=created - imported)
+print(json.dumps(stats))
+"""
+
+
+def run_once(database_uri):
+    env = dict(os.environ, DATABASE_URI=database_uri, PYTHONWARNINGS='ignore')
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(label, samples):
+    def median_ms(key):
+        return round(statistics.median(s[key] for s in samples) * 1000, 1)
+    print(f"{label:>10}: import {median_ms('import_seconds')} ms | create_app {median_ms('create_app_seconds')} ms"
+          f" | db {median_ms('db_seconds')} ms | statements {samples[-1]['statements']}"
+          f" (failed {samples[-1]['failed']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'uptime.db')}"
+        summarize('fresh db', [run_once(uri)])
+        summarize('warm db', [run_once(uri) for _ in range(args.runs)])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SelectField, IntegerField, BooleanField, SubmitField
-from wtforms.validators import DataRequired, Length, Optional, NumberRange, URL
-from models import Probe, Job
+from wtforms.validators import DataRequired, Length, Optional, NumberRange, URL, Regexp
+from urllib.parse import urlparse
+from models import Probe, Job, HTTP_METHODS, DEFAULT_EXPECTED_STATUS, EXPECTED_STATUS_PATTERN, MAX_AGGREGATE_SECONDS
 from wtforms import ValidationError
 
 class JobForm(FlaskForm):
@@ -12,10 +13,25 @@ class JobForm(FlaskForm):
     description = TextAreaField('Description', validators=[
         Length(max=255, message='Description cannot be more than 255 characters')
     ])
+    job_type = SelectField('Check Type', default='ping', choices=[
+        ('ping', 'Ping (ICMP)'),
+        ('tcp', 'TCP connect'),
+        ('http', 'HTTP(S) request'),
+    ])
     target_host = StringField('Target Host', validators=[
         DataRequired('This field is required'),
         Length(min=1, max=256, message='Hostname or IP address must be between 1 and 256 characters')
-    ], description='Hostname or IP address to ping')
+    ], description='Hostname or IP address to check (for HTTP checks, the full URL)')
+    port = IntegerField('Port', validators=[
+        Optional(),
+        NumberRange(min=1, max=65535, message='Port must be between 1 and 65535')
+    ], description='TCP port (TCP checks)')
+    http_method = SelectField('HTTP Method', default='GET', choices=[(method, method) for method in HTTP_METHODS])
+    expected_status = StringField('Expected Status', default=DEFAULT_EXPECTED_STATUS, validators=[
+        Optional(),
+        Regexp(EXPECTED_STATUS_PATTERN, message='Use status codes or ranges separated by commas, e.g. 200-299,301')
+    ], description='Status codes counted as up (HTTP checks)')
+    verify_tls = BooleanField('Verify TLS certificate', default=True)
     kuma_url = StringField('Uptime Kuma URL', validators=[
         DataRequired('This field is required'),
         URL()
@@ -31,17 +47,63 @@ class JobForm(FlaskForm):
     retries = IntegerField('Retries', default=0, validators=[
         NumberRange(min=0, max=5, message='Number of retries must be between 0 and 5')
     ], description='Number of attempts before considering a failure')
+    priority = IntegerField('Priority', default=0, validators=[
+        NumberRange(min=0, max=100, message='Priority must be between 0 and 100')
+    ], description='Higher priority jobs keep running when the probe is overloaded')
+    aggregate_seconds = IntegerField('Aggregate Uploads (seconds)', validators=[
+        Optional(),
+        NumberRange(min=10, max=MAX_AGGREGATE_SECONDS,
+                    message=f'Aggregation window must be between 10 and {MAX_AGGREGATE_SECONDS} seconds')
+    ], description='For high-frequency jobs: the probe uploads statistics per window of this many seconds, plus '
+                   'every failure, instead of every result. Uptime Kuma still gets every check. Leave empty to '
+                   'upload every result')
     is_active = BooleanField('Active', default=True)
-    probe_id = SelectField('Probe', coerce=int, validators=[DataRequired('This field is required')])
+    probe_id = SelectField('Probe', coerce=int, validators=[Optional()])
+    pool = StringField('Probe Pool', validators=[
+        Optional(),
+        Length(max=64, message='Pool name cannot be more than 64 characters')
+    ], description='When set, the server assigns the job to the online probes of this pool by capacity')
     submit = SubmitField('Save')
     
     def __init__(self, *args, **kwargs):
-        # Extract job_id if provided
+        # Extract job_id and (optionally) preloaded probe choices
         self.job_id = kwargs.pop('job_id', None)
+        probe_choices = kwargs.pop('probe_choices', None)
         super(JobForm, self).__init__(*args, **kwargs)
-        self.probe_id.choices = [(p.id, p.name) for p in Probe.query.filter_by(is_active=True).all()]
+        if probe_choices is None:
+            probe_choices = [(p.id, p.name) for p in Probe.query.filter_by(is_active=True).all()]
+        self.probe_id.choices = [(0, 'Automatic (from the pool)')] + list(probe_choices)
         
+    def validate_target_host(self, target_host):
+        if self.job_type.data == 'http':
+            parsed = urlparse(target_host.data or '')
+            if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+                raise ValidationError('HTTP checks need a full http:// or https:// URL')
+    
+    def validate_port(self, port):
+        if self.job_type.data == 'tcp' and not port.data:
+            raise ValidationError('TCP checks need a port')
+    
+    def validate_aggregate_seconds(self, aggregate_seconds):
+        interval = self.interval_seconds.data
+        if aggregate_seconds.data and interval and aggregate_seconds.data < interval:
+            raise ValidationError('The aggregation window must be at least the check interval')
+    
+    def validate_probe_id(self, probe_id):
+        if not probe_id.data and not (self.pool.data or '').strip():
+            raise ValidationError('Select a probe or set a probe pool')
+    
+    def validate_pool(self, pool):
+        name = (pool.data or '').strip()
+        if name and not Probe.query.filter_by(pool=name, is_active=True).first():
+            raise ValidationError('No active probe belongs to this pool')
+    
     def validate_name(self, name):
         job = Job.query.filter_by(name=name.data).first()
         if job and job.id != self.job_id:
             raise ValidationError('This name is already in use by another job')
+
+
+class JobImportForm(FlaskForm):
+    """CSRF protection of the bulk import; the file itself is read from request.files"""
+    submit = SubmitField('Import jobs')
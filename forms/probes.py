@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, BooleanField, SubmitField
-from wtforms.validators import DataRequired, Length, ValidationError
+from wtforms import StringField, TextAreaField, BooleanField, SelectField, SubmitField
+from wtforms.validators import DataRequired, Length, Optional, ValidationError
 from models import Probe
 
 class ProbeForm(FlaskForm):
@@ -12,6 +12,14 @@ class ProbeForm(FlaskForm):
         Length(max=500, message='Description cannot be more than 500 characters')
     ])
     is_active = BooleanField('Active', default=True)
+    kuma_push_mode = SelectField('Uptime Kuma Push', default='probe', choices=[
+        ('probe', 'Probe pushes directly to Uptime Kuma'),
+        ('server', 'Server pushes to Uptime Kuma (probe only reports to the server)')
+    ], description='Where the Uptime Kuma push requests are made from')
+    pool = StringField('Pool', validators=[
+        Optional(),
+        Length(max=64, message='Pool name cannot be more than 64 characters')
+    ], description='Jobs assigned to this pool are spread automatically across its online probes')
     submit = SubmitField('Save')
     
     def __init__(self, *args, **kwargs):
@@ -19,7 +19,7 @@ errorlog = "logs/gunicorn-error.log"    # Arquivo de log separado
 proc_name = "uptime-monitor"
 
 # Server mechanics
-preload_app = True    # Pré-carrega a aplicação para evitar múltiplos schedulers
+preload_app = True    # Pré-carrega a aplicação; o runner de manutenção fica no master (ver utils/maintenance.py)
 max_requests = 1000   # Limita o número máximo de requisições por worker
 max_requests_jitter = 50  # Adiciona jitter para prevenir reinicializações simultâneas
 
@@ -0,0 +1,471 @@
+"""Asyncio fast path for probe traffic.
+
+Serves only the probe endpoints (``/api/probe/<key>/jobs``, ``/heartbeat`` and
+``/results``) with the same responses as the Flask API, without the Flask
+request stack: API keys are resolved through ``utils.probe_ingest.ProbeCache``,
+payloads go through the same ``validate_result`` and writes are grouped --
+every request arriving within ``INGEST_FLUSH_MS`` (or until
+``INGEST_BATCH_SIZE`` rows) is written in one transaction with core
+``executemany`` inserts, and each request is answered once its transaction
+commits. The admin UI keeps running on gunicorn/Flask; point the probes'
+``SERVER_URL`` (or a proxy location for ``/api/probe/``) at this listener:
+
+    MAINTENANCE_MODE=external gunicorn --config=gunicorn_config.py wsgi:app
+    python ingest_server.py
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+
+from app import create_app, db, logger
+from models import to_epoch_us
+from utils import job_health, metrics, probe_ingest
+
+api_logger = logging.getLogger('api')
+
+PROBE_PATH = re.compile(r'^/api/probe/([^/]+)/(jobs|heartbeat|results)$')
+METHODS = {'jobs': 'GET', 'heartbeat': 'POST', 'results': 'POST'}
+# Mesmos limites das rotas Flask (routes/api.py)
+RATE_LIMITS = {'jobs': '10 per minute', 'heartbeat': '30 per minute', 'results': '100 per minute'}
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 429: 'Too Many Requests', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 501: 'Not Implemented',
+}
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = 1024 * 1024
+INVALID_KEY = {'status': 'error', 'message': 'Invalid or inactive API key'}
+
+
+def _response(status, payload, keep_alive=True):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+class _Write:
+    """Rows of one request, kept apart so a failed group commit can be retried per request"""
+    __slots__ = ('results', 'aggregates', 'logs', 'seen', 'loads', 'after', 'future')
+
+    def __init__(self, results, aggregates, logs, seen, loads, after, future):
+        self.results = results
+        self.aggregates = aggregates
+        self.logs = logs
+        self.seen = seen
+        self.loads = loads
+        self.after = after
+        self.future = future
+
+
+class WriteBatcher:
+    """Group commit of ingest writes
+
+    ``submit`` queues rows and returns a future resolved when the transaction
+    holding them commits; ``after`` callbacks (health state, metrics) run
+    right after that commit, in the writer thread. When a group commit fails
+    (e.g. a result for a job deleted less than ``PROBE_CACHE_TTL`` seconds
+    ago), each request is written again on its own, so only the bad one fails.
+    """
+
+    def __init__(self, app, engine, max_items=500, max_delay=0.002):
+        self.app = app
+        self.engine = engine
+        self.max_items = max_items
+        self.max_delay = max_delay
+        # Uma única thread de escrita: o SQLite serializa os writers de qualquer forma
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-writer')
+        self._ready = asyncio.Event()
+        self._pending = []
+
+    def submit(self, result=None, log=None, seen=None, load=None, after=None, results=(), aggregates=()):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(_Write(
+            ([result] if result is not None else []) + list(results),
+            list(aggregates),
+            [log] if log is not None else [],
+            dict([seen]) if seen is not None else {},
+            dict([load]) if load is not None else {},
+            after,
+            future,
+        ))
+        self._ready.set()
+        return future
+
+    def _write(self, writes):
+        seen, loads = {}, {}
+        for write in writes:
+            seen.update(write.seen)
+            loads.update(write.loads)
+        probe_ingest.write_batch(
+            self.engine,
+            [row for write in writes for row in write.results],
+            [row for write in writes for row in write.logs],
+            seen, loads,
+            [row for write in writes for row in write.aggregates],
+        )
+
+    def _flush(self, writes):
+        """Write the batch; returns the error of each request (None when written)"""
+        metrics.current_endpoint.set('ingest.write')
+        try:
+            self._write(writes)
+            errors = [None] * len(writes)
+        except Exception as e:
+            if len(writes) == 1:
+                return [e]
+            logger.warning(f"Ingest batch of {len(writes)} requests failed ({str(e)}), writing them one by one")
+            errors = []
+            for write in writes:
+                try:
+                    self._write([write])
+                    errors.append(None)
+                except Exception as error:
+                    errors.append(error)
+        callbacks = [write.after for write, error in zip(writes, errors) if error is None and write.after]
+        if callbacks:
+            with self.app.app_context():
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logger.warning(f"Ingest post-commit callback failed: {str(e)}")
+        return errors
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+            if len(self._pending) < self.max_items:
+                await asyncio.sleep(self.max_delay)
+            self._ready.clear()
+            writes, self._pending = self._pending, []
+            try:
+                errors = await loop.run_in_executor(self.executor, self._flush, writes)
+            except Exception as e:
+                errors = [e] * len(writes)
+            failed = [error for error in errors if error is not None]
+            if failed:
+                logger.error(f"{len(failed)} of {len(writes)} ingest requests failed: {str(failed[0])}")
+            for write, error in zip(writes, errors):
+                if write.future.done():
+                    continue
+                if error is None:
+                    write.future.set_result(True)
+                else:
+                    write.future.set_exception(error)
+
+
+class IngestServer:
+    def __init__(self, app, batch_size=500, flush_ms=2.0, readers=4):
+        self.app = app
+        with app.app_context():
+            self.engine = db.engine
+        self.cache = probe_ingest.ProbeCache()
+        self.batcher = WriteBatcher(app, self.engine, batch_size, flush_ms / 1000.0)
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='ingest-reader')
+        self._jobs_payloads = {}
+        self._limiter = self._rate_limiter()
+
+    def _rate_limiter(self):
+        if os.environ.get('ENABLE_RATE_LIMITING', 'True').lower() != 'true':
+            return None
+        from limits import parse, storage, strategies
+        import utils.shm_limiter  # noqa: F401  (registra shm://)
+        backend = storage.storage_from_string(os.environ.get('RATELIMIT_STORAGE_URI', 'shm://'))
+        return strategies.FixedWindowRateLimiter(backend), {name: parse(value) for name, value in RATE_LIMITS.items()}
+
+    def _allowed(self, endpoint, api_key):
+        if self._limiter is None:
+            return True
+        limiter, limits = self._limiter
+        return limiter.hit(limits[endpoint], 'ingest', endpoint, f'probe:{api_key}')
+
+    async def _read(self, func, *args):
+        def run():
+            metrics.current_endpoint.set('ingest.read')
+            with self.engine.connect() as conn:
+                return func(conn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self.readers, run)
+
+    async def _probe(self, api_key, refresh=False):
+        if not refresh:
+            hit, info = self.cache.peek(api_key)
+            if hit:
+                return info
+        return await self._read(self.cache.get, api_key, refresh)
+
+    async def jobs(self, api_key, body, client_ip):
+        api_logger.info(f"Probe connection from IP {client_ip} with API key {api_key}")
+        # A lista de jobs sempre relê o probe: mudanças de configuração valem na hora
+        info = await self._probe(api_key, refresh=True)
+        if info is None:
+            api_logger.warning(f"Failed connection attempt with invalid API key: {api_key} from IP {client_ip}")
+            return 401, INVALID_KEY
+        now = datetime.utcnow()
+        try:
+            await self.batcher.submit(
+                log=probe_ingest.log_row(info.id, 'fetch_jobs', client_ip, "Probe requested configured jobs list", now),
+                seen=(info.id, now),
+            )
+        except Exception as e:
+            logger.error(f"Database error in ingest jobs: {str(e)}")
+        # Corpo da resposta em cache enquanto a configuração do probe não muda
+        version = (info.config_version, info.kuma_push_mode, info.name)
+        cached = self._jobs_payloads.get(info.id)
+        if cached is None or cached[0] != version:
+            payload = await self._read(probe_ingest.jobs_payload, info)
+            cached = (version, json.dumps(payload).encode('utf-8'))
+            self._jobs_payloads[info.id] = cached
+        return 200, cached[1]
+
+    async def heartbeat(self, api_key, body, client_ip):
+        info = await self._probe(api_key)
+        if info is None:
+            api_logger.warning(f"Failed heartbeat attempt with invalid API key: {api_key} from IP {client_ip}")
+            return 401, INVALID_KEY
+        now = datetime.utcnow()
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        load = probe_ingest.load_report(data, now)
+        try:
+            await self.batcher.submit(
+                log=probe_ingest.log_row(info.id, 'heartbeat', client_ip, probe_ingest.heartbeat_details(load), now),
+                seen=(info.id, now),
+                load=(info.id, load) if load else None,
+            )
+            api_logger.info(f"Heartbeat from probe {info.name} (ID: {info.id}) from IP {client_ip}")
+        except Exception as e:
+            logger.error(f"Database error in ingest heartbeat: {str(e)}")
+        return 200, {'status': 'success', 'message': 'Heartbeat received', 'timestamp': datetime.utcnow().isoformat()}
+
+    async def results(self, api_key, body, client_ip):
+        info = await self._probe(api_key)
+        if info is None:
+            return 401, INVALID_KEY
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if probe_ingest.is_batch(data):
+            return await self.results_batch(api_key, info, data, client_ip)
+        try:
+            result = probe_ingest.validate_result(data)
+        except probe_ingest.ValidationError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+
+        job_id = result['job_id']
+        if job_id not in info.jobs:
+            found, _ = await self._read(self.cache.job_url, api_key, info, job_id)
+            if not found:
+                return 404, {'status': 'error', 'message': 'Job not found or not assigned to this probe'}
+
+        received_at = datetime.utcnow()
+        timestamp_us = to_epoch_us(received_at)
+        server_push = info.server_push
+
+        def after_commit():
+            metrics.record_result(info.name, None if server_push else result['kuma_success'])
+            if not result['aggregated']:
+                job_health.observe_result(job_id, received_at, result['success'], result['response_time_ms'],
+                                          result['packets_sent'], result['packets_received'])
+
+        try:
+            await self.batcher.submit(
+                result=probe_ingest.result_row(result, timestamp_us, server_push),
+                log=probe_ingest.log_row(info.id, 'job_result_submission', client_ip,
+                                         f"Probe submitted job results from IP {client_ip}", received_at),
+                after=after_commit,
+            )
+        except Exception as e:
+            return 500, {'status': 'error', 'message': f'Error recording job result: {str(e)}'}
+        return 200, {'status': 'success', 'message': 'Job result recorded successfully'}
+
+    async def results_batch(self, api_key, info, data, client_ip):
+        """Batch of results and aggregates ({"results": [...], "aggregates": [...]}),
+        written in the same group commit as concurrent requests"""
+        try:
+            results, errors = probe_ingest.validate_batch(data)
+            aggregates, aggregate_errors = probe_ingest.validate_aggregates(data)
+        except probe_ingest.ValidationError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+
+        received_at = datetime.utcnow()
+        server_push = info.server_push
+        rows, recorded, kuma_urls = [], [], {}
+        seen = set()
+
+        async def job_url(job_id):
+            if job_id not in kuma_urls:
+                if job_id in info.jobs:
+                    kuma_urls[job_id] = (True, info.jobs[job_id])
+                else:
+                    kuma_urls[job_id] = await self._read(self.cache.job_url, api_key, info, job_id)
+            return kuma_urls[job_id]
+
+        for result in results:
+            job_id = result['job_id']
+            found, _ = await job_url(job_id)
+            if not found:
+                errors.append({'index': result['index'], 'message': 'Job not found or not assigned to this probe'})
+                continue
+            timestamp = probe_ingest.result_time(result, received_at)
+            timestamp_us = to_epoch_us(timestamp)
+            if (job_id, timestamp_us) in seen:
+                errors.append({'index': result['index'], 'message': 'Duplicate result'})
+                continue
+            seen.add((job_id, timestamp_us))
+            rows.append(probe_ingest.result_row(result, timestamp_us, server_push))
+            recorded.append((result, timestamp))
+
+        windows = []
+        for aggregate in aggregates:
+            found, _ = await job_url(aggregate['job_id'])
+            if not found:
+                aggregate_errors.append({'index': aggregate['index'],
+                                         'message': 'Job not found or not assigned to this probe'})
+                continue
+            windows.append((aggregate, probe_ingest.aggregate_row(
+                aggregate, probe_ingest.window_start(aggregate, received_at))))
+
+        def after_commit():
+            for result, timestamp in recorded:
+                metrics.record_result(info.name, None if server_push else result['kuma_success'])
+                if not result['aggregated']:
+                    job_health.observe_result(result['job_id'], timestamp, result['success'],
+                                              result['response_time_ms'], result['packets_sent'],
+                                              result['packets_received'])
+            for aggregate, row in windows:
+                job_health.observe_aggregate(aggregate['job_id'], probe_ingest.window_end(row), aggregate['count'],
+                                             aggregate['successes'], aggregate['latency_avg_ms'],
+                                             aggregate['packets_sent'], aggregate['packets_received'])
+
+        try:
+            await self.batcher.submit(
+                results=rows,
+                aggregates=[row for _, row in windows],
+                log=probe_ingest.log_row(info.id, 'job_result_submission', client_ip,
+                                         f"Probe submitted {len(rows)} job results and {len(windows)} aggregates "
+                                         f"from IP {client_ip}", received_at),
+                after=after_commit,
+            )
+        except Exception as e:
+            return 500, {'status': 'error', 'message': f'Error recording job results: {str(e)}'}
+        return 200, {'status': 'success', 'message': f'{len(rows)} job results and {len(windows)} aggregates recorded',
+                     'recorded': len(rows), 'aggregates_recorded': len(windows),
+                     'errors': sorted(errors, key=lambda error: error['index']),
+                     'aggregate_errors': sorted(aggregate_errors, key=lambda error: error['index'])}
+
+    async def dispatch(self, method, target, body, client_ip):
+        match = PROBE_PATH.match(target.split('?', 1)[0])
+        if not match:
+            return 404, {'status': 'error', 'message': 'Not found'}
+        api_key, endpoint = match.groups()
+        if method != METHODS[endpoint]:
+            return 405, {'status': 'error', 'message': 'Method not allowed'}
+        if not self._allowed(endpoint, api_key):
+            return 429, {'status': 'error', 'message': f'Rate limit exceeded: {RATE_LIMITS[endpoint]}'}
+        return await getattr(self, endpoint)(api_key, body, client_ip)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else None
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(_response(431, {'status': 'error', 'message': 'Headers too large'}, False))
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ', 2)
+                except ValueError:
+                    writer.write(_response(400, {'status': 'error', 'message': 'Bad request line'}, False))
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if value:
+                        headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                if 'chunked' in headers.get('transfer-encoding', '').lower():
+                    writer.write(_response(501, {'status': 'error', 'message': 'Chunked bodies not supported'}, False))
+                    break
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > MAX_BODY_SIZE:
+                    writer.write(_response(413, {'status': 'error', 'message': 'Invalid body size'}, False))
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                started = perf_counter()
+                try:
+                    status, payload = await self.dispatch(method, target, body, client_ip)
+                except Exception as e:
+                    logger.error(f"Ingest error on {method} {target}: {str(e)}")
+                    status, payload = 500, {'status': 'error', 'message': 'Internal server error'}
+                match = PROBE_PATH.match(target.split('?', 1)[0])
+                endpoint = f'ingest.{match.group(2)}' if match else 'ingest.unmatched'
+                metrics.http_duration.observe(perf_counter() - started, endpoint)
+                metrics.http_requests.inc(endpoint, method, status)
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, stop):
+        batcher = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE, backlog=1024)
+        logger.info(f"Ingest server listening on {host}:{port} (pid {os.getpid()})")
+        async with server:
+            await stop.wait()
+        # Últimas escritas pendentes antes de sair
+        started = perf_counter()
+        while self.batcher._pending and perf_counter() - started < 5:
+            await asyncio.sleep(0.01)
+        batcher.cancel()
+        self.batcher.executor.shutdown(wait=True)
+        self.readers.shutdown(wait=False)
+
+
+async def main():
+    app = create_app(start_maintenance=False)
+    server = IngestServer(
+        app,
+        batch_size=int(os.environ.get('INGEST_BATCH_SIZE', 500)),
+        flush_ms=float(os.environ.get('INGEST_FLUSH_MS', 2)),
+        readers=int(os.environ.get('INGEST_READERS', 4)),
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # Encerrar de forma limpa com SIGTERM/SIGINT (docker stop, Ctrl+C)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await server.serve(os.environ.get('INGEST_HOST', '0.0.0.0'), int(os.environ.get('INGEST_PORT', 5002)), stop)
+    logger.info("Ingest server stopped")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+"""Run the maintenance tasks in a dedicated low-priority process.
+
+Use together with MAINTENANCE_MODE=external on the web processes, so cleanup,
+checkpoints and the server-side Uptime Kuma pushes never compete with request
+handling:
+
+    MAINTENANCE_MODE=external gunicorn --config=gunicorn_config.py wsgi:app
+    python maintenance.py
+"""
+import os
+import signal
+
+from app import create_app, logger
+from utils.kuma_dispatcher import start_dispatch_runner
+from utils.maintenance import MaintenanceRunner, default_lock_path, lower_priority
+
+if __name__ == "__main__":
+    lower_priority(int(os.environ.get('MAINTENANCE_NICE', 10)))
+    app = create_app(start_maintenance=False)
+    
+    from app import db
+    with app.app_context():
+        lock_path = os.environ.get('MAINTENANCE_LOCK_FILE') or default_lock_path(db.engine)
+    runner = MaintenanceRunner(app, lock_path, poll_interval=int(os.environ.get('MAINTENANCE_POLL_INTERVAL', 15)))
+    # Os pushes do modo 'server' ao Uptime Kuma saem deste processo, com sua própria eleição
+    dispatch_runner = start_dispatch_runner(app)
+    
+    def stop(sig, frame):
+        dispatch_runner.stop()
+        runner.stop()
+    
+    # Encerrar de forma limpa com SIGTERM/SIGINT (docker stop, Ctrl+C)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    logger.info(f"Maintenance process started (pid {os.getpid()}), lock file: {lock_path}")
+    runner.run()
+    logger.info("Maintenance process stopped")
@@ -1,5 +1,12 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
+import time
 from app import db
+from sqlalchemy import event, false as sa_false, select, text, true as sa_true
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.types import TypeDecorator
 from flask_login import UserMixin
 from passlib.hash import pbkdf2_sha256
 from itsdangerous import URLSafeTimedSerializer as Serializer
@@ -44,6 +51,18 @@ class Probe(db.Model):
     last_seen = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # 'probe': the probe pushes to Uptime Kuma itself; 'server': the server dispatches the pushes
+    kuma_push_mode = db.Column(db.String(10), default='probe', nullable=False)
+    # Incremented whenever the probe's job set changes
+    config_version = db.Column(db.Integer, default=1, nullable=False)
+    # Carga informada no último heartbeat (capacidade em checks/s, fração dos slots usada)
+    overloaded = db.Column(db.Boolean, default=False, server_default=sa_false(), nullable=False)
+    utilization = db.Column(db.Float, nullable=True)
+    capacity = db.Column(db.Float, nullable=True)
+    load_report = db.Column(db.Text, nullable=True)  # JSON completo do último relatório
+    load_reported_at = db.Column(db.DateTime, nullable=True)
+    # Pool de probes: jobs do mesmo pool são distribuídos automaticamente entre os probes online
+    pool = db.Column(db.String(64), nullable=True, index=True)
     
     # Relationship with jobs
     jobs = db.relationship('Job', backref='probe', lazy='dynamic')
@@ -54,20 +73,44 @@ class Probe(db.Model):
         self.api_key = secrets.token_hex(32)
         return self.api_key
     
+    def bump_config_version(self):
+        """Mark the probe's job configuration as changed"""
+        self.config_version = (self.config_version or 0) + 1
+    
     def __repr__(self):
         return f'<Probe {self.name}>'
 
+JOB_TYPES = ('ping', 'tcp', 'http')
+HTTP_METHODS = ('GET', 'HEAD')
+# Faixas de status HTTP aceitas como "up" (ex.: '200-299,301')
+DEFAULT_EXPECTED_STATUS = '200-399'
+EXPECTED_STATUS_PATTERN = r'^\d{3}(-\d{3})?(,\d{3}(-\d{3})?)*$'
+# Longest window of the aggregate upload mode (Job.aggregate_seconds)
+MAX_AGGREGATE_SECONDS = 3600
+
+
 class Job(db.Model):
     __tablename__ = 'jobs'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    job_type = db.Column(db.String(20), default='ping', nullable=False)  # Set as 'ping'
-    target_host = db.Column(db.String(256), nullable=False)  # Host for ping
+    job_type = db.Column(db.String(20), default='ping', nullable=False)  # One of JOB_TYPES
+    target_host = db.Column(db.String(256), nullable=False)  # Host (ping, tcp) or URL (http)
+    port = db.Column(db.Integer, nullable=True)  # TCP port of 'tcp' jobs
+    http_method = db.Column(db.String(8), nullable=True)  # 'http' jobs: GET or HEAD
+    expected_status = db.Column(db.String(64), nullable=True)  # 'http' jobs: accepted status ranges
+    verify_tls = db.Column(db.Boolean, default=True, server_default=sa_true(), nullable=False)  # 'http' jobs: check the certificate
     kuma_url = db.Column(db.String(256), nullable=False)  # URL of Uptime Kuma to send results
     interval_seconds = db.Column(db.Integer, default=300, nullable=False)
     timeout_seconds = db.Column(db.Integer, default=10, nullable=False)
     retries = db.Column(db.Integer, default=3, nullable=False)
+    # Higher runs first; an overloaded probe with the 'skip' policy drops the lowest first
+    priority = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # When set, the server picks probe_id among the online probes of this pool (utils/pool_assignment.py)
+    pool = db.Column(db.String(64), nullable=True, index=True)
+    # When set, the probe uploads one JobResultAggregate per window of this many seconds
+    # plus its failures and recoveries, instead of every result
+    aggregate_seconds = db.Column(db.Integer, nullable=True)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -77,25 +120,351 @@ class Job(db.Model):
     
     # Relationship with job results
     results = db.relationship('JobResult', backref='job', lazy='dynamic', cascade='all, delete-orphan')
+    aggregates = db.relationship('JobResultAggregate', backref='job', lazy='dynamic', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Job {self.name}> ({self.job_type})'
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_us(value):
+    """Naive UTC datetime -> integer microseconds since the epoch"""
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+class EpochMicroseconds(TypeDecorator):
+    """Naive UTC datetime stored as integer microseconds since the epoch"""
+    impl = db.Integer
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return to_epoch_us(value)
+        return value
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return EPOCH + timedelta(microseconds=value)
+
+
+# Cache do processo: texto -> id em result_messages. As entradas expiram para que a
+# limpeza possa remover mensagens sem uso sem invalidar ids ainda em cache (ver purge_unused)
+_message_ids = {}
+MESSAGE_CACHE_TTL = 600
+MESSAGE_CACHE_SIZE = 10000
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_message_ids(session):
+    # Um rollback pode ter desfeito mensagens recém-inseridas
+    _message_ids.clear()
+
+
+@event.listens_for(Engine, 'rollback')
+def _forget_connection_message_ids(conn):
+    # Transações de Connection (recorder do dispatcher, ingest): só os textos internados nela
+    for value in conn.info.pop('interned_messages', ()):
+        _message_ids.pop(value, None)
+
+
+@event.listens_for(Engine, 'commit')
+def _keep_connection_message_ids(conn):
+    conn.info.pop('interned_messages', None)
+
+
+def _message_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def intern_message_id(executor, value):
+    """Return the result_messages id for value, inserting it if needed
+
+    executor is a Session or Connection; the insert joins its transaction.
+    """
+    if value is None:
+        return None
+    now = time.time()
+    cached = _message_ids.get(value)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    digest = _message_hash(value)
+    executor.execute(text(
+        "INSERT INTO result_messages (hash, text, last_used) VALUES (:hash, :text, :now) "
+        "ON CONFLICT (hash) DO UPDATE SET last_used = :now"
+    ), {'hash': digest, 'text': value, 'now': int(now)})
+    message_id = executor.execute(
+        text("SELECT id FROM result_messages WHERE hash = :hash"), {'hash': digest}
+    ).scalar()
+    if len(_message_ids) >= MESSAGE_CACHE_SIZE:
+        _message_ids.clear()
+    _message_ids[value] = (message_id, now + MESSAGE_CACHE_TTL)
+    if isinstance(executor, Connection):
+        executor.info.setdefault('interned_messages', set()).add(value)
+    return message_id
+
+
+class ResultMessage(db.Model):
+    """Interned error texts referenced by job results"""
+    __tablename__ = 'result_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.BigInteger, nullable=False, unique=True)
+    text = db.Column(db.Text, nullable=False)
+    last_used = db.Column(db.Integer, nullable=False)  # epoch seconds of the last intern
+    
+    @classmethod
+    def intern(cls, value):
+        """Return the (session-attached) message for value without re-reading it"""
+        message_id = intern_message_id(db.session, value)
+        if message_id is None:
+            return None
+        message = cls(id=message_id, hash=_message_hash(value), text=value, last_used=0)
+        make_transient_to_detached(message)
+        return db.session.merge(message, load=False)
+    
+    def __repr__(self):
+        return f'<ResultMessage {self.id}>'
+
+
+# Bits de JobResult.flags
+FLAG_SUCCESS = 1
+FLAG_KUMA_SUCCESS = 2
+FLAG_KUMA_PENDING = 4
+# Resultado enviado por um job no modo agregado: já contado na janela em job_result_aggregates
+FLAG_AGGREGATED = 8
+DEFAULT_FLAGS = FLAG_KUMA_SUCCESS
+PACKETS_NULL = 0xFFFF
+
+
+def result_flags(success, kuma_success=True, aggregated=False):
+    """flags value for a result; kuma_success None marks a pending server-side push"""
+    flags = FLAG_SUCCESS if success else 0
+    if aggregated:
+        flags |= FLAG_AGGREGATED
+    if kuma_success is None:
+        return flags | FLAG_KUMA_PENDING
+    return flags | FLAG_KUMA_SUCCESS if kuma_success else flags
+
+
+def pack_packets(sent, received):
+    """(sent << 16) | received, PACKETS_NULL for a missing count, None if both are missing"""
+    if sent is None and received is None:
+        return None
+    encoded = [PACKETS_NULL if count is None else min(int(count), PACKETS_NULL - 1) for count in (sent, received)]
+    return (encoded[0] << 16) | encoded[1]
+
+
 class JobResult(db.Model):
+    """One check result, stored compactly
+
+    Rows are clustered by (job_id, timestamp) in a WITHOUT ROWID table, the
+    latency is kept as integer microseconds, success/kuma_success are bits of
+    ``flags``, both packet counts share one integer and error texts are
+    interned in ``result_messages``. The attributes below keep the original
+    interface (``success``, ``response_time_ms``, ``error_message``...).
+    """
     __tablename__ = 'job_results'
-    id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    success = db.Column(db.Boolean, default=False)
-    response_time_ms = db.Column(db.Float, nullable=True)
+    __table_args__ = (
+        db.Index('ix_job_results_error_id', 'error_id', 'timestamp', sqlite_where=text('error_id IS NOT NULL')),
+        db.Index('ix_job_results_kuma_error_id', 'kuma_error_id', 'timestamp', sqlite_where=text('kuma_error_id IS NOT NULL')),
+        # Fila de pushes do modo 'server' (ver utils/kuma_dispatcher.py)
+        db.Index('ix_job_results_kuma_pending', 'job_id', 'timestamp', sqlite_where=text(f'(flags & {FLAG_KUMA_PENDING}) != 0')),
+        {'sqlite_with_rowid': False},
+    )
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), primary_key=True, autoincrement=False)
+    timestamp = db.Column(EpochMicroseconds, primary_key=True, default=datetime.utcnow)
+    flags = db.Column(db.Integer, nullable=False, default=DEFAULT_FLAGS)
+    response_time_us = db.Column(db.Integer, nullable=True)
+    packets = db.Column(db.Integer, nullable=True)  # (sent << 16) | received; 0xFFFF means NULL
+    error_id = db.Column(db.Integer, db.ForeignKey('result_messages.id'), nullable=True)
+    kuma_error_id = db.Column(db.Integer, db.ForeignKey('result_messages.id'), nullable=True)
+    
+    error = db.relationship('ResultMessage', foreign_keys=[error_id], lazy='joined')
+    kuma_error_ref = db.relationship('ResultMessage', foreign_keys=[kuma_error_id], lazy='joined')
+    
+    @property
+    def id(self):
+        """Stable identifier of the result (job id and timestamp in microseconds)"""
+        return f'{self.job_id}-{to_epoch_us(self.timestamp)}'
+    
+    def _set_flag(self, flag, enabled):
+        flags = DEFAULT_FLAGS if self.flags is None else self.flags
+        self.flags = flags | flag if enabled else flags & ~flag
+    
+    @hybrid_property
+    def success(self):
+        return bool((self.flags or 0) & FLAG_SUCCESS)
+    
+    @success.setter
+    def success(self, value):
+        self._set_flag(FLAG_SUCCESS, bool(value))
+    
+    @success.expression
+    def success(cls):
+        return cls.flags.op('&')(FLAG_SUCCESS) != 0
+    
+    @hybrid_property
+    def kuma_success(self):
+        """True/False, or None while a server-side Kuma push is pending"""
+        flags = DEFAULT_FLAGS if self.flags is None else self.flags
+        if flags & FLAG_KUMA_PENDING:
+            return None
+        return bool(flags & FLAG_KUMA_SUCCESS)
+    
+    @kuma_success.setter
+    def kuma_success(self, value):
+        self._set_flag(FLAG_KUMA_PENDING, value is None)
+        self._set_flag(FLAG_KUMA_SUCCESS, bool(value))
+    
+    @kuma_success.expression
+    def kuma_success(cls):
+        return cls.flags.op('&')(FLAG_KUMA_SUCCESS) != 0
+    
+    @hybrid_property
+    def aggregated(self):
+        """Uploaded by a job in aggregate mode (also counted in its JobResultAggregate)"""
+        return bool((self.flags or 0) & FLAG_AGGREGATED)
+    
+    @aggregated.setter
+    def aggregated(self, value):
+        self._set_flag(FLAG_AGGREGATED, bool(value))
+    
+    @aggregated.expression
+    def aggregated(cls):
+        return cls.flags.op('&')(FLAG_AGGREGATED) != 0
+    
+    @hybrid_property
+    def response_time_ms(self):
+        return None if self.response_time_us is None else self.response_time_us / 1000.0
+    
+    @response_time_ms.setter
+    def response_time_ms(self, value):
+        self.response_time_us = None if value is None else int(round(float(value) * 1000))
+    
+    @response_time_ms.expression
+    def response_time_ms(cls):
+        return cls.response_time_us / 1000.0
+    
+    def _packet_count(self, shift):
+        if self.packets is None:
+            return None
+        value = (self.packets >> shift) & PACKETS_NULL
+        return None if value == PACKETS_NULL else value
+    
+    def _set_packet_count(self, shift, value):
+        other_shift = 0 if shift else 16
+        counts = {shift: value, other_shift: self._packet_count(other_shift)}
+        self.packets = pack_packets(counts[16], counts[0])
+    
+    @hybrid_property
+    def packets_sent(self):
+        return self._packet_count(16)
+    
+    @packets_sent.setter
+    def packets_sent(self, value):
+        self._set_packet_count(16, value)
+    
+    @packets_sent.expression
+    def packets_sent(cls):
+        return cls.packets.op('>>')(16)
+    
+    @hybrid_property
+    def packets_received(self):
+        return self._packet_count(0)
+    
+    @packets_received.setter
+    def packets_received(self, value):
+        self._set_packet_count(0, value)
+    
+    @packets_received.expression
+    def packets_received(cls):
+        return cls.packets.op('&')(PACKETS_NULL)
+    
+    @hybrid_property
+    def error_message(self):
+        return self.error.text if self.error is not None else None
+    
+    @error_message.setter
+    def error_message(self, value):
+        self.error = ResultMessage.intern(value)
+    
+    @error_message.expression
+    def error_message(cls):
+        return select(ResultMessage.text).where(ResultMessage.id == cls.error_id).scalar_subquery()
+    
+    @hybrid_property
+    def kuma_error(self):
+        return self.kuma_error_ref.text if self.kuma_error_ref is not None else None
+    
+    @kuma_error.setter
+    def kuma_error(self, value):
+        self.kuma_error_ref = ResultMessage.intern(value)
+    
+    @kuma_error.expression
+    def kuma_error(cls):
+        return select(ResultMessage.text).where(ResultMessage.id == cls.kuma_error_id).scalar_subquery()
+    
+    def __repr__(self):
+        return f'<JobResult {self.job_id} at {self.timestamp}>'
+
+class JobResultAggregate(db.Model):
+    """Statistics of a job's checks over one window (aggregate upload mode)
+
+    Jobs with ``aggregate_seconds`` upload one row per window instead of one
+    ``job_results`` row per check: check and success counts, latency of the
+    successful checks (min/avg/max/p95, integer microseconds) and packet
+    totals. Their failed checks, and the check that ends each failure run, are
+    also stored as ``job_results`` rows with ``FLAG_AGGREGATED``. Clustered by
+    (job_id, window_start) like job_results.
+    """
+    __tablename__ = 'job_result_aggregates'
+    __table_args__ = {'sqlite_with_rowid': False}
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), primary_key=True, autoincrement=False)
+    window_start = db.Column(EpochMicroseconds, primary_key=True)
+    window_seconds = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    successes = db.Column(db.Integer, nullable=False)
+    latency_min_us = db.Column(db.Integer, nullable=True)
+    latency_avg_us = db.Column(db.Integer, nullable=True)
+    latency_max_us = db.Column(db.Integer, nullable=True)
+    latency_p95_us = db.Column(db.Integer, nullable=True)
     packets_sent = db.Column(db.Integer, nullable=True)
     packets_received = db.Column(db.Integer, nullable=True)
-    error_message = db.Column(db.Text, nullable=True)
-    kuma_success = db.Column(db.Boolean, default=True)  # New column to indicate if the sending to Kuma was successful
-    kuma_error = db.Column(db.Text, nullable=True)      # New column to store the error of communication with Kuma
+    
+    @property
+    def window_end(self):
+        return self.window_start + timedelta(seconds=self.window_seconds)
+    
+    @property
+    def uptime_pct(self):
+        return self.successes * 100.0 / self.count if self.count else None
+    
+    @property
+    def loss_pct(self):
+        if not self.packets_sent or self.packets_received is None:
+            return None
+        return max(0.0, 1.0 - self.packets_received / self.packets_sent) * 100.0
+    
+    def latency_ms(self, name):
+        """'min', 'avg', 'max' or 'p95' latency in ms (None without successful checks)"""
+        value = getattr(self, f'latency_{name}_us')
+        return None if value is None else value / 1000.0
     
     def __repr__(self):
-        return f'<JobResult {self.job_id} at {self.timestamp}>'
+        return f'<JobResultAggregate {self.job_id} at {self.window_start}>'
+
+class JobHealth(db.Model):
+    """Checkpoint of the streaming health state of a job (see utils/job_health.py)"""
+    __tablename__ = 'job_health'
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), primary_key=True, autoincrement=False)
+    flags = db.Column(db.Integer, nullable=False, default=0)
+    state = db.Column(db.LargeBinary, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<JobHealth {self.job_id} flags={self.flags}>'
 
 # Model for probe connection logs
 class ProbeLog(db.Model):
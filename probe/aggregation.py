@@ -0,0 +1,150 @@
+"""Aggregate upload mode of high-frequency jobs.
+
+Jobs with ``aggregate_seconds`` (set on the server) still push every check to
+Uptime Kuma, but instead of every result the server gets:
+
+* one aggregate per window of ``aggregate_seconds``: check and success
+  counts, min/avg/max/p95 latency of the successful checks and packet totals;
+* the raw failed results and the result that ends each failure run, marked
+  ``aggregated`` (they are also counted in their window).
+
+A window starts at its first check and is uploaded once a check falls past
+its end or ``AGGREGATE_FLUSH_DELAY`` seconds after it ends (default 5), so
+checks still running at the boundary land in it. Open windows are uploaded on
+shutdown. Jobs of probes in 'server' push mode are never aggregated: the
+server needs every result to push it to Kuma.
+"""
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+import probe_metrics as metrics
+
+FLUSH_DELAY = float(os.environ.get('AGGREGATE_FLUSH_DELAY', 5))
+
+aggregated_results = metrics.Counter('probe_results_aggregated_total',
+                                     'Results uploaded only as part of an aggregate window')
+aggregate_windows = metrics.Counter('probe_aggregate_windows_total', 'Aggregate windows uploaded to the server')
+
+
+def aggregate_seconds(job):
+    """Window length of a job in aggregate mode, or None"""
+    if job.get('kuma_push_mode', 'probe') == 'server':
+        return None
+    return job.get('aggregate_seconds') or None
+
+
+def _checked_at(result):
+    """Unix time of the check (the uploader may see it later)"""
+    try:
+        return datetime.fromisoformat(result['timestamp']).replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class Window:
+    __slots__ = ('job_id', 'start', 'seconds', 'count', 'successes', 'latencies', 'packets_sent',
+                 'packets_received')
+
+    def __init__(self, job_id, start, seconds):
+        self.job_id = job_id
+        self.start = start
+        self.seconds = seconds
+        self.count = 0
+        self.successes = 0
+        self.latencies = []
+        self.packets_sent = None
+        self.packets_received = None
+
+    @property
+    def end(self):
+        return self.start + self.seconds
+
+    def add(self, result):
+        self.count += 1
+        if result['success']:
+            self.successes += 1
+            if result.get('response_time_ms') is not None:
+                self.latencies.append(float(result['response_time_ms']))
+        if result.get('packets_sent') is not None:
+            self.packets_sent = (self.packets_sent or 0) + result['packets_sent']
+            self.packets_received = (self.packets_received or 0) + (result.get('packets_received') or 0)
+
+    def payload(self):
+        latencies = sorted(self.latencies)
+        stats = {}
+        if latencies:
+            stats = {
+                'latency_min_ms': latencies[0],
+                'latency_avg_ms': round(sum(latencies) / len(latencies), 3),
+                'latency_max_ms': latencies[-1],
+                # Nearest rank
+                'latency_p95_ms': latencies[math.ceil(0.95 * len(latencies)) - 1],
+            }
+        return {
+            'job_id': self.job_id,
+            'window_start': datetime.fromtimestamp(self.start, timezone.utc).replace(tzinfo=None).isoformat(),
+            'window_seconds': self.seconds,
+            'count': self.count,
+            'successes': self.successes,
+            'packets_sent': self.packets_sent,
+            'packets_received': self.packets_received,
+            **stats,
+        }
+
+
+class Aggregator:
+    """Open windows of the jobs in aggregate mode; used by the uploader thread only"""
+
+    def __init__(self, flush_delay=FLUSH_DELAY):
+        self.flush_delay = flush_delay
+        self._windows = {}  # job id -> open Window
+        self._closed = []  # Windows ended by a later check, waiting for the next upload
+        self._failing = set()  # Jobs whose last check failed
+
+    def pending(self):
+        return bool(self._windows or self._closed)
+
+    def add(self, job, result):
+        """Count result in its job's window; returns whether the result itself must still be uploaded"""
+        seconds = aggregate_seconds(job)
+        job_id = job['id']
+        window = self._windows.get(job_id)
+        if seconds is None:
+            if window is not None:
+                # Modo agregado desligado: fecha a janela aberta
+                self._closed.append(self._windows.pop(job_id))
+            self._failing.discard(job_id)
+            return True
+
+        checked_at = _checked_at(result)
+        if window is not None and (checked_at >= window.end or window.seconds != seconds):
+            self._closed.append(window)
+            window = None
+        if window is None:
+            window = self._windows[job_id] = Window(job_id, checked_at, seconds)
+        window.add(result)
+
+        # Falhas e a recuperação que encerra cada sequência de falhas também vão como resultado
+        failed = not result['success']
+        recovered = not failed and job_id in self._failing
+        if failed:
+            self._failing.add(job_id)
+        else:
+            self._failing.discard(job_id)
+        if failed or recovered:
+            result['aggregated'] = True
+            return True
+        aggregated_results.inc()
+        return False
+
+    def due(self, now=None, flush=False):
+        """Payloads of the windows ready for upload (all of them with flush)"""
+        now = time.time() if now is None else now
+        ready, self._closed = self._closed, []
+        for job_id, window in list(self._windows.items()):
+            if flush or now >= window.end + self.flush_delay:
+                ready.append(self._windows.pop(job_id))
+        aggregate_windows.inc(amount=len(ready))
+        return [window.payload() for window in ready]
@@ -0,0 +1,168 @@
+"""Resolver cache of the probe.
+
+Check targets and the Kuma/server hosts are resolved through one cache
+instead of a system lookup per ping and per upload:
+
+* answers are kept for ``DNS_CACHE_TTL`` seconds (default 60) and failures
+  for ``DNS_NEGATIVE_TTL`` seconds (default 10);
+* a hit in the last ``DNS_PREFETCH_FRACTION`` of the TTL (default 0.2)
+  refreshes the entry in the background, so busy names never expire on the
+  check path;
+* if a refresh fails, the previous answer keeps being served for up to
+  ``DNS_STALE_SECONDS`` (default 300), so a resolver hiccup does not turn
+  into false "down" results;
+* at most ``DNS_CACHE_SIZE`` names are kept (default 1024, least recently
+  used evicted first).
+
+``getaddrinfo`` does not return record TTLs, so the TTLs are configured
+rather than taken from the answers. ``install_requests_hook`` routes new
+``requests`` connections through the cache (TLS still uses the hostname).
+"""
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import probe_metrics as metrics
+
+logger = logging.getLogger('uptime-probe')
+
+lookups = metrics.Counter('probe_dns_lookups_total', 'Name lookups by outcome (hit, miss, negative, stale, error)',
+                          ('outcome',))
+resolve_duration = metrics.Histogram('probe_dns_resolve_seconds', 'Time spent resolving names, by cache outcome',
+                                     ('outcome',))
+
+
+class DNSCache:
+    def __init__(self, ttl=None, negative_ttl=None, stale=None, size=None, prefetch_fraction=None):
+        self.ttl = float(ttl or os.environ.get('DNS_CACHE_TTL', 60))
+        self.negative_ttl = float(negative_ttl or os.environ.get('DNS_NEGATIVE_TTL', 10))
+        self.stale = float(stale if stale is not None else os.environ.get('DNS_STALE_SECONDS', 300))
+        self.size = int(size or os.environ.get('DNS_CACHE_SIZE', 1024))
+        self.prefetch_fraction = float(prefetch_fraction if prefetch_fraction is not None
+                                       else os.environ.get('DNS_PREFETCH_FRACTION', 0.2))
+        # host -> [addresses or None, error, expires_at, stale_until]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='dns-prefetch')
+        metrics.Gauge('probe_dns_cache_entries', 'Names in the resolver cache', lambda: len(self._entries))
+
+    @staticmethod
+    def _system_lookup(host):
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        # Ordem do resolvedor, sem repetições
+        return list(dict.fromkeys(info[4][0] for info in infos))
+
+    def _store(self, host, addresses, error, now):
+        with self._lock:
+            previous = self._entries.get(host)
+            if addresses is None and previous is not None and previous[0] is not None and now < previous[3]:
+                # Falha ao renovar: mantém a resposta anterior até o limite de "stale"
+                lookups.inc('stale')
+                logger.warning(f"Could not refresh {host} ({error}), serving the previous answer")
+                entry = [previous[0], None, now + self.negative_ttl, previous[3]]
+            elif addresses is None:
+                entry = [None, error, now + self.negative_ttl, now + self.negative_ttl]
+            else:
+                entry = [addresses, None, now + self.ttl, now + self.ttl + self.stale]
+            self._entries[host] = entry
+            self._entries.move_to_end(host)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _lookup(self, host):
+        try:
+            addresses, error = self._system_lookup(host), None
+        except OSError as e:
+            addresses, error = None, str(e)
+        return self._store(host, addresses, error, time.monotonic())
+
+    def _refresh(self, host):
+        try:
+            self._lookup(host)
+        finally:
+            with self._lock:
+                self._refreshing.discard(host)
+
+    def cached(self, host):
+        """Cached entry for host (None on a miss); schedules a prefetch near expiry"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None or now >= entry[2]:
+                return None
+            self._entries.move_to_end(host)
+            prefetch = (entry[0] is not None and host not in self._refreshing
+                        and entry[2] - now < self.ttl * self.prefetch_fraction)
+            if prefetch:
+                self._refreshing.add(host)
+        if prefetch:
+            self._executor.submit(self._refresh, host)
+        return entry
+
+    def _answer(self, host, entry, outcome, started):
+        elapsed = time.perf_counter() - started
+        if entry[0] is None:
+            outcome = 'negative' if outcome == 'hit' else 'error'
+        lookups.inc(outcome)
+        resolve_duration.observe(elapsed, outcome)
+        if entry[0] is None:
+            raise socket.gaierror(f"Could not resolve {host}: {entry[1]}")
+        return entry[0], elapsed
+
+    def resolve(self, host):
+        """(addresses, seconds spent) for host; raises socket.gaierror if it does not resolve"""
+        started = time.perf_counter()
+        if _is_ip(host):
+            return [host], 0.0
+        entry = self.cached(host)
+        if entry is not None:
+            return self._answer(host, entry, 'hit', started)
+        return self._answer(host, self._lookup(host), 'miss', started)
+
+    async def resolve_async(self, host):
+        """resolve() for the event loop: misses are looked up in a worker thread"""
+        started = time.perf_counter()
+        if _is_ip(host):
+            return [host], 0.0
+        entry = self.cached(host)
+        if entry is not None:
+            return self._answer(host, entry, 'hit', started)
+        entry = await asyncio.to_thread(self._lookup, host)
+        return self._answer(host, entry, 'miss', started)
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def install_requests_hook(cache):
+    """Make new urllib3 (requests) connections resolve through cache"""
+    from urllib3.util import connection
+
+    original = connection.create_connection
+
+    def create_connection(address, *args, **kwargs):
+        host, port = address
+        # socket.gaierror (também do cache negativo) vira o erro de resolução habitual do urllib3
+        addresses, _ = cache.resolve(host)
+        error = None
+        for ip in addresses:
+            try:
+                return original((ip, port), *args, **kwargs)
+            except OSError as e:
+                error = e
+        raise error
+
+    connection.create_connection = create_connection
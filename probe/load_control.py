@@ -0,0 +1,193 @@
+"""Capacity measurement and load shedding for the probe.
+
+The probe runs at most ``MAX_CONCURRENT_CHECKS`` checks at a time (and at most
+``MAX_SUBPROCESSES`` check subprocesses and ``MAX_OPEN_FDS`` descriptors). Only
+ping checks run a subprocess; TCP and HTTP checks just hold a socket. The
+cost of every job is measured continuously (EWMA of its wall time), so the
+controller knows how many check slots the configured jobs need:
+
+    utilization = max(sum(cost / interval) / MAX_CONCURRENT_CHECKS,
+                      sum(cost / interval of ping jobs) / ping slots)
+
+Above ``OVERLOAD_TARGET_UTILIZATION`` (default 0.9) the probe is saturated and
+``OVERLOAD_POLICY`` decides what gives:
+
+* ``stretch`` (default): every interval is multiplied by the same factor, so
+  all jobs keep running, proportionally less often;
+* ``skip``: jobs are kept in priority order (``priority`` from the server,
+  higher first, then by id) while they fit and the rest are not run at all.
+
+Overload (shedding active, or due checks starting more than
+``OVERLOAD_LAG_SECONDS`` late) is reported to the server in the heartbeat.
+"""
+import logging
+import os
+import resource
+
+import probe_metrics as metrics
+
+logger = logging.getLogger('uptime-probe')
+
+POLICIES = ('stretch', 'skip')
+# Custo assumido para jobs ainda não medidos (segundos por check)
+DEFAULT_CHECK_COST = 1.0
+COST_ALPHA = 0.3
+
+
+def _default_max_fds():
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return int(soft * 0.8) if soft != resource.RLIM_INFINITY else 65536
+
+
+def uses_subprocess(job):
+    """Whether the job's checks run a subprocess (ping) instead of only a socket (tcp, http)"""
+    return (job.get('job_type') or 'ping') == 'ping'
+
+
+def fd_count():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def _lag_p95():
+    lags = sorted(metrics.schedule_lag.recent_values())
+    return lags[int(0.95 * (len(lags) - 1))] if lags else None
+
+
+utilization_gauge = metrics.Gauge('probe_utilization', 'Check slots needed by the configured jobs / slots available')
+capacity_gauge = metrics.Gauge('probe_capacity_checks_per_second',
+                               'Checks per second the probe can sustain with the current job mix')
+demand_gauge = metrics.Gauge('probe_demand_checks_per_second', 'Checks per second the configured intervals ask for')
+stretch_gauge = metrics.Gauge('probe_interval_stretch_factor', 'Factor applied to job intervals (stretch policy)')
+skipped_gauge = metrics.Gauge('probe_skipped_jobs', 'Jobs not run because of overload (skip policy)')
+overloaded_gauge = metrics.Gauge('probe_overloaded', '1 while the probe is overloaded')
+admission_blocked = metrics.Counter('probe_admission_blocked_total',
+                                    'Due checks held back by a concurrency limit', ('limit',))
+
+
+class LoadController:
+    def __init__(self, max_checks=None, max_subprocesses=None, max_fds=None, policy=None,
+                 target_utilization=None, lag_threshold=None):
+        self.max_checks = max(1, int(max_checks or os.environ.get('MAX_CONCURRENT_CHECKS', 32)))
+        self.max_subprocesses = max(1, int(max_subprocesses or os.environ.get('MAX_SUBPROCESSES', self.max_checks)))
+        self.max_fds = int(max_fds or os.environ.get('MAX_OPEN_FDS', 0) or _default_max_fds())
+        self.policy = (policy or os.environ.get('OVERLOAD_POLICY', 'stretch')).lower()
+        if self.policy not in POLICIES:
+            logger.warning(f"Unknown OVERLOAD_POLICY {self.policy!r}, using 'stretch'")
+            self.policy = 'stretch'
+        self.target_utilization = float(target_utilization or os.environ.get('OVERLOAD_TARGET_UTILIZATION', 0.9))
+        self.lag_threshold = float(lag_threshold or os.environ.get('OVERLOAD_LAG_SECONDS', 10))
+
+        self._cost = {}
+        self.stretch = 1.0
+        self.skipped = set()
+        self.utilization = 0.0
+        self.demand = 0.0
+        self.capacity = None
+        self.overloaded = False
+        self.blocked = None  # Limite que barrou o último admit()
+        self._fds = 0
+        self._network_jobs = False
+
+    @property
+    def ping_slots(self):
+        # Cada check de ping usa um subprocesso
+        return min(self.max_checks, self.max_subprocesses)
+
+    @property
+    def slots(self):
+        return self.max_checks if self._network_jobs else self.ping_slots
+
+    def record(self, job_id, duration):
+        """Fold the wall time of a finished check into the job's cost"""
+        previous = self._cost.get(job_id)
+        self._cost[job_id] = duration if previous is None else previous + COST_ALPHA * (duration - previous)
+
+    def _default_cost(self):
+        return sum(self._cost.values()) / len(self._cost) if self._cost else DEFAULT_CHECK_COST
+
+    def ordered(self, jobs):
+        """Jobs in shedding order: highest priority first, then by id"""
+        return sorted(jobs, key=lambda job: (-int(job.get('priority') or 0), job['id']))
+
+    def update(self, jobs):
+        """Recompute utilization and the shedding decision for the current job set"""
+        ordered = self.ordered(jobs)
+        # Jobs removidos deixam de contar; jobs novos assumem o custo médio medido
+        self._cost = {job['id']: self._cost[job['id']] for job in ordered if job['id'] in self._cost}
+        default = self._default_cost()
+        busy = [self._cost.get(job['id'], default) / max(job['interval_seconds'], 1) for job in ordered]
+        pings = [uses_subprocess(job) for job in ordered]
+        self._network_jobs = not all(pings)
+        self.demand = sum(1.0 / max(job['interval_seconds'], 1) for job in ordered)
+        ping_busy = sum(load for load, ping in zip(busy, pings) if ping)
+        self.utilization = max(sum(busy) / self.max_checks, ping_busy / self.ping_slots)
+        self.capacity = self.demand / self.utilization if self.utilization else None
+        budget = self.target_utilization * self.max_checks
+        ping_budget = self.target_utilization * self.ping_slots
+
+        stretch, skipped = 1.0, set()
+        if self.utilization > self.target_utilization:
+            if self.policy == 'stretch':
+                stretch = self.utilization / self.target_utilization
+            else:
+                used = used_ping = 0.0
+                for job, load, ping in zip(ordered, busy, pings):
+                    if used + load > budget or (ping and used_ping + load > ping_budget):
+                        skipped.add(job['id'])
+                    else:
+                        used += load
+                        used_ping += load if ping else 0.0
+        shedding = stretch > 1.0 or bool(skipped)
+        if shedding != (self.stretch > 1.0 or bool(self.skipped)):
+            if shedding:
+                logger.warning(f"Probe overloaded: utilization {self.utilization:.2f} of {self.slots} slots, "
+                               f"policy {self.policy} (stretch {stretch:.2f}x, {len(skipped)} jobs skipped)")
+            else:
+                logger.info(f"Probe load back to normal: utilization {self.utilization:.2f}")
+        self.stretch, self.skipped = stretch, skipped
+
+        self.overloaded = shedding or (_lag_p95() or 0.0) > self.lag_threshold
+        self._fds = fd_count() or 0
+
+        utilization_gauge.set(self.utilization)
+        capacity_gauge.set(self.capacity or 0)
+        demand_gauge.set(self.demand)
+        stretch_gauge.set(self.stretch)
+        skipped_gauge.set(len(self.skipped))
+        overloaded_gauge.set(1 if self.overloaded else 0)
+
+    def interval(self, job):
+        return job['interval_seconds'] * self.stretch
+
+    def admit(self, running, job):
+        """Whether job's check can start now (running = checks in flight); sets blocked to the limit hit"""
+        if running >= self.max_checks:
+            self.blocked = 'checks'
+        elif uses_subprocess(job) and metrics.subprocesses.get() >= self.max_subprocesses:
+            self.blocked = 'subprocesses'
+        # Contagem lida a cada update (não a cada check: listar /proc/self/fd custa O(fds))
+        elif self._fds >= self.max_fds:
+            self.blocked = 'fds'
+        else:
+            self.blocked = None
+            return True
+        admission_blocked.inc(self.blocked)
+        return False
+
+    def report(self):
+        """Load section of the heartbeat"""
+        lag_p95 = _lag_p95()
+        return {
+            'overloaded': self.overloaded,
+            'policy': self.policy,
+            'utilization': round(self.utilization, 4),
+            'capacity': None if self.capacity is None else round(self.capacity, 4),
+            'demand': round(self.demand, 4),
+            'slots': self.slots,
+            'stretch_factor': round(self.stretch, 3),
+            'skipped_jobs': len(self.skipped),
+            'schedule_lag_p95': None if lag_p95 is None else round(lag_p95, 3),
+        }
@@ -0,0 +1,351 @@
+"""TCP-connect and HTTP(S) check engines of the probe.
+
+Both run on the probe's event loop with asyncio streams, so a check costs a
+socket and a coroutine instead of a ping subprocess:
+
+* ``tcp``: up when ``target_host:port`` accepts the connection;
+* ``http``: sends ``GET`` or ``HEAD`` to the URL in ``target_host`` and is up
+  when the status is in the job's ``expected_status`` ranges (default
+  ``200-399``; redirects are not followed).
+
+The job's retries are attempts within one ``timeout_seconds`` deadline, the
+check stops at the first success (like the ``first_reply`` ping mode). Names
+resolve through the probe's resolver cache, outside the check time. Every
+attempt is timed by phase (connect, TLS, first byte) and the phases are
+exported as ``probe_check_phase_seconds``.
+
+TLS contexts (CA bundle loaded once) are shared by all checks. Reusing HTTP
+connections is off by default because a check on a reused connection skips
+connect and TLS, so it no longer proves new connections are accepted;
+``HTTP_KEEPALIVE_SECONDS`` keeps one idle connection per target for that many
+seconds. Only responses read to the end (``Content-Length`` or chunked, up to
+``HTTP_MAX_BODY`` bytes) leave their connection reusable.
+"""
+import asyncio
+import base64
+import logging
+import os
+import ssl
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import probe_metrics as metrics
+
+logger = logging.getLogger('uptime-probe')
+
+# Seconds between failed attempts of the same check
+RETRY_DELAY = float(os.environ.get('CHECK_RETRY_DELAY', 0.5))
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_SECONDS', 0))
+HTTP_MAX_BODY = int(os.environ.get('HTTP_MAX_BODY', 1024 * 1024))
+USER_AGENT = os.environ.get('HTTP_USER_AGENT', 'uptime-probe')
+DEFAULT_EXPECTED_STATUS = '200-399'
+MAX_HEADERS = 100
+
+phase_duration = metrics.Histogram('probe_check_phase_seconds',
+                                   'Time spent in each phase of TCP and HTTP checks (connect, tls, first_byte)',
+                                   ('engine', 'phase'))
+connections_reused = metrics.Counter('probe_http_connections_reused_total',
+                                     'HTTP checks sent on a kept-alive connection')
+
+_tls_contexts = {}
+# (scheme, host, port, address, verify_tls) -> (reader, writer, idle since); oldest first
+_idle = OrderedDict()
+
+
+class CheckError(Exception):
+    """Attempt failed for a reason worth reporting as is (status, protocol)"""
+
+
+def tls_context(verify):
+    """Shared client TLS context (building one loads the CA bundle)"""
+    context = _tls_contexts.get(verify)
+    if context is None:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        _tls_contexts[verify] = context
+    return context
+
+
+@lru_cache(maxsize=256)
+def status_ranges(expected):
+    """'200-299,301' -> ((200, 299), (301, 301))"""
+    ranges = []
+    for part in (expected or DEFAULT_EXPECTED_STATUS).replace(' ', '').split(','):
+        low, _, high = part.partition('-')
+        ranges.append((int(low), int(high or low)))
+    return tuple(ranges)
+
+
+def status_expected(status, expected):
+    return any(low <= status <= high for low, high in status_ranges(expected))
+
+
+def _error_text(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return 'Timed out'
+    if isinstance(error, ssl.SSLCertVerificationError):
+        return f"TLS certificate error: {error.verify_message}"
+    return str(error) or type(error).__name__
+
+
+def _close(writer):
+    try:
+        writer.close()
+    except Exception:
+        pass
+
+
+def _result(job, success, attempts, response_ms, duration, resolve_seconds, error, output, **extra):
+    """Result in the shape of the ping results (attempts count as packets)"""
+    rtt = round(response_ms, 2) if success else 0
+    return dict({
+        "timestamp": datetime.utcnow().isoformat(),
+        "job_id": job['id'],
+        "target_host": job['target_host'],
+        "success": success,
+        "duration_ms": round(duration * 1000, 2),
+        "resolve_ms": round(resolve_seconds * 1000, 2),
+        "packets_sent": attempts,
+        "packets_received": 1 if success else 0,
+        "packet_loss": 100.0 if not attempts else round(100 * (1 - (1 if success else 0) / attempts), 2),
+        "min_rtt": rtt,
+        "avg_rtt": rtt,
+        "max_rtt": rtt,
+        "response_time_ms": rtt,
+        "error_message": None if success else error,
+        "output": output,
+    }, **extra)
+
+
+async def _attempts(job, attempt):
+    """Runs attempt() until it succeeds, retries run out or the deadline passes
+
+    Returns (success, attempts made, value of the successful attempt or last error).
+    """
+    count = max(1, job.get('retries', 3))
+    deadline = time.perf_counter() + job.get('timeout_seconds', 10)
+    error = None
+    made = 0
+    for made in range(1, count + 1):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            made -= 1
+            break
+        try:
+            return True, made, await asyncio.wait_for(attempt(), remaining)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, CheckError, ValueError) as e:
+            error = e
+            logger.debug(f"Attempt {made} of job {job['id']} failed: {_error_text(e)}")
+        if made < count:
+            await asyncio.sleep(max(0.0, min(RETRY_DELAY, deadline - time.perf_counter())))
+    return False, made, error or asyncio.TimeoutError()
+
+
+async def execute_tcp(job, resolver):
+    """TCP-connect check of target_host:port"""
+    host, port = job['target_host'], job.get('port')
+    logger.info(f"Running TCP check to {host}:{port}")
+    resolve_seconds = 0.0
+    started = time.perf_counter()
+    try:
+        addresses, resolve_seconds = await resolver.resolve_async(host)
+        address = addresses[0]
+        started = time.perf_counter()
+
+        async def connect():
+            connect_started = time.perf_counter()
+            _, writer = await asyncio.open_connection(address, port)
+            elapsed = time.perf_counter() - connect_started
+            _close(writer)
+            phase_duration.observe(elapsed, 'tcp', 'connect')
+            return elapsed
+
+        success, attempts, outcome = await _attempts(job, connect)
+        duration = time.perf_counter() - started
+        connect_ms = outcome * 1000 if success else 0
+        logger.info(f"TCP result: success={success}, connect={connect_ms:.2f}ms, attempts={attempts}")
+        return _result(job, success, attempts, connect_ms, duration, resolve_seconds,
+                       None if success else _error_text(outcome),
+                       f"Connected to {address}:{port}" if success else "",
+                       connect_ms=round(connect_ms, 2))
+    except Exception as e:
+        logger.error(f"Error executing TCP check to {host}:{port}: {str(e)}")
+        return _result(job, False, 0, 0, time.perf_counter() - started, resolve_seconds, _error_text(e), "")
+
+
+def _take_idle(key):
+    entry = _idle.pop(key, None)
+    if entry is None:
+        return None
+    reader, writer, idle_since = entry
+    if time.monotonic() - idle_since >= HTTP_KEEPALIVE_SECONDS or writer.is_closing() or reader.at_eof():
+        _close(writer)
+        return None
+    return reader, writer
+
+
+def _put_idle(key, reader, writer):
+    now = time.monotonic()
+    previous = _idle.pop(key, None)
+    if previous is not None:
+        _close(previous[1])
+    _idle[key] = (reader, writer, now)
+    # Mais antigas primeiro: as expiradas saem sem varrer o pool inteiro
+    while _idle:
+        oldest_key, (_, oldest_writer, idle_since) = next(iter(_idle.items()))
+        if now - idle_since < HTTP_KEEPALIVE_SECONDS:
+            break
+        del _idle[oldest_key]
+        _close(oldest_writer)
+
+
+def close_idle():
+    """Close the kept-alive connections (shutdown)"""
+    while _idle:
+        _, (_, writer, _) = _idle.popitem()
+        _close(writer)
+
+
+async def _read_body(reader, headers):
+    """Reads the response body; False when it cannot be read to the end (connection not reusable)"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+            total += size
+            if total > HTTP_MAX_BODY:
+                return False
+            if size == 0:
+                # Trailers até a linha vazia
+                while (await reader.readline()).strip():
+                    pass
+                return True
+            await reader.readexactly(size + 2)
+    length = headers.get('content-length')
+    if length is None or not length.isdigit() or int(length) > HTTP_MAX_BODY:
+        return False
+    await reader.readexactly(int(length))
+    return True
+
+
+async def _http_exchange(reader, writer, request, method, timings):
+    """Sends request and reads the status line and headers; returns (status, status line, reusable)"""
+    sent = time.perf_counter()
+    writer.write(request)
+    await writer.drain()
+    status_line = await reader.readline()
+    timings['first_byte'] = time.perf_counter() - sent
+    if not status_line:
+        raise CheckError('Connection closed before the response')
+    parts = status_line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+        raise CheckError(f"Invalid HTTP status line: {status_line[:100]!r}")
+    status = int(parts[1])
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise CheckError('Too many response headers')
+    reusable = (HTTP_KEEPALIVE_SECONDS > 0 and parts[0] == 'HTTP/1.1'
+                and headers.get('connection', '').lower() != 'close')
+    if reusable and not (method == 'HEAD' or status in (204, 304) or 100 <= status < 200):
+        reusable = await _read_body(reader, headers)
+    return status, status_line.decode('latin-1').strip(), reusable
+
+
+async def execute_http(job, resolver):
+    """HTTP(S) check of the URL in target_host"""
+    url = job['target_host']
+    method = (job.get('http_method') or 'GET').upper()
+    expected = job.get('expected_status') or DEFAULT_EXPECTED_STATUS
+    verify = job.get('verify_tls', True) is not False
+    logger.info(f"Running HTTP check {method} {url}")
+    resolve_seconds = 0.0
+    started = time.perf_counter()
+    try:
+        parsed = urlsplit(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError(f"Not an http(s) URL: {url}")
+        host = parsed.hostname
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses, resolve_seconds = await resolver.resolve_async(host)
+        address = addresses[0]
+        started = time.perf_counter()
+
+        host_header = f"[{host}]" if ':' in host else host
+        if parsed.port:
+            host_header += f":{parsed.port}"
+        lines = [f"{method} {parsed.path or '/'}{'?' + parsed.query if parsed.query else ''} HTTP/1.1",
+                 f"Host: {host_header}", f"User-Agent: {USER_AGENT}", "Accept: */*",
+                 "Connection: keep-alive" if HTTP_KEEPALIVE_SECONDS > 0 else "Connection: close"]
+        if parsed.username:
+            credentials = f"{parsed.username}:{parsed.password or ''}".encode('utf-8')
+            lines.append(f"Authorization: Basic {base64.b64encode(credentials).decode('ascii')}")
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        key = (parsed.scheme, host, port, address, verify)
+
+        async def attempt():
+            timings = {}
+            idle = _take_idle(key) if HTTP_KEEPALIVE_SECONDS > 0 else None
+            if idle is not None:
+                try:
+                    status, status_line, reusable = await _http_exchange(*idle, request, method, timings)
+                    connections_reused.inc()
+                    return status, status_line, reusable, idle, timings
+                except (OSError, asyncio.IncompleteReadError, CheckError):
+                    # O servidor fechou a conexão ociosa: tenta de novo numa conexão nova
+                    _close(idle[1])
+                    timings = {}
+                except BaseException:
+                    _close(idle[1])
+                    raise
+            connect_started = time.perf_counter()
+            reader, writer = await asyncio.open_connection(address, port)
+            timings['connect'] = time.perf_counter() - connect_started
+            try:
+                if parsed.scheme == 'https':
+                    tls_started = time.perf_counter()
+                    await writer.start_tls(tls_context(verify), server_hostname=host)
+                    timings['tls'] = time.perf_counter() - tls_started
+                status, status_line, reusable = await _http_exchange(reader, writer, request, method, timings)
+            except BaseException:
+                _close(writer)
+                raise
+            return status, status_line, reusable, (reader, writer), timings
+
+        async def checked():
+            status, status_line, reusable, (reader, writer), timings = await attempt()
+            if reusable:
+                _put_idle(key, reader, writer)
+            else:
+                _close(writer)
+            for phase, seconds in timings.items():
+                phase_duration.observe(seconds, 'http', phase)
+            if not status_expected(status, expected):
+                raise CheckError(f"HTTP {status} not in {expected}")
+            return status, status_line, timings
+
+        success, attempts, outcome = await _attempts(job, checked)
+        duration = time.perf_counter() - started
+        if success:
+            status, status_line, timings = outcome
+            response_ms = sum(timings.values()) * 1000
+        else:
+            status, status_line, timings, response_ms = None, "", {}, 0
+        logger.info(f"HTTP result: success={success}, status={status}, response_time={response_ms:.2f}ms, "
+                    f"attempts={attempts}")
+        return _result(job, success, attempts, response_ms, duration, resolve_seconds,
+                       None if success else _error_text(outcome), status_line, status_code=status,
+                       **{f"{phase}_ms": round(seconds * 1000, 2) for phase, seconds in timings.items()})
+    except Exception as e:
+        logger.error(f"Error executing HTTP check to {url}: {str(e)}")
+        return _result(job, False, 0, 0, time.perf_counter() - started, resolve_seconds, _error_text(e), "")
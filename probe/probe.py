@@ -1,13 +1,26 @@
+import asyncio
+import math
 import os
+import re
 import time
 import signal
 import sys
 import logging
 import requests
 import subprocess
-import json
+import queue
+import threading
+from collections import deque
 from datetime import datetime
 
+import dns_cache
+import net_checks
+import probe_metrics as metrics
+import probe_state
+import sharding
+from aggregation import Aggregator
+from load_control import LoadController, uses_subprocess
+
 # Logger configuration
 logging.basicConfig(
     level=logging.DEBUG,  # Changed to DEBUG to see detailed logs
@@ -25,8 +38,36 @@ API_KEY = os.environ.get('API_KEY')
 SERVER_URL = os.environ.get('SERVER_URL', 'http://localhost:5001')
 FETCH_INTERVAL = int(os.environ.get('FETCH_INTERVAL', 300))  # 5 minutes by default
 HEARTBEAT_INTERVAL = int(os.environ.get('HEARTBEAT_INTERVAL', 60))  # 1 minute by default
+# Results waiting for upload (Kuma and server); the oldest are dropped when full
+UPLOAD_SPOOL_SIZE = int(os.environ.get('UPLOAD_SPOOL_SIZE', 10000))
+# Seconds to keep uploading spooled results after a termination signal
+UPLOAD_DRAIN_TIMEOUT = float(os.environ.get('UPLOAD_DRAIN_TIMEOUT', 10))
+# Results sent to the server per request (1: one request per result, for servers without batch uploads)
+UPLOAD_BATCH_SIZE = int(os.environ.get('UPLOAD_BATCH_SIZE', 100))
+# Worker processes running the checks (above 1: sharded mode, see sharding.py)
+PROBE_WORKERS = max(1, int(os.environ.get('PROBE_WORKERS', 1)))
+# Jobs with the same target and check parameters that come due within this many
+# seconds of each other share one check (0 disables the deduplication)
+CHECK_DEDUP_WINDOW = float(os.environ.get('CHECK_DEDUP_WINDOW', 5))
+# Job fields that define the check itself (jobs equal on all of them share checks)
+CHECK_FIELDS = ('job_type', 'target_host', 'port', 'http_method', 'expected_status', 'verify_tls',
+                'timeout_seconds', 'retries')
+
+# How ping checks send their echo requests:
+#   first_reply: retries requests PING_SPACING seconds apart, up on the first reply,
+#                one timeout for the whole check (default)
+#   sampled:     same spacing and timeout, but waits for every reply (full loss/RTT statistics)
+#   sequential:  one request per second, timeout applied to each one (previous behaviour)
+PING_MODE = os.environ.get('PING_MODE', 'first_reply').lower()
+PING_SPACING = float(os.environ.get('PING_SPACING', 0.2))
+# Seconds between checkpoints of the job list and schedule (see probe_state.py)
+STATE_INTERVAL = int(os.environ.get('PROBE_STATE_INTERVAL', 30))
 
 # Validate configs
+if PING_MODE not in ('first_reply', 'sampled', 'sequential'):
+    logger.warning(f"Unknown PING_MODE {PING_MODE!r}, using 'first_reply'")
+    PING_MODE = 'first_reply'
+
 if not API_KEY:
     logger.error("API_KEY not defined. Please set the API_KEY environment variable.")
     sys.exit(1)
@@ -34,6 +75,10 @@ if not API_KEY:
 # Initialize jobs
 jobs = []
 jobs_last_execution = {}  # Stores timestamp of last execution for each job
+config_version = None  # Version of the job list on the server
+
+# Resolver cache for check targets and for the Kuma/server hosts (see dns_cache.py)
+resolver = dns_cache.DNSCache()
 
 # Indicator for application termination
 running = True
@@ -49,12 +94,17 @@ signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 def fetch_jobs():
-    """Gets jobs from the server"""
+    """Gets jobs from the server
+
+    Returns (jobs, config_version), or None when the server could not be
+    reached (the probe then keeps running its current jobs).
+    """
     try:
         response = requests.get(f"{SERVER_URL}/api/probe/{API_KEY}/jobs")
         if response.status_code == 200:
             jobs_data = response.json()
             logger.info(f"Retrieved {jobs_data['jobs_count']} jobs from server")
+            metrics.last_fetch.set(time.time())
             
             # Adiciona logs detalhados para cada job recebido
             for job in jobs_data['jobs']:
@@ -64,20 +114,26 @@ def fetch_jobs():
                 else:
                     logger.warning(f"Job {job['id']} is missing kuma_url field")
             
-            return jobs_data['jobs']
+            return jobs_data['jobs'], jobs_data.get('config_version')
+        elif response.status_code == 401:
+            # Probe removido ou desativado no servidor: para de executar os jobs
+            logger.error(f"Error getting jobs: {response.status_code} - {response.text}")
+            return [], None
         else:
             logger.error(f"Error getting jobs: {response.status_code} - {response.text}")
-            return []
+            return None
     except Exception as e:
         logger.error(f"Error connecting to server: {str(e)}")
-        return []
+        return None
 
-def send_heartbeat():
-    """Sends heartbeat signal to the server"""
+def send_heartbeat(load=None):
+    """Sends heartbeat signal to the server, with the probe's load report"""
     try:
-        response = requests.post(f"{SERVER_URL}/api/probe/{API_KEY}/heartbeat")
+        response = requests.post(f"{SERVER_URL}/api/probe/{API_KEY}/heartbeat",
+                                 json={'load': load} if load is not None else None)
         if response.status_code == 200:
             logger.debug("Heartbeat sent successfully")
+            metrics.last_heartbeat.set(time.time())
             return True
         else:
             logger.error(f"Error sending heartbeat: {response.status_code} - {response.text}")
@@ -86,24 +142,67 @@ def send_heartbeat():
         logger.error(f"Error connecting to server for heartbeat: {str(e)}")
         return False
 
-def execute_ping(job):
+def ping_command(count, timeout, address):
+    """ping command line for PING_MODE and its overall deadline in seconds"""
+    if PING_MODE == 'sequential':
+        return ['ping', '-n', '-c', str(count), '-W', str(timeout), address], count * timeout
+    # Um único prazo para o check inteiro, que comporta o espaçamento entre os pacotes
+    deadline = max(timeout, math.ceil((count - 1) * PING_SPACING) + 1)
+    return ['ping', '-n', '-c', str(count), '-i', str(PING_SPACING), '-w', str(deadline), address], deadline
+
+async def run_ping_until_reply(command, deadline):
+    """Runs ping until its first echo reply; returns (exit_code, stdout, stderr)"""
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    lines = []
+    replied = False
+    
+    async def read_until_reply():
+        nonlocal replied
+        async for line in process.stdout:
+            lines.append(line)
+            if b'bytes from' in line and b'time=' in line:
+                replied = True
+                return
+    
+    try:
+        await asyncio.wait_for(read_until_reply(), deadline + 1)
+    except asyncio.TimeoutError:
+        pass
+    if process.returncode is None:
+        process.kill()
+    stderr = await process.stderr.read()
+    await process.wait()
+    return (0 if replied else process.returncode), b''.join(lines), stderr
+
+async def execute_ping(job):
     """Executes ping to the target host and returns results"""
     target_host = job['target_host']
     timeout = job.get('timeout_seconds', 10)
     count = max(1, job.get('retries', 3))  # Ensure count is at least 1
     
     logger.info(f"Running ping to {target_host}")
+    resolve_seconds = 0.0
     
     try:
-        command = ['ping', '-c', str(count), '-W', str(timeout), target_host]
+        # Resolução pelo cache, fora do tempo do check (-n: sem DNS reverso nas respostas)
+        addresses, resolve_seconds = await resolver.resolve_async(target_host)
+        command, deadline = ping_command(count, timeout, addresses[0])
         logger.debug(f"Ping command: {' '.join(command)}")
         
         # Start process
         start_time = time.time()
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            exit_code = process.returncode
+            metrics.subprocesses.inc()
+            try:
+                if PING_MODE == 'first_reply':
+                    exit_code, stdout, stderr = await run_ping_until_reply(command, deadline)
+                else:
+                    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE,
+                                                                   stderr=subprocess.PIPE)
+                    stdout, stderr = await process.communicate()
+                    exit_code = process.returncode
+            finally:
+                metrics.subprocesses.dec()
             end_time = time.time()
             
             # Parse the result
@@ -168,9 +267,10 @@ def execute_ping(job):
                     times = []
                     for line in response_lines:
                         logger.debug(f"Processing response line: {line}")
-                        time_part = line.split("time=")[1].split()[0]
-                        if "ms" in time_part:
-                            time_value = float(time_part.replace("ms", ""))
+                        # "time=0.05 ms" (iputils) ou "time=0.05ms"
+                        time_part = re.search(r'time=([\d.]+)\s*ms', line)
+                        if time_part:
+                            time_value = float(time_part.group(1))
                             times.append(time_value)
                             logger.debug(f"Extracted time: {time_value}ms")
                     
@@ -185,6 +285,11 @@ def execute_ping(job):
                 except Exception as e:
                     logger.warning(f"Error extracting times from response lines: {e}")
             
+            # Interrompido na primeira resposta: enviados = número de sequência dela
+            if PING_MODE == 'first_reply' and packets_received and "packets transmitted" not in output:
+                sequence = re.search(r'icmp_seq=(\d+)', output)
+                packets_sent = int(sequence.group(1)) if sequence else packets_received
+            
             # Determine response time to send to Kuma
             response_time = 0
             if success and avg_rtt > 0:
@@ -200,6 +305,7 @@ def execute_ping(job):
                 "target_host": target_host,
                 "success": success,
                 "duration_ms": round(duration_ms, 2),
+                "resolve_ms": round(resolve_seconds * 1000, 2),
                 "packets_sent": packets_sent,
                 "packets_received": packets_received,
                 "packet_loss": 100.0 if packets_sent == 0 else round(100 * (1 - packets_received / packets_sent), 2),
@@ -224,6 +330,7 @@ def execute_ping(job):
             "target_host": target_host,
             "success": False,
             "duration_ms": 0,
+            "resolve_ms": round(resolve_seconds * 1000, 2),
             "packets_sent": 0,
             "packets_received": 0,
             "packet_loss": 100.0,
@@ -235,26 +342,27 @@ def execute_ping(job):
             "output": ""
         }
 
-def send_result_to_server(job_id, result):
-    """Sends the result to the server using the modern API endpoint"""
-    # Get the job to know the Kuma URL
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    if not job:
-        logger.error(f"Job ID {job_id} not found in job list")
-        return
-    
-    # Format the result for the server
-    data = {
+def result_payload(job_id, result):
+    """Fields of a result stored by the server"""
+    return {
         "job_id": job_id,
+        "timestamp": result.get("timestamp"),
         "success": result["success"],
         "response_time_ms": result.get("response_time_ms"),
         "packets_sent": result.get("packets_sent"),
         "packets_received": result.get("packets_received"),
         "error_message": result.get("error_message"),
         "kuma_success": result.get("kuma_success", True),
-        "kuma_error": result.get("kuma_error")
+        "kuma_error": result.get("kuma_error"),
+        "aggregated": result.get("aggregated", False)
     }
+
+def send_result_to_server(job, result):
+    """Sends the result to the server using the modern API endpoint"""
+    job_id = job['id']
+    data = result_payload(job_id, result)
     
+    started = time.perf_counter()
     try:
         # Using the modern endpoint format: /api/probe/<api_key>/results
         response = requests.post(
@@ -264,14 +372,47 @@ def send_result_to_server(job_id, result):
         if response.status_code == 200:
             logger.debug(f"Result sent successfully to the server using modern endpoint: Job ID {job_id}")
         else:
+            metrics.upload_failures.inc('server')
             logger.error(f"Error sending result to server: {response.status_code} - {response.text}")
     except Exception as e:
+        metrics.upload_failures.inc('server')
         logger.error(f"Exception sending result to server: {str(e)}")
+    finally:
+        metrics.upload_duration.observe(time.perf_counter() - started, 'server')
+
+def send_results_to_server(batch, aggregates=()):
+    """Sends a batch of (job, result) and aggregate windows to the server in one request"""
+    data = {"results": [result_payload(job['id'], result) for job, result in batch]}
+    if aggregates:
+        data["aggregates"] = list(aggregates)
+    
+    started = time.perf_counter()
+    try:
+        response = requests.post(f"{SERVER_URL}/api/probe/{API_KEY}/results", json=data)
+        if response.status_code == 200:
+            body = response.json()
+            errors = (body.get('errors') or []) + (body.get('aggregate_errors') or [])
+            if errors:
+                # Resultados de jobs que mudaram de probe, por exemplo; o resto do lote foi gravado
+                metrics.upload_failures.inc('server', amount=len(errors))
+                logger.warning(f"Server rejected {len(errors)} of {len(batch) + len(aggregates)} "
+                               f"results and aggregates: {errors[:5]}")
+            else:
+                logger.debug(f"Batch of {len(batch)} results and {len(aggregates)} aggregates "
+                             f"sent successfully to the server")
+        else:
+            metrics.upload_failures.inc('server', amount=len(batch))
+            logger.error(f"Error sending {len(batch)} results to server: {response.status_code} - {response.text}")
+    except Exception as e:
+        metrics.upload_failures.inc('server', amount=len(batch))
+        logger.error(f"Exception sending {len(batch)} results to server: {str(e)}")
+    finally:
+        metrics.upload_duration.observe(time.perf_counter() - started, 'server')
 
-def send_ping_result_to_kuma(job_id, result):
-    """Sends the ping result to Uptime Kuma"""
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    if not job or not job.get('kuma_url'):
+def send_ping_result_to_kuma(job, result):
+    """Sends the check result to Uptime Kuma"""
+    job_id = job['id']
+    if not job.get('kuma_url'):
         logger.warning(f"Could not send result to Uptime Kuma: URL not configured for job {job_id}")
         result["kuma_success"] = False
         result["kuma_error"] = "Uptime Kuma URL not configured for this job"
@@ -296,6 +437,7 @@ def send_ping_result_to_kuma(job_id, result):
     
     logger.info(f"Sending to Kuma: {params} to URL: {kuma_url}")
     
+    started = time.perf_counter()
     try:
         # Using GET instead of POST
         response = requests.get(kuma_url, params=params, timeout=5)
@@ -306,67 +448,427 @@ def send_ping_result_to_kuma(job_id, result):
             result["kuma_success"] = True
             result["kuma_error"] = None
         else:
+            metrics.upload_failures.inc('kuma')
             logger.error(f"Error sending result to Uptime Kuma: {response.status_code} - {response.text}")
             result["kuma_success"] = False
             result["kuma_error"] = f"HTTP Error {response.status_code}: {response.text}"
     except Exception as e:
+        metrics.upload_failures.inc('kuma')
         logger.error(f"Exception sending result to Uptime Kuma: {str(e)}")
         result["kuma_success"] = False
         result["kuma_error"] = f"Connection error: {str(e)}"
+    finally:
+        metrics.upload_duration.observe(time.perf_counter() - started, 'kuma')
+
+class ResultUploader(threading.Thread):
+    """Uploads results (Kuma push, then server) in the background, in check order
+
+    Checks no longer wait on upload latency; while Kuma or the server is slow,
+    results queue in a bounded spool (UPLOAD_SPOOL_SIZE) and the oldest are
+    dropped once it is full. Results already waiting are sent to the server
+    together, up to UPLOAD_BATCH_SIZE per request. Results of jobs in
+    aggregate mode are summarized per window (see aggregation.py).
+    """
+
+    def __init__(self, max_size=UPLOAD_SPOOL_SIZE, batch_size=UPLOAD_BATCH_SIZE):
+        super().__init__(name='result-uploader', daemon=True)
+        self.max_size = max_size
+        self.batch_size = max(1, batch_size)
+        self._spool = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self.aggregator = Aggregator()
+
+    def submit(self, job, result):
+        with self._cond:
+            if len(self._spool) >= self.max_size:
+                self._spool.popleft()
+                metrics.spool_dropped.inc()
+            self._spool.append((job, result))
+            metrics.spool_depth.set(len(self._spool))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._spool and not self._closing:
+                    if self.aggregator.pending():
+                        # Acorda a cada segundo para enviar as janelas que terminaram
+                        self._cond.wait(1.0)
+                        break
+                    self._cond.wait()
+                batch = [self._spool.popleft() for _ in range(min(self.batch_size, len(self._spool)))]
+                closing = self._closing and not self._spool
+                metrics.spool_depth.set(len(self._spool))
+            uploads = []
+            for job, result in batch:
+                try:
+                    # Send to Uptime Kuma (in 'server' push mode the server dispatches it)
+                    if job.get('kuma_push_mode', 'probe') != 'server':
+                        send_ping_result_to_kuma(job, result)
+                    
+                    if not self.aggregator.add(job, result):
+                        continue
+                    if self.batch_size == 1:
+                        send_result_to_server(job, result)
+                    else:
+                        uploads.append((job, result))
+                except Exception as e:
+                    logger.error(f"Error uploading result of job {job['id']}: {str(e)}")
+            aggregates = self.aggregator.due(flush=closing)
+            if uploads or aggregates:
+                try:
+                    send_results_to_server(uploads, aggregates)
+                except Exception as e:
+                    logger.error(f"Error uploading a batch of {len(uploads)} results: {str(e)}")
+            if closing:
+                return
+
+    def close(self, timeout):
+        """Upload what is left (up to timeout seconds) and stop"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self.join(timeout)
+        if self.is_alive():
+            logger.warning(f"{len(self._spool)} results were not uploaded before shutdown")
 
-def check_job_execution_time(job):
-    """Checks if it's time to execute the job"""
+def check_job_execution_time(job, interval=None):
+    """Checks if it's time to execute the job (interval overrides the job's own)"""
     job_id = job['id']
     current_time = time.time()
     
     # If the job has never been executed or if the interval has passed
     if job_id not in jobs_last_execution or \
-       (current_time - jobs_last_execution[job_id]) >= job['interval_seconds']:
+       (current_time - jobs_last_execution[job_id]) >= (interval or job['interval_seconds']):
         return True
     
     return False
 
-def main():
-    global jobs
+def check_key(job):
+    """Jobs with the same key run the same check"""
+    return tuple(job.get(field) for field in CHECK_FIELDS)
+
+async def execute_check(job):
+    """Runs one check for job with the engine of its job_type; returns (result, duration)"""
+    started = time.time()
+    engine = job.get('job_type') or 'ping'
+    if engine == 'tcp':
+        result = await net_checks.execute_tcp(job, resolver)
+    elif engine == 'http':
+        result = await net_checks.execute_http(job, resolver)
+    else:
+        engine = 'ping'
+        result = await execute_ping(job)
+    duration = time.time() - started
+    metrics.check_duration.observe(duration, engine)
+    metrics.checks.inc(engine, 'up' if result['success'] else 'down')
+    return result, duration
+
+async def run_check(job, controller, uploader, check, shared=False):
+    """Waits for the job's check (its own or one shared with other jobs) and hands the result to the uploader"""
+    result, duration = await check
+    # Só o job que executou o check mede o custo; um resultado reaproveitado não diz nada sobre ele
+    if not shared:
+        controller.record(job['id'], duration)
+    
+    # Kuma push and server upload run in the uploader thread
+    uploader.submit(job, dict(result, job_id=job['id']))
+
+def shared_check(recent_checks, job, current_time):
+    """Check of another job with the same key that job can reuse, or None
+
+    A check is reused while it is running or until CHECK_DEDUP_WINDOW seconds
+    after it started.
+    """
+    if CHECK_DEDUP_WINDOW <= 0:
+        return None
+    entry = recent_checks.get(check_key(job))
+    if entry is None:
+        return None
+    started_at, check = entry
+    if not check.done() or current_time - started_at < CHECK_DEDUP_WINDOW:
+        return check
+    return None
+
+def _background(pending, name, func, *args):
+    """Runs a blocking server call in a thread unless the previous one is still running"""
+    task = pending.get(name)
+    if task is None or task.done():
+        pending[name] = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    return pending[name]
+
+def apply_fetch(fetched):
+    """Installs a job list returned by fetch_jobs (None keeps the current one)"""
+    global jobs, config_version
+    if fetched is None:
+        return
+    jobs, version = fetched
+    if version is not None and version != config_version:
+        logger.info(f"Job list at config version {version} ({len(jobs)} jobs)")
+    config_version = version
+    metrics.jobs_configured.set(len(jobs))
+
+def save_state(path, owner, snapshot):
+    try:
+        probe_state.save(path, owner, *snapshot)
+    except Exception as e:
+        logger.error(f"Could not save probe state to {path}: {str(e)}")
+
+def state_snapshot():
+    # Cópias: a gravação roda em outra thread enquanto o loop altera os dicionários
+    return list(jobs), config_version, dict(jobs_last_execution)
+
+def start_due_checks(controller, uploader, in_flight, recent_checks, running_checks, current_time):
+    """Starts the due checks of jobs, highest priority first, while there are free slots"""
+    # Checks encerrados fora da janela não são mais reaproveitados
+    for key, (started_at, check) in list(recent_checks.items()):
+        if check.done() and current_time - started_at >= CHECK_DEDUP_WINDOW:
+            del recent_checks[key]
+    
+    for job in controller.ordered(jobs):
+        if job['id'] in in_flight or job['id'] in controller.skipped:
+            continue
+        interval = controller.interval(job)
+        if not check_job_execution_time(job, interval):
+            continue
+        check = shared_check(recent_checks, job, current_time)
+        if check is None and not controller.admit(len(running_checks), job):
+            if uses_subprocess(job) and controller.blocked == 'subprocesses':
+                # Só o limite de subprocessos: checks TCP/HTTP ainda podem começar
+                continue
+            # Sem capacidade: os jobs restantes continuam vencidos e o atraso aparece no lag
+            break
+        # Atraso em relação ao horário previsto (jobs nunca executados não contam)
+        if job['id'] in jobs_last_execution:
+            due_at = jobs_last_execution[job['id']] + interval
+            metrics.schedule_lag.observe(max(0.0, time.time() - due_at))
+        
+        if check is None:
+            check = asyncio.ensure_future(execute_check(job))
+            recent_checks[check_key(job)] = (current_time, check)
+            running_checks.add(check)
+            check.add_done_callback(running_checks.discard)
+            task = asyncio.ensure_future(run_check(job, controller, uploader, check))
+        else:
+            # Mesmo alvo e parâmetros de um check recente: o resultado é replicado para este job
+            metrics.checks_coalesced.inc()
+            task = asyncio.ensure_future(run_check(job, controller, uploader, check, shared=True))
+        in_flight[job['id']] = task
+        task.add_done_callback(lambda done, job_id=job['id']: in_flight.pop(job_id, None))
+        
+        # Update timestamp of last execution
+        jobs_last_execution[job['id']] = current_time
+
+async def run():
+    global jobs, config_version
     last_fetch_time = 0
     last_heartbeat_time = 0
     
-    logger.info("===== Starting Uptime Probe =====")
-    logger.info(f"Connecting to server: {SERVER_URL}")
-    logger.info(f"Job update interval: {FETCH_INTERVAL} seconds")
-    logger.info(f"Heartbeat interval: {HEARTBEAT_INTERVAL} seconds")
+    state_path = probe_state.state_path()
+    state_owner = probe_state.owner_id(API_KEY, SERVER_URL)
+    state = probe_state.load(state_path, state_owner)
+    if state is not None:
+        # Retomada imediata: a lista é revalidada com o servidor em segundo plano
+        jobs, config_version, resumed = state
+        jobs_last_execution.update(resumed)
+        metrics.jobs_configured.set(len(jobs))
+        logger.info(f"Resumed {len(jobs)} jobs (config version {config_version}) from {state_path}")
+    last_state_time = time.time()
+    
+    metrics.start_server()
+    dns_cache.install_requests_hook(resolver)
+    controller = LoadController()
+    logger.info(f"Check slots: {controller.slots} (max {controller.max_checks} concurrent checks, "
+                f"{controller.max_subprocesses} subprocesses, {controller.max_fds} fds), "
+                f"overload policy: {controller.policy}")
+    uploader = ResultUploader()
+    uploader.start()
+    in_flight = {}  # job_id -> task of the running check
+    recent_checks = {}  # check key -> (start time, task) of the latest check, shared by identical jobs
+    running_checks = set()  # Checks em execução (jobs que compartilham um check não ocupam slot)
+    pending = {}  # Chamadas ao servidor em andamento (fetch, heartbeat)
     
     # Main loop
     while running:
         current_time = time.time()
         
         # Check if it's time to fetch jobs again
+        fetch = pending.get('fetch')
+        if fetch is not None and fetch.done():
+            apply_fetch(fetch.result())
+            pending.pop('fetch')
         if current_time - last_fetch_time >= FETCH_INTERVAL:
-            jobs = fetch_jobs()
+            _background(pending, 'fetch', fetch_jobs)
             last_fetch_time = current_time
+            if not jobs:
+                # Primeira carga: espera a lista antes de agendar
+                apply_fetch(await pending.pop('fetch'))
+        
+        controller.update(jobs)
         
         # Check if it's time to send heartbeat
         if current_time - last_heartbeat_time >= HEARTBEAT_INTERVAL:
-            send_heartbeat()
+            _background(pending, 'heartbeat', send_heartbeat, controller.report())
             last_heartbeat_time = current_time
         
-        # Process each job
-        for job in jobs:
-            if check_job_execution_time(job):
-                # Execute ping
-                result = execute_ping(job)
-                
-                # Send to Uptime Kuma
-                send_ping_result_to_kuma(job['id'], result)
-                
-                # Send result to server
-                send_result_to_server(job['id'], result)
-                
-                # Update timestamp of last execution
-                jobs_last_execution[job['id']] = current_time
+        if state_path and current_time - last_state_time >= STATE_INTERVAL:
+            _background(pending, 'state', save_state, state_path, state_owner, state_snapshot())
+            last_state_time = current_time
+        
+        start_due_checks(controller, uploader, in_flight, recent_checks, running_checks, current_time)
         
         # Small wait to not overload CPU
-        time.sleep(1)
+        await asyncio.sleep(1)
+    
+    # Checks em andamento terminam (no máximo timeout * tentativas) antes do último upload
+    if in_flight:
+        logger.info(f"Waiting for {len(in_flight)} running checks...")
+        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+    if state_path:
+        state_task = pending.get('state')
+        if state_task is not None:
+            await state_task
+        save_state(state_path, state_owner, state_snapshot())
+    net_checks.close_idle()
+    uploader.close(UPLOAD_DRAIN_TIMEOUT)
+
+class WorkerUploader:
+    """Uploader of a worker process: results go to the supervisor's shared uploader"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def submit(self, job, result):
+        self.connection.send(('result', job, result))
+
+def worker_status(index, controller):
+    # Só os jobs da partição atual: um job que mudou de worker é agendado pelo novo
+    schedule = {job['id']: jobs_last_execution[job['id']] for job in jobs if job['id'] in jobs_last_execution}
+    return 'status', index, controller.report(), schedule
+
+async def run_worker(index, count, control, results, schedule):
+    """Check loop of one worker process (sharded mode) over the jobs the supervisor assigns to it"""
+    global jobs, config_version
+    jobs_last_execution.update(schedule)
+    supervisor = os.getppid()
+    last_status_time = 0
+    
+    metrics.start_server(port=sharding.worker_metrics_port(index))
+    controller = LoadController(**sharding.shard_limits(count))
+    uploader = WorkerUploader(results)
+    in_flight = {}
+    recent_checks = {}
+    running_checks = set()
+    
+    while running:
+        current_time = time.time()
+        
+        # Só a atribuição mais recente importa
+        try:
+            while True:
+                config_version, jobs = control.get_nowait()
+                metrics.jobs_configured.set(len(jobs))
+        except queue.Empty:
+            pass
+        if os.getppid() != supervisor:
+            logger.error(f"Worker {index}: the supervisor is gone, stopping")
+            break
+        
+        controller.update(jobs)
+        if current_time - last_status_time >= sharding.STATUS_INTERVAL:
+            results.send(worker_status(index, controller))
+            last_status_time = current_time
+        
+        start_due_checks(controller, uploader, in_flight, recent_checks, running_checks, current_time)
+        
+        await asyncio.sleep(1)
+    
+    if in_flight:
+        logger.info(f"Worker {index}: waiting for {len(in_flight)} running checks...")
+        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+    net_checks.close_idle()
+    try:
+        results.send(worker_status(index, controller))
+    except OSError:
+        pass
+
+def worker_main(index, count, control, results, schedule):
+    """Entry point of the worker processes"""
+    try:
+        asyncio.run(run_worker(index, count, control, results, schedule))
+    except KeyboardInterrupt:
+        pass
+
+async def run_supervisor(count):
+    """Sharded mode: job list, heartbeat, state and uploads here, checks in count worker processes"""
+    global jobs, config_version
+    last_fetch_time = 0
+    last_heartbeat_time = 0
+    resumed = {}
+    
+    state_path = probe_state.state_path()
+    state_owner = probe_state.owner_id(API_KEY, SERVER_URL)
+    state = probe_state.load(state_path, state_owner)
+    if state is not None:
+        jobs, config_version, resumed = state
+        metrics.jobs_configured.set(len(jobs))
+        logger.info(f"Resumed {len(jobs)} jobs (config version {config_version}) from {state_path}")
+    last_state_time = time.time()
+    
+    metrics.start_server()
+    dns_cache.install_requests_hook(resolver)
+    uploader = ResultUploader()
+    uploader.start()
+    pool = sharding.WorkerPool(count, worker_main, uploader.submit, check_key)
+    pool.start(jobs, config_version, resumed)
+    pending = {}
+    
+    while running:
+        current_time = time.time()
+        
+        fetch = pending.get('fetch')
+        if fetch is not None and fetch.done():
+            apply_fetch(fetch.result())
+            pending.pop('fetch')
+            pool.assign(jobs, config_version)
+        if current_time - last_fetch_time >= FETCH_INTERVAL:
+            _background(pending, 'fetch', fetch_jobs)
+            last_fetch_time = current_time
+        
+        if current_time - last_heartbeat_time >= HEARTBEAT_INTERVAL:
+            _background(pending, 'heartbeat', send_heartbeat, pool.report())
+            last_heartbeat_time = current_time
+        
+        if state_path and current_time - last_state_time >= STATE_INTERVAL:
+            _background(pending, 'state', save_state, state_path, state_owner,
+                        (list(jobs), config_version, pool.last_execution()))
+            last_state_time = current_time
+        
+        pool.check()
+        
+        await asyncio.sleep(1)
+    
+    # Os workers terminam os checks em andamento antes do último upload
+    logger.info(f"Stopping {count} workers...")
+    await asyncio.to_thread(pool.stop)
+    if state_path:
+        state_task = pending.get('state')
+        if state_task is not None:
+            await state_task
+        save_state(state_path, state_owner, (list(jobs), config_version, pool.last_execution()))
+    uploader.close(UPLOAD_DRAIN_TIMEOUT)
+
+def main():
+    logger.info("===== Starting Uptime Probe =====")
+    logger.info(f"Connecting to server: {SERVER_URL}")
+    logger.info(f"Job update interval: {FETCH_INTERVAL} seconds")
+    logger.info(f"Heartbeat interval: {HEARTBEAT_INTERVAL} seconds")
+    if PROBE_WORKERS > 1:
+        logger.info(f"Sharded mode: {PROBE_WORKERS} worker processes")
+        asyncio.run(run_supervisor(PROBE_WORKERS))
+    else:
+        asyncio.run(run())
 
 if __name__ == "__main__":
     try:
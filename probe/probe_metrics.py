@@ -0,0 +1,273 @@
+"""Self-metrics of the probe, served over HTTP.
+
+``GET /metrics`` returns Prometheus text format and ``GET /health`` a JSON
+summary (checks per second, schedule lag, spool depth, last contact with the
+server) for quick sizing and troubleshooting. The server runs in a daemon
+thread on ``PROBE_METRICS_HOST:PROBE_METRICS_PORT`` (default ``0.0.0.0:9102``,
+port ``0`` disables it).
+
+Updates are a dict lookup and a few additions under a lock; process gauges
+(RSS, open sockets, file descriptors) are read from ``/proc`` only when the
+metrics are requested.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('uptime-probe')
+
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Janela usada pelos valores "recentes" do /health
+RECENT_WINDOW = 60
+
+_lock = threading.Lock()
+REGISTRY = {}
+STARTED_AT = time.time()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        REGISTRY[name] = self
+
+    def _label_text(self, label_values, extra=None):
+        pairs = list(zip(self.labels, label_values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        return [f'{self.name}{self._label_text(labels)} {_number(value)}'
+                for labels, value in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    """Value set by the probe, or computed by func at collection time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func
+
+    def set(self, value):
+        with _lock:
+            self.values[()] = value
+
+    def inc(self, amount=1):
+        with _lock:
+            self.values[()] = self.values.get((), 0) + amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def get(self):
+        if self.func is not None:
+            return self.func()
+        return self.values.get((), 0)
+
+    def render(self):
+        value = self.get()
+        return [] if value is None else [f'{self.name} {_number(value)}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.recent = deque(maxlen=20000)
+
+    def observe(self, value, *label_values):
+        with _lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # Contagens por bucket (não cumulativas), soma e contagem total
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+            self.recent.append((time.monotonic(), value))
+
+    def recent_values(self, window=RECENT_WINDOW):
+        since = time.monotonic() - window
+        with _lock:
+            return [value for at, value in self.recent if at >= since]
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{self._label_text(labels, ("le", repr(bound)))} {cumulative}')
+            lines.append(f'{self.name}_bucket{self._label_text(labels, ("le", "+Inf"))} {count}')
+            lines.append(f'{self.name}_sum{self._label_text(labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{self._label_text(labels)} {count}')
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(int(value)) if float(value).is_integer() else repr(round(value, 6))
+
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Fora do Linux: pico de memória (ru_maxrss em KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _fd_targets():
+    try:
+        names = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    targets = []
+    for name in names:
+        try:
+            targets.append(os.readlink(f'/proc/self/fd/{name}'))
+        except OSError:
+            pass
+    return targets
+
+
+def open_fds():
+    targets = _fd_targets()
+    return None if targets is None else len(targets)
+
+
+def open_sockets():
+    targets = _fd_targets()
+    return None if targets is None else sum(1 for target in targets if target.startswith('socket:'))
+
+
+checks = Counter('probe_checks_total', 'Checks executed, by engine and result', ('engine', 'result'))
+checks_coalesced = Counter('probe_checks_coalesced_total',
+                           'Due jobs served by the check of another job with the same target and parameters')
+check_duration = Histogram('probe_check_duration_seconds', 'Wall time of a check, by engine', ('engine',))
+schedule_lag = Histogram('probe_schedule_lag_seconds', 'How late due checks start', buckets=LAG_BUCKETS)
+upload_duration = Histogram('probe_upload_duration_seconds', 'Upload latency to Uptime Kuma and to the server',
+                            ('target',))
+upload_failures = Counter('probe_upload_failures_total', 'Failed uploads to Uptime Kuma and to the server',
+                          ('target',))
+spool_dropped = Counter('probe_spool_dropped_total', 'Results dropped because the upload spool was full')
+spool_depth = Gauge('probe_spool_depth', 'Results waiting to be uploaded')
+jobs_configured = Gauge('probe_jobs', 'Jobs currently assigned to the probe')
+subprocesses = Gauge('probe_subprocesses', 'Check subprocesses currently running')
+last_heartbeat = Gauge('probe_last_heartbeat_timestamp_seconds', 'Unix time of the last successful heartbeat')
+last_fetch = Gauge('probe_last_fetch_timestamp_seconds', 'Unix time of the last successful job list fetch')
+Gauge('probe_resident_memory_bytes', 'Resident set size of the probe process', resident_memory_bytes)
+Gauge('probe_open_fds', 'Open file descriptors', open_fds)
+Gauge('probe_open_sockets', 'Open sockets', open_sockets)
+Gauge('probe_start_time_seconds', 'Unix time the probe started', lambda: STARTED_AT)
+
+
+def render():
+    lines = []
+    for name, metric in list(REGISTRY.items()):
+        if metric.kind == 'gauge':
+            # Gauges calculados leem /proc: fora do lock
+            body = metric.render()
+        else:
+            with _lock:
+                body = metric.render()
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        lines.extend(body)
+    return '\n'.join(lines) + '\n'
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def health():
+    """Summary for GET /health"""
+    now = time.time()
+    durations = check_duration.recent_values()
+    lags = schedule_lag.recent_values()
+    heartbeat = last_heartbeat.get()
+    fetch = last_fetch.get()
+    return {
+        'uptime_seconds': round(now - STARTED_AT, 1),
+        'jobs': jobs_configured.get(),
+        'checks_per_second': round(len(durations) / min(RECENT_WINDOW, max(now - STARTED_AT, 1)), 3),
+        'schedule_lag_p95_seconds': _percentile(lags, 0.95),
+        'schedule_lag_max_seconds': max(lags) if lags else None,
+        'spool_depth': spool_depth.get(),
+        'subprocesses': subprocesses.get(),
+        'open_sockets': open_sockets(),
+        'rss_bytes': resident_memory_bytes(),
+        'seconds_since_heartbeat': round(now - heartbeat, 1) if heartbeat else None,
+        'seconds_since_fetch': round(now - fetch, 1) if fetch else None,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body, content_type = render().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/health':
+            body, content_type = json.dumps(health()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Sem log de acesso: scrapes frequentes poluiriam o log do probe
+        pass
+
+
+def start_server(host=None, port=None):
+    """Serve /metrics and /health in a daemon thread; returns the server or None"""
+    host = host if host is not None else os.environ.get('PROBE_METRICS_HOST', '0.0.0.0')
+    port = int(port if port is not None else os.environ.get('PROBE_METRICS_PORT', 9102))
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='probe-metrics', daemon=True).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port} (/metrics, /health)")
+    return server
@@ -0,0 +1,117 @@
+"""Local state of the probe, for warm restarts.
+
+The job list (with the server's ``config_version``) and the next due time of
+every job are checkpointed to ``PROBE_STATE_FILE`` (default
+``/var/lib/uptime-probe/state.json``, empty disables it) every
+``PROBE_STATE_INTERVAL`` seconds and at shutdown. Writes go to a temporary
+file in the same directory that is then renamed over the old one, so a crash
+never leaves a torn file.
+
+On start the probe resumes from the file right away and revalidates the job
+list with the server in the background. Jobs that came due while the probe was
+down are not all run at once: the schedule is shifted by the downtime (at most
+one interval per job), so the checks keep the spacing they had.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger('uptime-probe')
+
+STATE_FORMAT = 1
+
+
+def state_path():
+    return os.environ.get('PROBE_STATE_FILE', '/var/lib/uptime-probe/state.json')
+
+
+def owner_id(api_key, server_url):
+    # Um estado gravado com outra chave ou outro servidor não é reaproveitado
+    return hashlib.sha256(f'{server_url}\n{api_key}'.encode('utf-8')).hexdigest()[:16]
+
+
+def save(path, owner, jobs, config_version, last_execution):
+    """Atomically write the job list and the next due time of every job"""
+    by_id = {job['id']: job for job in jobs}
+    state = {
+        'format': STATE_FORMAT,
+        'owner': owner,
+        'saved_at': time.time(),
+        'config_version': config_version,
+        'jobs': jobs,
+        'next_due': {str(job_id): at + by_id[job_id]['interval_seconds']
+                     for job_id, at in last_execution.items() if job_id in by_id},
+    }
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.state-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    # Persiste a renomeação (entrada de diretório)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def resume_schedule(jobs, next_due, saved_at, now):
+    """job id -> last execution time that reproduces the saved schedule
+
+    A job that came due while the probe was down is delayed by the downtime
+    (at most one interval): it runs as long after the restart as it was due
+    after the checkpoint, so overdue checks keep their spacing instead of all
+    running at once.
+    """
+    last_execution = {}
+    for job in jobs:
+        due = next_due.get(str(job['id']))
+        if due is None:
+            continue
+        interval = job['interval_seconds']
+        if due < now:
+            due = now + min(max(due - saved_at, 0.0), interval)
+        last_execution[job['id']] = due - interval
+    return last_execution
+
+
+def load(path, owner, now=None):
+    """(jobs, config_version, last_execution) from the state file, or None"""
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable probe state {path}: {str(e)}")
+        return None
+    if not isinstance(state, dict) or state.get('format') != STATE_FORMAT or state.get('owner') != owner:
+        logger.warning(f"Ignoring probe state {path}: written by another version, probe or server")
+        return None
+    try:
+        jobs = state['jobs']
+        last_execution = resume_schedule(jobs, state['next_due'], state['saved_at'], now or time.time())
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Ignoring invalid probe state {path}: {str(e)}")
+        return None
+    return jobs, state.get('config_version'), last_execution
@@ -0,0 +1,219 @@
+"""Multi-process sharded mode of the probe.
+
+With ``PROBE_WORKERS`` above 1, ``probe.py`` runs as a supervisor plus that
+many worker processes, so parsing, scheduling and JSON work of very large job
+sets use several cores:
+
+* the supervisor fetches the job list, sends the heartbeat, saves the state
+  file and runs the shared uploader, which posts the results of every worker
+  to the server in batches;
+* jobs are partitioned by a stable hash (CRC32) of their check key, so a job
+  stays on the same worker across fetches and restarts and jobs that share a
+  check land on the same worker;
+* each worker runs the usual check loop on its partition, with
+  ``MAX_CONCURRENT_CHECKS`` and ``MAX_SUBPROCESSES`` divided among the
+  workers, and reports its load and schedule every
+  ``PROBE_WORKER_STATUS_INTERVAL`` seconds (default 5);
+* a worker that dies is restarted (at most every
+  ``PROBE_WORKER_RESTART_DELAY`` seconds, default 5) with its partition and
+  last reported schedule; the other workers are not touched;
+* on SIGTERM the supervisor forwards the signal, and the workers finish their
+  running checks (up to ``PROBE_WORKER_STOP_TIMEOUT`` seconds, default 30)
+  before the last results are uploaded.
+
+Worker ``i`` serves its own check metrics on ``PROBE_METRICS_PORT + 1 + i``.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+import zlib
+
+import probe_metrics as metrics
+
+logger = logging.getLogger('uptime-probe')
+
+STATUS_INTERVAL = float(os.environ.get('PROBE_WORKER_STATUS_INTERVAL', 5))
+RESTART_DELAY = float(os.environ.get('PROBE_WORKER_RESTART_DELAY', 5))
+STOP_TIMEOUT = float(os.environ.get('PROBE_WORKER_STOP_TIMEOUT', 30))
+
+worker_restarts = metrics.Counter('probe_worker_restarts_total', 'Worker processes restarted after dying',
+                                  ('worker',))
+
+
+def shard_of(key, count):
+    """Worker of a check key; stable across processes and restarts (unlike hash())"""
+    return zlib.crc32(repr(key).encode('utf-8')) % count
+
+
+def partition(jobs, count, key):
+    shards = [[] for _ in range(count)]
+    for job in jobs:
+        shards[shard_of(key(job), count)].append(job)
+    return shards
+
+
+def shard_limits(count):
+    """Concurrency limits of one worker: the probe-wide limits divided among the workers"""
+    max_checks = int(os.environ.get('MAX_CONCURRENT_CHECKS', 32))
+    max_subprocesses = int(os.environ.get('MAX_SUBPROCESSES', max_checks))
+    return {'max_checks': max(1, max_checks // count), 'max_subprocesses': max(1, max_subprocesses // count)}
+
+
+def worker_metrics_port(index):
+    port = int(os.environ.get('PROBE_METRICS_PORT', 9102))
+    return port + 1 + index if port else 0
+
+
+def combine_reports(reports):
+    """Heartbeat load section of the probe from its workers' reports (None without any)"""
+    reports = [report for report in reports if report]
+    if not reports:
+        return None
+
+    def known(key):
+        return [report[key] for report in reports if report.get(key) is not None]
+
+    slots = sum(report['slots'] for report in reports)
+    capacity, lags = known('capacity'), known('schedule_lag_p95')
+    return {
+        'overloaded': any(report['overloaded'] for report in reports),
+        'policy': reports[0]['policy'],
+        # Média ponderada pelos slots de cada worker
+        'utilization': round(sum(report['utilization'] * report['slots'] for report in reports) / slots, 4)
+        if slots else 0.0,
+        'capacity': round(sum(capacity), 4) if capacity else None,
+        'demand': round(sum(known('demand')), 4),
+        'slots': slots,
+        'stretch_factor': max(known('stretch_factor'), default=1.0),
+        'skipped_jobs': sum(known('skipped_jobs')),
+        'schedule_lag_p95': max(lags) if lags else None,
+    }
+
+
+class WorkerPool:
+    """Worker processes of the sharded mode, as seen from the supervisor
+
+    ``target(index, count, control, results, schedule)`` runs in each worker:
+    it reads ``(config_version, jobs)`` assignments from the ``control`` queue
+    and sends ``('result', job, result)`` and ``('status', index, load report,
+    schedule)`` messages on its ``results`` pipe. Results are handed to
+    ``on_result`` in a collector thread. Every worker has its own pipe, so a
+    worker killed mid-write cannot block the others.
+    """
+
+    def __init__(self, count, target, on_result, key):
+        self.count = count
+        self.target = target
+        self.on_result = on_result
+        self.key = key
+        # spawn: nada do supervisor (threads, locks, sockets) é herdado pelos workers
+        self._context = multiprocessing.get_context('spawn')
+        self.processes = [None] * count
+        self.controls = [None] * count
+        self.assigned = [None] * count  # Última (config_version, jobs) enviada a cada worker
+        self.schedules = [{} for _ in range(count)]  # job id -> última execução, do último status
+        self.reports = [None] * count
+        self._connections = {}  # Ponta de leitura do pipe -> índice do worker
+        self._started_at = [0.0] * count
+        self._stopping = False
+        self._collector = threading.Thread(target=self._collect, name='worker-results', daemon=True)
+        metrics.Gauge('probe_workers_alive', 'Worker processes running (sharded mode)',
+                      lambda: sum(1 for process in self.processes if process is not None and process.is_alive()))
+
+    def start(self, jobs, config_version, last_execution):
+        for index, shard in enumerate(partition(jobs, self.count, self.key)):
+            self.assigned[index] = (config_version, shard)
+            self.schedules[index] = {job['id']: last_execution[job['id']] for job in shard
+                                     if job['id'] in last_execution}
+            self._spawn(index)
+        self._collector.start()
+
+    def _spawn(self, index):
+        control = self._context.Queue()
+        control.put(self.assigned[index])
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=self.target, name=f'probe-worker-{index}',
+                                        args=(index, self.count, control, sender, dict(self.schedules[index])))
+        process.start()
+        # Só o worker fica com a ponta de escrita: a morte dele aparece como EOF
+        sender.close()
+        self.processes[index] = process
+        self.controls[index] = control
+        self._connections[receiver] = index
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Worker {index} started (pid {process.pid}, {len(self.assigned[index][1])} jobs)")
+
+    def assign(self, jobs, config_version):
+        """Send each worker its partition of a new job list (only workers whose partition changed)"""
+        for index, shard in enumerate(partition(jobs, self.count, self.key)):
+            changed = self.assigned[index][1] != shard
+            self.assigned[index] = (config_version, shard)
+            if changed:
+                self.controls[index].put(self.assigned[index])
+
+    def check(self):
+        """Restart dead workers with their partition and last reported schedule"""
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or now - self._started_at[index] < RESTART_DELAY:
+                continue
+            logger.error(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting it")
+            worker_restarts.inc(str(index))
+            self.reports[index] = None
+            self._spawn(index)
+
+    def _handle(self, message):
+        if message[0] == 'result':
+            self.on_result(message[1], message[2])
+        elif message[0] == 'status':
+            _, index, report, schedule = message
+            self.reports[index] = report
+            self.schedules[index] = schedule
+
+    def _collect(self):
+        while True:
+            connections = list(self._connections)
+            if self._stopping and not connections:
+                return
+            for connection in multiprocessing.connection.wait(connections, timeout=1):
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    # Worker encerrado e pipe esvaziado
+                    self._connections.pop(connection, None)
+                    connection.close()
+                    continue
+                try:
+                    self._handle(message)
+                except Exception as e:
+                    logger.error(f"Error handling worker message {message[0]}: {str(e)}")
+
+    def report(self):
+        return combine_reports(self.reports)
+
+    def last_execution(self):
+        merged = {}
+        for schedule in self.schedules:
+            merged.update(schedule)
+        return merged
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """SIGTERM to every worker, wait for their running checks, then collect what they sent"""
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop within {timeout}s, killing it")
+                process.kill()
+                process.join()
+        # O coletor termina quando os pipes de todos os workers chegam ao EOF
+        self._stopping = True
+        self._collector.join(timeout)
@@ -3,9 +3,11 @@ from datetime import datetime
 import json
 from flask import Blueprint, jsonify, request, current_app
 from flask_login import login_required
+from flask_limiter.util import get_remote_address
 from sqlalchemy import text
 from app import db, limiter
-from models import Probe, Job, JobResult, ProbeLog
+from models import Probe, Job, JobResult, ProbeLog, to_epoch_us
+from utils import job_health, metrics, probe_ingest
 
 api_blueprint = Blueprint('api', __name__)
 
@@ -16,8 +18,29 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s -
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+# Chaves de API já resolvidas (com TTL), para não consultar o banco a cada requisição limitada
+probe_cache = probe_ingest.ProbeCache()
+
+def probe_rate_limit_key():
+    """Rate limit probe endpoints per API key of an active probe, else per remote address"""
+    api_key = (request.view_args or {}).get('api_key')
+    if not api_key:
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            api_key = auth_header.split(' ', 1)[1]
+    if not api_key:
+        return get_remote_address()
+    hit, info = probe_cache.peek(api_key)
+    if not hit:
+        with db.engine.connect() as conn:
+            info = probe_cache.get(conn, api_key)
+    # Chaves inválidas ou de probes inativos não ganham um limite próprio cada uma
+    if info is None:
+        return get_remote_address()
+    return f"probe:{api_key}"
+
 @api_blueprint.route('/api/probe/<api_key>/jobs', methods=['GET'])
-@limiter.limit("10 per minute")
+@limiter.limit("10 per minute", key_func=probe_rate_limit_key)
 def get_probe_jobs(api_key):
     """Endpoint for probes to obtain their configured jobs"""
     # Register probe connection
@@ -60,22 +83,30 @@ def get_probe_jobs(api_key):
         'name': job.name,
         'job_type': job.job_type,
         'target_host': job.target_host,
+        'port': job.port,
+        'http_method': job.http_method,
+        'expected_status': job.expected_status,
+        'verify_tls': job.verify_tls,
         'kuma_url': job.kuma_url,
         'interval_seconds': job.interval_seconds,
         'timeout_seconds': job.timeout_seconds,
-        'retries': job.retries
+        'retries': job.retries,
+        'priority': job.priority,
+        'aggregate_seconds': job.aggregate_seconds,
+        'kuma_push_mode': probe.kuma_push_mode
     } for job in jobs]
     
     return jsonify({
         'status': 'success',
         'probe_id': probe.id,
         'probe_name': probe.name,
+        'config_version': probe.config_version,
         'jobs': jobs_data,
         'jobs_count': len(jobs_data)  # Adicionar a contagem de jobs que o probe espera
     })
 
 @api_blueprint.route('/api/probe/<api_key>/heartbeat', methods=['POST'])
-@limiter.limit("30 per minute")
+@limiter.limit("30 per minute", key_func=probe_rate_limit_key)
 def probe_heartbeat(api_key):
     """Endpoint for probes to send heartbeat signals"""
     # Verificar se o probe existe e é ativo
@@ -94,12 +125,18 @@ def probe_heartbeat(api_key):
         # Atualizar o último acesso do probe
         probe.last_seen = datetime.utcnow()
         
+        # Relatório de carga do probe (capacidade, sobrecarga), quando enviado
+        load = probe_ingest.load_report(request.get_json(silent=True), probe.last_seen)
+        if load:
+            for column, value in load.items():
+                setattr(probe, column, value)
+        
         # Registrar o log no banco de dados
         log = ProbeLog(
             probe_id=probe.id,
             action='heartbeat',
             ip_address=client_ip,
-            details=f"Heartbeat received"
+            details=probe_ingest.heartbeat_details(load)
         )
         db.session.add(log)
         db.session.commit()
@@ -116,7 +153,7 @@ def probe_heartbeat(api_key):
     })
 
 @api_blueprint.route('/api/probe/<api_key>/results', methods=['POST'])
-@limiter.limit("100 per minute")
+@limiter.limit("100 per minute", key_func=probe_rate_limit_key)
 def submit_job_result(api_key):
     """Endpoint for probes to send job results"""
     # Verificar se o probe existe e é ativo
@@ -138,12 +175,17 @@ def submit_job_result(api_key):
     )
     db.session.add(probe_log)
     
-    # Validar formato dos dados
-    data = request.json
-    if not data or not isinstance(data, dict) or 'job_id' not in data or 'success' not in data:
+    payload = request.get_json(silent=True)
+    if probe_ingest.is_batch(payload):
+        return submit_job_result_batch(probe, payload)
+    
+    # Validar formato dos dados (mesmas regras do ingest_server.py)
+    try:
+        data = probe_ingest.validate_result(payload)
+    except probe_ingest.ValidationError as e:
         return jsonify({
             'status': 'error',
-            'message': 'Invalid data format'
+            'message': str(e)
         }), 400
     
     # Procurar job correspondente
@@ -155,19 +197,30 @@ def submit_job_result(api_key):
         }), 404
     
     # Criar registro de resultado
+    server_push = probe.kuma_push_mode == 'server'
+    job_id = job.id
+    received_at = datetime.utcnow()
     job_result = JobResult(
-        job_id=job.id,
+        job_id=job_id,
+        timestamp=received_at,
         success=data['success'],
-        response_time_ms=data.get('response_time_ms'),
-        packets_sent=data.get('packets_sent'),
-        packets_received=data.get('packets_received'),
-        error_message=data.get('error_message'),
-        kuma_success=data.get('kuma_success', True),
-        kuma_error=data.get('kuma_error')
+        response_time_ms=data['response_time_ms'],
+        packets_sent=data['packets_sent'],
+        packets_received=data['packets_received'],
+        error_message=data['error_message'],
+        # No modo 'server' o status do Kuma é preenchido depois pelo dispatcher
+        kuma_success=None if server_push else data['kuma_success'],
+        kuma_error=None if server_push else data['kuma_error'],
+        aggregated=data['aggregated']
     )
     
     db.session.add(job_result)
     db.session.commit()
+    # Estado de saúde em memória: O(1), sem consultas adicionais (jobs agregados: pela janela)
+    if not data['aggregated']:
+        job_health.observe_result(job_id, received_at, data['success'], data['response_time_ms'],
+                                  data['packets_sent'], data['packets_received'])
+    metrics.record_result(probe.name, None if server_push else data['kuma_success'])
     
     # Atualizar timestamp de última execução
     job.last_run = datetime.utcnow()
@@ -178,6 +231,85 @@ def submit_job_result(api_key):
         'message': 'Job result recorded successfully'
     })
 
+def submit_job_result_batch(probe, payload):
+    """Records a batch of results and aggregates ({"results": [...], "aggregates": [...]}) in one transaction
+
+    Invalid items and jobs not assigned to the probe are reported per item
+    (``errors`` for results, ``aggregate_errors`` for aggregates); the rest of
+    the batch is recorded.
+    """
+    try:
+        results, errors = probe_ingest.validate_batch(payload)
+        aggregates, aggregate_errors = probe_ingest.validate_aggregates(payload)
+    except probe_ingest.ValidationError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    # Uma consulta para todos os jobs do lote
+    job_ids = {data['job_id'] for data in results} | {data['job_id'] for data in aggregates}
+    jobs = {job.id: job for job in Job.query.filter(Job.id.in_(job_ids), Job.probe_id == probe.id)} if job_ids else {}
+    server_push = probe.kuma_push_mode == 'server'
+    received_at = datetime.utcnow()
+    rows, recorded = [], []
+    seen = set()
+    for data in results:
+        job = jobs.get(data['job_id'])
+        if job is None:
+            errors.append({'index': data['index'], 'message': 'Job not found or not assigned to this probe'})
+            continue
+        timestamp = probe_ingest.result_time(data, received_at)
+        timestamp_us = to_epoch_us(timestamp)
+        if (job.id, timestamp_us) in seen:
+            errors.append({'index': data['index'], 'message': 'Duplicate result'})
+            continue
+        seen.add((job.id, timestamp_us))
+        rows.append(probe_ingest.result_row(data, timestamp_us, server_push))
+        recorded.append((job, data, timestamp))
+    
+    windows = []
+    for data in aggregates:
+        job = jobs.get(data['job_id'])
+        if job is None:
+            aggregate_errors.append({'index': data['index'],
+                                     'message': 'Job not found or not assigned to this probe'})
+            continue
+        windows.append((job, data, probe_ingest.aggregate_row(data, probe_ingest.window_start(data, received_at))))
+    
+    # Mesma escrita do ingest_server.py (resultados repetidos de um upload reenviado são ignorados),
+    # na transação da sessão, junto com o log do probe
+    try:
+        probe_ingest.write_rows(db.session.connection(), rows, aggregates=[row for _, _, row in windows])
+        for job, _, _ in recorded + windows:
+            job.last_run = received_at
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error recording job result batch of probe {probe.name}: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error recording job results: {str(e)}'
+        }), 500
+    
+    for job, data, timestamp in recorded:
+        if not data['aggregated']:
+            job_health.observe_result(job.id, timestamp, data['success'], data['response_time_ms'],
+                                      data['packets_sent'], data['packets_received'])
+        metrics.record_result(probe.name, None if server_push else data['kuma_success'])
+    for job, data, row in windows:
+        job_health.observe_aggregate(job.id, probe_ingest.window_end(row), data['count'], data['successes'],
+                                     data['latency_avg_ms'], data['packets_sent'], data['packets_received'])
+    
+    return jsonify({
+        'status': 'success',
+        'message': f'{len(recorded)} job results and {len(windows)} aggregates recorded',
+        'recorded': len(recorded),
+        'aggregates_recorded': len(windows),
+        'errors': sorted(errors, key=lambda error: error['index']),
+        'aggregate_errors': sorted(aggregate_errors, key=lambda error: error['index'])
+    })
+
 @api_blueprint.route('/api/results', methods=['POST'])
 def legacy_submit_job_result():
     """Compatibility endpoint for legacy probes to submit results"""
@@ -211,11 +343,12 @@ def legacy_submit_job_result():
     db.session.add(probe_log)
     
     # Validate data format
-    data = request.json
-    if not data or not isinstance(data, dict) or 'job_id' not in data or 'success' not in data:
+    try:
+        data = probe_ingest.validate_result(request.get_json(silent=True))
+    except probe_ingest.ValidationError as e:
         return jsonify({
             'status': 'error',
-            'message': 'Invalid data format'
+            'message': str(e)
         }), 400
     
     # Find corresponding job
@@ -231,30 +364,30 @@ def legacy_submit_job_result():
     
     try:
         # Create result record with only valid fields
+        job_id = job.id
+        received_at = datetime.utcnow()
+        server_push = probe.kuma_push_mode == 'server'
         job_result = JobResult(
-            job_id=job.id,
-            success=data['success']
+            job_id=job_id,
+            timestamp=received_at,
+            success=data['success'],
+            response_time_ms=data['response_time_ms'],
+            packets_sent=data['packets_sent'],
+            packets_received=data['packets_received'],
+            error_message=data['error_message'],
+            # No modo 'server' o status do Kuma é preenchido depois pelo dispatcher
+            kuma_success=None if server_push else data['kuma_success'],
+            kuma_error=None if server_push else data['kuma_error'],
         )
         
-        # Conditionally add fields only if they exist in both the data and the model
-        if 'response_time_ms' in data:
-            job_result.response_time_ms = data['response_time_ms']
-        if 'packets_sent' in data:
-            job_result.packets_sent = data['packets_sent']
-        if 'packets_received' in data:
-            job_result.packets_received = data['packets_received']
-        if 'error_message' in data:
-            job_result.error_message = data['error_message']
-        if 'kuma_success' in data:
-            job_result.kuma_success = data['kuma_success']
-        if 'kuma_error' in data:
-            job_result.kuma_error = data['kuma_error']
-        
         db.session.add(job_result)
         
         # Update last run timestamp
         job.last_run = datetime.utcnow()
         db.session.commit()
+        job_health.observe_result(job_id, received_at, data['success'], data['response_time_ms'],
+                                  data['packets_sent'], data['packets_received'])
+        metrics.record_result(probe.name, None if server_push else data['kuma_success'])
         
         return jsonify({
             'status': 'success',
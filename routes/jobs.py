@@ -1,45 +1,67 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, Response, stream_with_context
 from flask_login import login_required, current_user
-from app import db
-from models import Job, Probe, JobResult
-from forms.jobs import JobForm
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
+from app import db, read_session
+from models import Job, Probe, JobResult, JobResultAggregate, JobHealth, FLAG_SUCCESS, PACKETS_NULL, EPOCH, DEFAULT_EXPECTED_STATUS, to_epoch_us
+from forms.jobs import JobForm, JobImportForm
+from utils import job_bulk, job_health, message_search, pool_assignment, result_archive
+import click
+import csv
+import io
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 jobs_blueprint = Blueprint('jobs', __name__)
 
+def check_fields(form):
+    """Check type and the type-specific fields of the form (unused ones are cleared)"""
+    job_type = form.job_type.data
+    return {
+        'job_type': job_type,
+        'port': form.port.data if job_type == 'tcp' else None,
+        'http_method': form.http_method.data if job_type == 'http' else None,
+        'expected_status': (form.expected_status.data or DEFAULT_EXPECTED_STATUS) if job_type == 'http' else None,
+        'verify_tls': bool(form.verify_tls.data) if job_type == 'http' else True,
+    }
+
 @jobs_blueprint.route('/jobs')
 @login_required
 def list_jobs():
     jobs = Job.query.all()
-    return render_template('jobs/list.html', jobs=jobs)
+    health = job_health.health_snapshot([job.id for job in jobs])
+    return render_template('jobs/list.html', jobs=jobs, health=health, import_form=JobImportForm())
 
 @jobs_blueprint.route('/jobs/new', methods=['GET', 'POST'])
 @login_required
 def create_job():
+    # JobForm already populates the probe choices with the active probes
     form = JobForm()
     
-    # Populate probe select field with probes from the database
-    form.probe_id.choices = [
-        (probe.id, probe.name) for probe in Probe.query.filter_by(is_active=True).all()
-    ]
-    
     if form.validate_on_submit():
+        pool = (form.pool.data or '').strip() or None
         job = Job(
             name=form.name.data,
             description=form.description.data,
-            job_type='ping',  # Always ping
             target_host=form.target_host.data,
             kuma_url=form.kuma_url.data,
-            probe_id=form.probe_id.data,
+            # Jobs de pool começam em um probe provisório; o rebalanceamento abaixo escolhe o definitivo
+            probe_id=form.probe_id.data or pool_assignment.provisional_probe(pool),
+            pool=pool,
             interval_seconds=form.interval_seconds.data,
             timeout_seconds=form.timeout_seconds.data,
             retries=form.retries.data,
-            is_active=form.is_active.data
+            priority=form.priority.data or 0,
+            aggregate_seconds=form.aggregate_seconds.data or None,
+            is_active=form.is_active.data,
+            **check_fields(form)
         )
         
         db.session.add(job)
+        db.session.get(Probe, job.probe_id).bump_config_version()
         db.session.commit()
+        if pool:
+            pool_assignment.rebalance([pool])
         
         flash(f'Job "{job.name}" created successfully!', 'success')
         return redirect(url_for('jobs.list_jobs'))
@@ -50,29 +72,46 @@ def create_job():
 @login_required
 def edit_job(job_id):
     job = Job.query.get_or_404(job_id)
-    form = JobForm(job_id=job_id, obj=job)
-    
     # Populate probe select field with probes from the database
-    form.probe_id.choices = [
+    form = JobForm(job_id=job_id, obj=job, probe_choices=[
         (probe.id, probe.name) for probe in Probe.query.order_by(Probe.name).all()
-    ]
+    ])
+    if request.method == 'GET' and job.pool:
+        # Job de pool: o probe atual foi escolhido pelo servidor
+        form.probe_id.data = 0
     
     if form.validate_on_submit():
         try:
             # Atualizar campos do job sem iniciar uma nova transação
+            old_probe = job.probe
+            old_pool = job.pool
+            pool = (form.pool.data or '').strip() or None
             job.name = form.name.data
             job.description = form.description.data
-            # job_type remains as ping
+            for field, value in check_fields(form).items():
+                setattr(job, field, value)
             job.target_host = form.target_host.data
             job.kuma_url = form.kuma_url.data
-            job.probe_id = form.probe_id.data
+            if form.probe_id.data:
+                job.probe_id = form.probe_id.data
+            elif pool != old_pool or old_probe.pool != pool:
+                job.probe_id = pool_assignment.provisional_probe(pool)
+            job.pool = pool
             job.interval_seconds = form.interval_seconds.data
             job.timeout_seconds = form.timeout_seconds.data
             job.retries = form.retries.data
+            job.priority = form.priority.data or 0
+            job.aggregate_seconds = form.aggregate_seconds.data or None
             job.is_active = form.is_active.data
             
+            old_probe.bump_config_version()
+            if job.probe_id != old_probe.id:
+                db.session.get(Probe, job.probe_id).bump_config_version()
+            
             # Commit das alterações
             db.session.commit()
+            if pool or old_pool:
+                pool_assignment.rebalance({pool, old_pool} - {None})
             
             flash(f'Job "{job.name}" was updated successfully!', 'success')
             return redirect(url_for('jobs.list_jobs'))
@@ -89,20 +128,270 @@ def delete_job(job_id):
     
     # Delete all results associated with the job
     JobResult.query.filter_by(job_id=job.id).delete()
+    JobResultAggregate.query.filter_by(job_id=job.id).delete()
+    JobHealth.query.filter_by(job_id=job.id).delete()
     
+    job.probe.bump_config_version()
     db.session.delete(job)
     db.session.commit()
+    # Os ids podem ser reutilizados pelo SQLite: o histórico arquivado vai junto
+    result_archive.remove_job_archive(result_archive.archive_dir(db.engine), job_id)
+    job_health.forget_job(job_id)
     
     flash('Job deleted successfully!', 'success')
     return redirect(url_for('jobs.list_jobs'))
 
+@jobs_blueprint.route('/jobs/import', methods=['POST'])
+@login_required
+def import_jobs():
+    """Bulk create/update jobs from a CSV or JSON upload (or request body)
+
+    Both need the session's CSRF token: the upload form sends it as a field,
+    requests with the rows in the body send it in the X-CSRFToken header.
+    """
+    upload = request.files.get('file')
+    if upload:
+        if not JobImportForm().validate_on_submit():
+            flash('Import failed: the form expired, reload the page and try again.', 'danger')
+            return redirect(url_for('jobs.list_jobs'))
+        payload = upload.read().decode('utf-8-sig')
+        fmt = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+    else:
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError as e:
+            return jsonify({'status': 'error', 'message': f'CSRF check failed: {e}'}), 400
+        payload = request.get_data(as_text=True)
+        fmt = 'json' if request.is_json else request.args.get('format', 'csv')
+    allow_update = request.values.get('update', 'true').lower() == 'true'
+    
+    try:
+        summary = job_bulk.import_jobs(job_bulk.parse_rows(payload, fmt), allow_update=allow_update)
+    except job_bulk.BulkImportError as e:
+        if upload:
+            details = '; '.join(f"row {err['row']}: {err['error']}" for err in e.errors[:5])
+            flash(f'Import failed: {str(e)}. {details}', 'danger')
+            return redirect(url_for('jobs.list_jobs'))
+        return jsonify({'status': 'error', 'message': str(e), 'errors': e.errors}), 400
+    
+    if upload:
+        flash(f"Import complete: {summary['created']} job(s) created, {summary['updated']} updated.", 'success')
+        return redirect(url_for('jobs.list_jobs'))
+    return jsonify(dict(summary, status='success'))
+
+@jobs_blueprint.route('/jobs/export')
+@login_required
+def export_jobs():
+    """Stream all jobs as CSV (default) or JSON"""
+    fmt = 'json' if request.args.get('format') == 'json' else 'csv'
+    return Response(
+        stream_with_context(job_bulk.export_jobs(read_session, fmt)),
+        mimetype='application/json' if fmt == 'json' else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename=jobs.{fmt}'}
+    )
+
+@jobs_blueprint.cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), help='Defaults to the file extension')
+@click.option('--no-update', is_flag=True, help='Fail instead of updating jobs that already exist')
+def import_jobs_command(path, fmt, no_update):
+    """Bulk import jobs from a CSV or JSON file"""
+    fmt = fmt or ('json' if path.lower().endswith('.json') else 'csv')
+    with open(path, encoding='utf-8-sig') as f:
+        rows = job_bulk.parse_rows(f.read(), fmt)
+    try:
+        summary = job_bulk.import_jobs(rows, allow_update=not no_update)
+    except job_bulk.BulkImportError as e:
+        for err in e.errors:
+            click.echo(f"row {err['row']} ({err['name']}): {err['error']}", err=True)
+        raise click.ClickException(str(e))
+    click.echo(f"{summary['created']} job(s) created, {summary['updated']} updated, "
+               f"{len(summary['probes'])} probe(s) affected")
+
+@jobs_blueprint.cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default='csv')
+@click.option('--output', type=click.File('w'), default='-')
+def export_jobs_command(fmt, output):
+    """Export all jobs as CSV or JSON"""
+    for chunk in job_bulk.export_jobs(db.session, fmt):
+        output.write(chunk)
+
 @jobs_blueprint.route('/jobs/results/<int:job_id>')
 @login_required
 def view_results(job_id):
-    job = Job.query.get_or_404(job_id)
-    results = JobResult.query.filter_by(job_id=job.id).order_by(JobResult.timestamp.desc()).limit(100).all()
+    job = read_session.get(Job, job_id) or abort(404)
+    results = read_session.query(JobResult).filter_by(job_id=job.id).order_by(JobResult.timestamp.desc()).limit(100).all()
+    aggregates = read_session.query(JobResultAggregate).filter_by(job_id=job.id).order_by(
+        JobResultAggregate.window_start.desc()).limit(100).all()
+    
+    return render_template('jobs/results.html', job=job, results=results, aggregates=aggregates)
+
+def _time_range(default_hours=24):
+    """start/end query parameters (ISO 8601 or epoch seconds) as epoch microseconds"""
+    def parse(name):
+        value = request.args.get(name)
+        if not value:
+            return None
+        try:
+            return int(float(value) * 1000000)
+        except ValueError:
+            pass
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            abort(400, description=f'Invalid {name} parameter')
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return to_epoch_us(parsed)
+    
+    end = parse('end')
+    start = parse('start')
+    if start is None:
+        start = (end or to_epoch_us(datetime.utcnow())) - default_hours * 3600 * 1000000
+    return start, end
+
+@jobs_blueprint.route('/jobs/results/<int:job_id>/series')
+@login_required
+def result_series(job_id):
+    """Timestamps, status and latency of a job over a time range (live and archived)"""
+    job = read_session.get(Job, job_id) or abort(404)
+    start, end = _time_range()
+    series = result_archive.load_series(
+        read_session, result_archive.archive_dir(db.engine), job.id, start, end
+    )
+    return jsonify({
+        'job_id': job.id,
+        'start': start // 1000,
+        'end': end // 1000 if end is not None else None,
+        'timestamps': [timestamp // 1000 for timestamp in series['timestamp']],
+        'success': [int(bool(flags & FLAG_SUCCESS)) for flags in series['flags']],
+        'response_time_ms': [None if us < 0 else us / 1000 for us in series['response_time_us']],
+    })
+
+@jobs_blueprint.route('/jobs/results/<int:job_id>/aggregates')
+@login_required
+def result_aggregates(job_id):
+    """Windowed aggregates of a job in aggregate upload mode over a time range"""
+    job = read_session.get(Job, job_id) or abort(404)
+    start, end = _time_range()
+    query = read_session.query(JobResultAggregate).filter(
+        JobResultAggregate.job_id == job.id,
+        JobResultAggregate.window_start >= EPOCH + timedelta(microseconds=start),
+    )
+    if end is not None:
+        query = query.filter(JobResultAggregate.window_start < EPOCH + timedelta(microseconds=end))
+    windows = query.order_by(JobResultAggregate.window_start).all()
+    return jsonify({
+        'job_id': job.id,
+        'start': start // 1000,
+        'end': end // 1000 if end is not None else None,
+        'windows': [{
+            'start': to_epoch_us(window.window_start) // 1000,
+            'seconds': window.window_seconds,
+            'count': window.count,
+            'successes': window.successes,
+            'latency_min_ms': window.latency_ms('min'),
+            'latency_avg_ms': window.latency_ms('avg'),
+            'latency_max_ms': window.latency_ms('max'),
+            'latency_p95_ms': window.latency_ms('p95'),
+            'loss_pct': window.loss_pct,
+        } for window in windows],
+    })
+
+EXPORT_RESULT_FIELDS = ['timestamp', 'success', 'response_time_ms', 'packets_sent', 'packets_received', 'error_message']
+
+def _export_result_row(row):
+    timestamp, flags, response_time_us, packets, error = row
+    sent = received = None
+    if packets is not None:
+        sent = None if (packets >> 16) & PACKETS_NULL == PACKETS_NULL else (packets >> 16) & PACKETS_NULL
+        received = None if packets & PACKETS_NULL == PACKETS_NULL else packets & PACKETS_NULL
+    return [
+        (EPOCH + timedelta(microseconds=timestamp)).isoformat() + 'Z',
+        bool(flags & FLAG_SUCCESS),
+        None if response_time_us is None else response_time_us / 1000,
+        sent, received, error,
+    ]
+
+@jobs_blueprint.route('/jobs/results/<int:job_id>/export')
+@login_required
+def export_results(job_id):
+    """Stream a job's results (live and archived) as CSV (default) or JSON"""
+    job = read_session.get(Job, job_id) or abort(404)
+    fmt = 'json' if request.args.get('format') == 'json' else 'csv'
+    start, end = _time_range()
+    rows = result_archive.iter_results(
+        read_session, result_archive.archive_dir(db.engine), job.id, start, end
+    )
     
-    return render_template('jobs/results.html', job=job, results=results)
+    def generate():
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_RESULT_FIELDS)
+            for number, row in enumerate(rows, start=1):
+                writer.writerow(_export_result_row(row))
+                if number % 1000 == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            yield '['
+            for number, row in enumerate(rows):
+                yield (',' if number else '') + json.dumps(dict(zip(EXPORT_RESULT_FIELDS, _export_result_row(row))))
+            yield ']'
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/json' if fmt == 'json' else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename=job-{job.id}-results.{fmt}'}
+    )
+
+def _search_failures():
+    """Run the failure message search described by the query string"""
+    query = request.args.get('q', '').strip()
+    probe_id = request.args.get('probe_id', type=int)
+    field = request.args.get('field', 'both')
+    fields = ('error', 'kuma') if field not in message_search.FIELDS else (field,)
+    start, end = _time_range(default_hours=request.args.get('hours', 6, type=int) or 6)
+    result = message_search.search_failures(
+        read_session, query, start, end, probe_id=probe_id, fields=fields,
+        raw=request.args.get('syntax') == 'fts', limit=min(request.args.get('limit', 100, type=int) or 100, 1000)
+    )
+    names = dict(read_session.query(Job.id, Job.name).filter(
+        Job.id.in_({item['job_id'] for item in result['jobs']})
+    ).all()) if result['jobs'] else {}
+    for item in result['jobs'] + result['results']:
+        item['job_name'] = names.get(item['job_id'])
+        for key in ('timestamp', 'first', 'last'):
+            if key in item:
+                item[key] = (EPOCH + timedelta(microseconds=item[key])).isoformat() + 'Z'
+    result['jobs'].sort(key=lambda item: item['matches'], reverse=True)
+    return result
+
+@jobs_blueprint.route('/api/results/search')
+@login_required
+def search_failures_api():
+    """Jobs/results whose error or Kuma error matches ?q= (scoped by time and probe)"""
+    if not request.args.get('q', '').strip():
+        return jsonify({'status': 'error', 'message': 'q is required'}), 400
+    try:
+        return jsonify(_search_failures())
+    except message_search.SearchError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@jobs_blueprint.route('/jobs/search')
+@login_required
+def search_failures():
+    result = None
+    if request.args.get('q', '').strip():
+        try:
+            result = _search_failures()
+        except message_search.SearchError as e:
+            flash(str(e), 'danger')
+    probes = read_session.query(Probe.id, Probe.name).order_by(Probe.name).all()
+    return render_template('jobs/search.html', result=result, probes=probes, args=request.args)
 
 # API Endpoint to receive monitoring results
 @jobs_blueprint.route('/api/report', methods=['POST'])
@@ -132,8 +421,11 @@ def receive_report():
         return jsonify({'error': 'Job not found or not associated with this probe'}), 404
     
     # Create job result
+    job_id = job.id
+    received_at = datetime.utcnow()
     result = JobResult(
-        job_id=job.id,
+        job_id=job_id,
+        timestamp=received_at,
         success=data.get('success', False),
         response_time_ms=data.get('response_time_ms'),
         packets_sent=data.get('packets_sent'),
@@ -143,5 +435,7 @@ def receive_report():
     
     db.session.add(result)
     db.session.commit()
+    job_health.observe_result(job_id, received_at, data.get('success', False), data.get('response_time_ms'),
+                              data.get('packets_sent'), data.get('packets_received'))
     
     return jsonify({'status': 'success'}), 200
@@ -1,24 +1,25 @@
 from flask import Blueprint, render_template
 from flask_login import login_required
-from app import db
+from app import db, read_session
 from models import Probe, Job, JobResult
 from datetime import datetime, timedelta
+from utils.job_health import health_snapshot
 
 main_blueprint = Blueprint('main', __name__)
 
 @main_blueprint.route('/')
 @login_required
 def index():
-    # Dashboard data
-    probes_count = Probe.query.count()
-    active_probes = Probe.query.filter_by(is_active=True).count()
+    # Dashboard data (read-only pool, never waits on the ingest writer)
+    probes_count = read_session.query(Probe).count()
+    active_probes = read_session.query(Probe).filter_by(is_active=True).count()
     
-    jobs_count = Job.query.count()
-    active_jobs = Job.query.filter_by(is_active=True).count()
+    jobs_count = read_session.query(Job).count()
+    active_jobs = read_session.query(Job).filter_by(is_active=True).count()
     
     # Probes that have been offline for more than 5 minutes
     offline_threshold = datetime.utcnow() - timedelta(minutes=5)
-    offline_probes = Probe.query.filter(
+    offline_probes = read_session.query(Probe).filter(
         db.or_(
             Probe.last_seen < offline_threshold,
             Probe.last_seen == None
@@ -26,9 +27,17 @@ def index():
         Probe.is_active == True
     ).all()
     
+    # Jobs sinalizados pela detecção em streaming (estado em memória compartilhada)
+    flagged = {job_id: state for job_id, state in health_snapshot().items() if state['flags']}
+    unstable_jobs = []
+    if flagged:
+        jobs = read_session.query(Job).filter(Job.id.in_(flagged)).order_by(Job.name).all()
+        unstable_jobs = [(job, flagged[job.id]) for job in jobs]
+    
     return render_template('index.html', 
                            probes_count=probes_count,
                            active_probes=active_probes,
                            jobs_count=jobs_count,
                            active_jobs=active_jobs,
-                           offline_probes=offline_probes)
+                           offline_probes=offline_probes,
+                           unstable_jobs=unstable_jobs)
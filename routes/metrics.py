@@ -0,0 +1,36 @@
+import hmac
+import os
+from flask import Blueprint, Response, request
+from app import db, limiter
+from utils import metrics
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _database_gauges():
+    database = db.engine.url.database
+    if db.engine.dialect.name != 'sqlite' or database in (None, '', ':memory:'):
+        return []
+    return [
+        ('uptime_database_size_bytes', 'Size of the SQLite database file', _file_size(database)),
+        ('uptime_database_wal_size_bytes', 'Size of the SQLite write-ahead log', _file_size(f'{database}-wal')),
+    ]
+
+
+@metrics_blueprint.route('/metrics')
+@limiter.exempt
+def prometheus_metrics():
+    # Token opcional: com METRICS_TOKEN definido o scraper envia "Authorization: Bearer <token>"
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(_database_gauges()), content_type=CONTENT_TYPE)
@@ -1,8 +1,9 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, abort
 from flask_login import login_required, current_user
-from app import db
+from app import db, read_session
 from models import Probe, ProbeLog
 from forms.probes import ProbeForm
+from utils import pool_assignment
 
 probes_blueprint = Blueprint('probes', __name__, url_prefix='/probes')
 
@@ -20,7 +21,9 @@ def create_probe():
         probe = Probe(
             name=form.name.data,
             description=form.description.data,
-            is_active=form.is_active.data
+            is_active=form.is_active.data,
+            kuma_push_mode=form.kuma_push_mode.data,
+            pool=(form.pool.data or '').strip() or None
         )
         probe.generate_api_key()
         
@@ -44,9 +47,15 @@ def edit_probe(probe_id):
             probe.name = form.name.data
             probe.description = form.description.data
             probe.is_active = form.is_active.data
+            probe.kuma_push_mode = form.kuma_push_mode.data
+            old_pool, probe.pool = probe.pool, (form.pool.data or '').strip() or None
             
             # Commit das alterações
             db.session.commit()
+            # Mudança de pool (ou desativação) redistribui os jobs dos pools envolvidos
+            pools = {old_pool, probe.pool} - {None}
+            if pools:
+                pool_assignment.rebalance(pools)
             
             flash(f'Probe "{probe.name}" was updated successfully!', 'success')
             return redirect(url_for('probes.list_probes'))
@@ -93,9 +102,9 @@ def probe_jobs(probe_id):
 @login_required
 def view_probe_logs(probe_id):
     """Display connection logs for the probe"""
-    probe = Probe.query.get_or_404(probe_id)
+    probe = read_session.get(Probe, probe_id) or abort(404)
     
     # Get probe logs, ordered by most recent
-    logs = ProbeLog.query.filter_by(probe_id=probe.id).order_by(ProbeLog.timestamp.desc()).all()
+    logs = read_session.query(ProbeLog).filter_by(probe_id=probe.id).order_by(ProbeLog.timestamp.desc()).all()
     
     return render_template('probes/logs.html', probe=probe, logs=logs)
@@ -0,0 +1,34 @@
+from flask import Blueprint, render_template, request, jsonify
+from flask_login import login_required
+from app import db, read_session
+from models import Job
+from utils import analytics, result_archive
+
+reports_blueprint = Blueprint('reports', __name__)
+
+MAX_REPORT_DAYS = 366
+
+def _build_report():
+    days = min(max(request.args.get('days', 30, type=int) or 30, 1), MAX_REPORT_DAYS)
+    query = read_session.query(Job.id, Job.name).order_by(Job.id)
+    job_ids = request.args.getlist('job_id', type=int)
+    if job_ids:
+        query = query.filter(Job.id.in_(job_ids))
+    report = analytics.sla_report(
+        read_session, result_archive.archive_dir(db.engine), query.all(), days=days
+    )
+    return days, report
+
+@reports_blueprint.route('/reports/sla')
+@login_required
+def sla_report():
+    days, report = _build_report()
+    return render_template('reports/sla.html', days=days, report=report,
+                           loss_buckets=analytics.LOSS_BUCKETS)
+
+@reports_blueprint.route('/api/reports/sla')
+@login_required
+def sla_report_api():
+    """Per-job SLA metrics; ?days=30 and optional repeated ?job_id="""
+    days, report = _build_report()
+    return jsonify({'days': days, 'jobs': report})
@@ -1,9 +1,7 @@
 import os
 import sys
 import warnings
-from waitress import serve
-from app import create_app, scheduler
-import atexit
+from app import create_app
 
 # Suppress Flask development server warnings
 if not sys.warnoptions:
@@ -12,9 +10,6 @@ if not sys.warnoptions:
 
 app = create_app()
 
-# Ensure scheduler stops when application exits
-atexit.register(lambda: scheduler.shutdown(wait=False))
-
 if __name__ == "__main__":
     print("╔═══════════════════════════════════════════════╗")
     print("║          Uptime Monitor is running!           ║")
@@ -27,4 +22,5 @@ if __name__ == "__main__":
     print("╚═══════════════════════════════════════════════╝")
     
     # Using waitress for production-ready server without development warnings
+    from waitress import serve
     serve(app, host='0.0.0.0', port=5001, threads=4)
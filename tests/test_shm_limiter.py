@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.shm_limiter import SharedMemoryStorage  # noqa: E402
+
+PROCESSES = 8
+HITS = 3000
+
+
+def test_counters_are_shared_by_forked_workers(tmp_path):
+    # Como o gunicorn com preload_app: storage criado no master, usado pelos filhos
+    storage = SharedMemoryStorage(f"shm://{tmp_path / 'ratelimit'}", slots=1024)
+    storage.incr('warmup', 60)
+
+    children = []
+    for _ in range(PROCESSES):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for _ in range(HITS):
+                    storage.incr('hits', 60)
+                code = 0
+            finally:
+                os._exit(code)
+        children.append(pid)
+    for pid in children:
+        assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+
+    assert storage.get('hits') == PROCESSES * HITS
+
+
+def test_fixed_window_expires(tmp_path):
+    storage = SharedMemoryStorage(f"shm://{tmp_path / 'ratelimit'}", slots=1024)
+    assert storage.incr('key', 60) == 1
+    assert storage.incr('key', 60, amount=2) == 3
+    storage.clear('key')
+    assert storage.get('key') == 0
@@ -0,0 +1,275 @@
+"""SLA and latency analytics over job results.
+
+Results (live table and archive) are loaded as NumPy columns, a chunk of jobs
+at a time, and every metric is computed with grouped array operations over
+the whole chunk (``bincount``, ``lexsort``, cumulative maxima), never with a
+Python loop over rows:
+
+* uptime % and sample count;
+* latency mean / p50 / p95 / p99 of successful checks and jitter (mean
+  absolute difference between consecutive latencies);
+* packet loss: mean % and distribution over ``LOSS_BUCKETS``;
+* incidents (runs of failed checks), total downtime, MTTR and MTBF.
+
+A failure run lasts from its first failed check to the next successful one;
+a run still open at the end of the window counts as downtime but not in MTTR.
+
+Jobs in aggregate upload mode add their ``job_result_aggregates`` windows to
+the sample, uptime, mean latency and packet loss figures (their raw rows,
+marked ``FLAG_AGGREGATED``, only count for incidents); their p95 is the mean
+of the windows' p95 weighted by successful checks when no raw latency exists.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import chain
+
+import numpy as np
+from sqlalchemy import text
+
+from models import FLAG_AGGREGATED, FLAG_SUCCESS, PACKETS_NULL, to_epoch_us
+from utils import result_archive
+
+ARCHIVE_COLUMNS = ('timestamp', 'flags', 'response_time_us', 'packets')
+LOSS_BUCKETS = ['0%', '0-25%', '25-50%', '50-100%', '100%']
+PERCENTILES = (0.50, 0.95, 0.99)
+
+LIVE_QUERY = """
+    SELECT job_id, timestamp, flags, coalesce(response_time_us, -1), coalesce(packets, -1)
+    FROM job_results
+    WHERE job_id IN ({placeholders}) AND timestamp >= :start AND timestamp < :end
+    ORDER BY job_id, timestamp
+"""
+AGGREGATE_QUERY = """
+    SELECT job_id, sum(count), sum(successes),
+           sum(CASE WHEN latency_avg_us IS NOT NULL THEN successes ELSE 0 END),
+           sum(CASE WHEN latency_avg_us IS NOT NULL THEN latency_avg_us * successes ELSE 0 END),
+           sum(CASE WHEN latency_p95_us IS NOT NULL THEN successes ELSE 0 END),
+           sum(CASE WHEN latency_p95_us IS NOT NULL THEN latency_p95_us * successes ELSE 0 END),
+           sum(CASE WHEN packets_sent > 0 THEN count ELSE 0 END),
+           sum(CASE WHEN packets_sent > 0
+                    THEN (1.0 - min(packets_received, packets_sent) * 1.0 / packets_sent) * 100.0 * count
+                    ELSE 0 END),
+           min(window_start), max(window_start + window_seconds * 1000000)
+    FROM job_result_aggregates
+    WHERE job_id IN ({placeholders}) AND window_start >= :start AND window_start < :end
+    GROUP BY job_id
+"""
+AGGREGATE_TOTALS = ('count', 'successes', 'latency_count', 'latency_sum_us', 'p95_count', 'p95_sum_us',
+                    'loss_checks', 'loss_sum', 'first_us', 'last_us')
+
+
+def _empty_columns():
+    return {
+        'job': np.empty(0, np.int32),
+        'timestamp': np.empty(0, np.int64),
+        'flags': np.empty(0, np.int64),
+        'response_time_us': np.empty(0, np.int64),
+        'packets': np.empty(0, np.int64),
+    }
+
+
+def _load_archive(root, job_id, start_us, end_us):
+    parts = list(result_archive.read_range(root, job_id, start_us, end_us, ARCHIVE_COLUMNS))
+    if not parts:
+        return None
+    return {name: np.concatenate([np.frombuffer(part[name], dtype=part[name].typecode)
+                                  for part in parts]).astype(np.int64)
+            for name in ARCHIVE_COLUMNS}
+
+
+def load_columns(session, root, job_ids, start_us, end_us, fetch_size=50000, pool=None):
+    """Columns for job_ids over [start_us, end_us), grouped by job and in time order
+
+    ``job`` holds the position of the job in job_ids.
+    """
+    archived = list((pool.map if pool else map)(
+        lambda job_id: _load_archive(root, job_id, start_us, end_us), job_ids))
+
+    params = {f'j{i}': job_id for i, job_id in enumerate(job_ids)}
+    params.update(start=start_us, end=end_us)
+    query = text(LIVE_QUERY.format(placeholders=', '.join(f':j{i}' for i in range(len(job_ids)))))
+    result = session.execute(query, params)
+    chunks = []
+    while True:
+        rows = result.fetchmany(fetch_size)
+        if not rows:
+            break
+        chunks.append(np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 5).reshape(-1, 5))
+    live = np.concatenate(chunks) if chunks else np.empty((0, 5), np.int64)
+
+    # As linhas vivas vêm ordenadas por job_id: o trecho de cada job é uma busca binária
+    ids = np.asarray(job_ids, dtype=np.int64)
+    lows = np.searchsorted(live[:, 0], ids, side='left')
+    highs = np.searchsorted(live[:, 0], ids, side='right')
+
+    parts = []
+    for index, archive in enumerate(archived):
+        rows = live[lows[index]:highs[index]]
+        if archive is not None and len(archive['timestamp']):
+            # Linhas ainda presentes nas duas camadas contam uma vez
+            rows = rows[rows[:, 1] > archive['timestamp'][-1]]
+            part = {name: np.concatenate([archive[name], rows[:, column]])
+                    for column, name in enumerate(ARCHIVE_COLUMNS, start=1)}
+        else:
+            part = {name: rows[:, column] for column, name in enumerate(ARCHIVE_COLUMNS, start=1)}
+        part['job'] = np.full(len(part['timestamp']), index, dtype=np.int32)
+        parts.append(part)
+
+    if not parts:
+        return _empty_columns()
+    return {name: np.concatenate([part[name] for part in parts]) for name in _empty_columns()}
+
+
+def load_aggregates(session, job_ids, start_us, end_us):
+    """Per-job totals of the aggregate windows starting in [start_us, end_us), as arrays in job_ids order"""
+    totals = {name: np.zeros(len(job_ids)) for name in AGGREGATE_TOTALS}
+    totals['first_us'][:] = np.nan
+    totals['last_us'][:] = np.nan
+    params = {f'j{i}': job_id for i, job_id in enumerate(job_ids)}
+    params.update(start=start_us, end=end_us)
+    positions = {job_id: index for index, job_id in enumerate(job_ids)}
+    query = text(AGGREGATE_QUERY.format(placeholders=', '.join(f':j{i}' for i in range(len(job_ids)))))
+    for row in session.execute(query, params):
+        for name, value in zip(AGGREGATE_TOTALS, row[1:]):
+            totals[name][positions[row[0]]] = value
+    return totals
+
+
+def _grouped_percentiles(groups, values_us, n_groups, quantiles):
+    """Linear-interpolated percentiles (in ms) of values_us per group, NaN for empty groups"""
+    # Uma única ordenação de chaves (grupo << 32 | valor) substitui o lexsort
+    keys = np.sort((groups.astype(np.int64) << 32) | np.clip(values_us, 0, 0xFFFFFFFF))
+    values = (keys & 0xFFFFFFFF) / 1000.0
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has = counts > 0
+    result = np.full((len(quantiles), n_groups), np.nan)
+    for row, q in enumerate(quantiles):
+        position = starts[has] + q * (counts[has] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        result[row, has] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+
+
+def compute_metrics(columns, n_jobs, aggregates=None):
+    """Per-job metric arrays for columns grouped by job and sorted by time
+
+    aggregates are the ``load_aggregates`` totals of the same jobs, if any.
+    """
+    job = columns['job']
+    timestamp = columns['timestamp']
+    success = (columns['flags'] & FLAG_SUCCESS) != 0
+    # Resultados de jobs no modo agregado já estão nas janelas: só contam para os incidentes
+    counted = (columns['flags'] & FLAG_AGGREGATED) == 0
+    latency = columns['response_time_us']
+    totals = aggregates or {name: np.zeros(n_jobs) for name in AGGREGATE_TOTALS}
+    samples = np.bincount(job[counted], minlength=n_jobs) + totals['count'].astype(np.int64)
+    successes = np.bincount(job, weights=success & counted, minlength=n_jobs) + totals['successes']
+    metrics = {
+        'samples': samples,
+        'uptime_pct': _ratio(successes * 100.0, samples),
+    }
+
+    # Latência: apenas checagens com sucesso e tempo medido
+    valid = success & counted & (latency >= 0)
+    latency_job, latency_us = job[valid], latency[valid]
+    latency_ms = latency_us / 1000.0
+    raw_latency_count = np.bincount(latency_job, minlength=n_jobs)
+    metrics['latency_mean_ms'] = _ratio(
+        np.bincount(latency_job, weights=latency_ms, minlength=n_jobs) + totals['latency_sum_us'] / 1000.0,
+        raw_latency_count + totals['latency_count'])
+    for q, values in zip(PERCENTILES, _grouped_percentiles(latency_job, latency_us, n_jobs, PERCENTILES)):
+        metrics[f'latency_p{int(q * 100)}_ms'] = values
+    windows_only = (raw_latency_count == 0) & (totals['p95_count'] > 0)
+    metrics['latency_p95_ms'][windows_only] = (totals['p95_sum_us'] / 1000.0 / np.maximum(totals['p95_count'], 1))[
+        windows_only]
+    consecutive = latency_job[1:] == latency_job[:-1]
+    differences = np.abs(np.diff(latency_ms))[consecutive]
+    metrics['jitter_ms'] = _ratio(np.bincount(latency_job[1:][consecutive], weights=differences, minlength=n_jobs),
+                                  np.bincount(latency_job[1:][consecutive], minlength=n_jobs))
+
+    # Perda de pacotes
+    packets = columns['packets']
+    sent = (packets >> 16) & PACKETS_NULL
+    received = packets & PACKETS_NULL
+    measured = counted & (packets >= 0) & (sent != PACKETS_NULL) & (received != PACKETS_NULL) & (sent > 0)
+    loss = np.clip(1.0 - received[measured] / sent[measured], 0.0, 1.0) * 100.0
+    loss_job = job[measured]
+    metrics['packet_loss_pct'] = _ratio(np.bincount(loss_job, weights=loss, minlength=n_jobs) + totals['loss_sum'],
+                                        np.bincount(loss_job, minlength=n_jobs) + totals['loss_checks'])
+    bucket = np.select([loss == 0, loss <= 25, loss <= 50, loss < 100], [0, 1, 2, 3], default=4)
+    metrics['loss_distribution'] = np.bincount(
+        loss_job * len(LOSS_BUCKETS) + bucket, minlength=n_jobs * len(LOSS_BUCKETS)
+    ).reshape(n_jobs, len(LOSS_BUCKETS))
+
+    # Incidentes: sequências de falhas dentro do mesmo job
+    index = np.arange(len(job))
+    same_job = np.concatenate(([False], job[1:] == job[:-1]))
+    previous_success = np.concatenate(([True], success[:-1]))
+    failure_start = ~success & (~same_job | previous_success)
+    recovery = success & same_job & ~previous_success
+    last_start = np.maximum.accumulate(np.where(failure_start, index, 0))
+    repair = (timestamp[recovery] - timestamp[last_start[recovery]]) / 1e6
+    repair_job = job[recovery]
+    incidents = np.bincount(job[failure_start], minlength=n_jobs)
+    repairs = np.bincount(repair_job, minlength=n_jobs)
+    downtime = np.bincount(repair_job, weights=repair, minlength=n_jobs)
+
+    # Janela observada de cada job e incidente ainda aberto no fim dela
+    last = np.concatenate((job[1:] != job[:-1], [True])) if len(job) else np.empty(0, bool)
+    first = np.concatenate(([True], job[1:] != job[:-1])) if len(job) else np.empty(0, bool)
+    observed_first = np.full(n_jobs, np.nan)
+    observed_last = np.full(n_jobs, np.nan)
+    observed_first[job[first]] = timestamp[first]
+    observed_last[job[last]] = timestamp[last]
+    if aggregates is not None:
+        observed_first = np.fmin(observed_first, totals['first_us'])
+        observed_last = np.fmax(observed_last, totals['last_us'])
+    observed = np.nan_to_num((observed_last - observed_first) / 1e6)
+    open_at_end = last & ~success
+    downtime[job[open_at_end]] += (timestamp[open_at_end] - timestamp[last_start[open_at_end]]) / 1e6
+
+    metrics['incidents'] = incidents
+    metrics['downtime_s'] = downtime
+    metrics['mttr_s'] = _ratio(np.bincount(repair_job, weights=repair, minlength=n_jobs), repairs)
+    metrics['mtbf_s'] = _ratio(np.maximum(observed - downtime, 0), incidents)
+    return metrics
+
+
+def _value(value):
+    if isinstance(value, np.ndarray):
+        return [_value(item) for item in value]
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), 3)
+    return int(value)
+
+
+def sla_report(session, root, jobs, days=30, end=None, chunk_size=200, workers=None):
+    """Metrics for every (job_id, name) in jobs over the last days
+
+    Returns a list of dicts, one per job, in the order of jobs.
+    """
+    end = end or datetime.utcnow()
+    start_us, end_us = to_epoch_us(end - timedelta(days=days)), to_epoch_us(end)
+    workers = workers or int(os.environ.get('ANALYTICS_WORKERS', 4))
+    report = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for offset in range(0, len(jobs), chunk_size):
+            chunk = jobs[offset:offset + chunk_size]
+            job_ids = [job_id for job_id, _ in chunk]
+            columns = load_columns(session, root, job_ids, start_us, end_us, pool=pool)
+            metrics = compute_metrics(columns, len(chunk), load_aggregates(session, job_ids, start_us, end_us))
+            for index, (job_id, name) in enumerate(chunk):
+                entry = {'job_id': job_id, 'name': name}
+                for key, values in metrics.items():
+                    entry[key] = _value(values[index])
+                entry['loss_distribution'] = dict(zip(LOSS_BUCKETS, entry['loss_distribution']))
+                report.append(entry)
+    return report
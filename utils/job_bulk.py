@@ -0,0 +1,287 @@
+"""Bulk job import and export.
+
+Imports accept CSV or JSON rows with the job fields plus ``probe`` (probe name)
+or ``probe_id`` of an active probe; rows with a ``pool`` may omit the probe and are placed by
+``utils.pool_assignment`` after the import. The whole batch is validated in memory against one preload of
+probe and job names, then applied in a single transaction with bulk
+inserts/updates (jobs are matched by name), and the ``config_version`` of every
+affected probe is bumped once. Nothing is written if any row is invalid.
+"""
+import csv
+import io
+import json
+import re
+from datetime import datetime
+from urllib.parse import urlparse
+
+from sqlalchemy import insert, update
+
+from app import db
+from models import (Job, Probe, JOB_TYPES, HTTP_METHODS, DEFAULT_EXPECTED_STATUS, EXPECTED_STATUS_PATTERN,
+                    MAX_AGGREGATE_SECONDS)
+from utils import pool_assignment
+
+EXPORT_FIELDS = [
+    'name', 'description', 'probe', 'job_type', 'target_host', 'port', 'http_method', 'expected_status',
+    'verify_tls', 'kuma_url', 'interval_seconds', 'timeout_seconds', 'retries', 'priority', 'pool',
+    'aggregate_seconds', 'is_active',
+]
+DEFAULTS = {
+    'description': None,
+    'job_type': 'ping',
+    'port': None,
+    'http_method': 'GET',
+    'expected_status': DEFAULT_EXPECTED_STATUS,
+    'verify_tls': True,
+    'interval_seconds': 60,
+    'timeout_seconds': 10,
+    'retries': 0,
+    'priority': 0,
+    'pool': None,
+    'aggregate_seconds': None,
+    'is_active': True,
+}
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'off', ''}
+
+
+class BulkImportError(ValueError):
+    """Raised when the batch cannot be parsed or fails validation"""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+def parse_rows(payload, fmt):
+    """Parse CSV or JSON text into a list of dicts"""
+    if fmt == 'csv':
+        return list(csv.DictReader(io.StringIO(payload)))
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise BulkImportError(f'Invalid JSON: {str(e)}')
+    if isinstance(data, dict):
+        data = data.get('jobs')
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise BulkImportError('Expected a list of job objects (or {"jobs": [...]})')
+    return data
+
+
+def _as_int(value, field, minimum, maximum=None):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be an integer')
+    if number < minimum or (maximum is not None and number > maximum):
+        limit = f'between {minimum} and {maximum}' if maximum is not None else f'at least {minimum}'
+        raise ValueError(f'{field} must be {limit}')
+    return number
+
+
+def _as_bool(value, field='is_active'):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f'{field} must be a boolean')
+
+
+def _check_fields(value, target_host):
+    """job_type and its type-specific columns (the ones of other types are cleared)"""
+    job_type = str(value('job_type')).lower()
+    if job_type not in JOB_TYPES:
+        raise ValueError(f'job_type must be one of {", ".join(JOB_TYPES)}')
+    fields = {'job_type': job_type, 'port': None, 'http_method': None, 'expected_status': None, 'verify_tls': True}
+    if job_type == 'tcp':
+        if value('port') is None:
+            raise ValueError('port is required for tcp jobs')
+        fields['port'] = _as_int(value('port'), 'port', 1, 65535)
+    elif job_type == 'http':
+        parsed = urlparse(target_host)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError('target_host of http jobs must be a full http(s) URL')
+        http_method = str(value('http_method')).upper()
+        if http_method not in HTTP_METHODS:
+            raise ValueError(f'http_method must be one of {", ".join(HTTP_METHODS)}')
+        expected_status = str(value('expected_status')).replace(' ', '')
+        if len(expected_status) > 64 or not re.match(EXPECTED_STATUS_PATTERN, expected_status):
+            raise ValueError('expected_status must be status codes or ranges separated by commas')
+        fields.update(http_method=http_method, expected_status=expected_status,
+                      verify_tls=_as_bool(value('verify_tls'), 'verify_tls'))
+    return fields
+
+
+def _clean(row, probes_by_name, probe_ids, pool_probes):
+    """Validate one row (same rules as JobForm) and return the column values"""
+    def value(field):
+        raw = row.get(field)
+        if isinstance(raw, str):
+            raw = raw.strip()
+        return DEFAULTS.get(field) if raw in (None, '') else raw
+
+    name = value('name') or ''
+    if not 3 <= len(name) <= 64:
+        raise ValueError('name must be between 3 and 64 characters')
+    description = value('description')
+    if description and len(description) > 255:
+        raise ValueError('description cannot be more than 255 characters')
+    target_host = value('target_host') or ''
+    if not 1 <= len(target_host) <= 256:
+        raise ValueError('target_host must be between 1 and 256 characters')
+    kuma_url = value('kuma_url') or ''
+    parsed = urlparse(kuma_url)
+    if parsed.scheme not in ('http', 'https') or not parsed.netloc or len(kuma_url) > 256:
+        raise ValueError('kuma_url must be a valid http(s) URL')
+
+    pool = value('pool')
+    if pool is not None:
+        pool = str(pool)
+        if len(pool) > 64:
+            raise ValueError('pool cannot be more than 64 characters')
+        if pool not in pool_probes:
+            pool_probes[pool] = pool_assignment.provisional_probe(pool)
+        if pool_probes[pool] is None:
+            raise ValueError(f'no active probe belongs to pool "{pool}"')
+
+    interval_seconds = _as_int(value('interval_seconds'), 'interval_seconds', 5)
+    aggregate_seconds = value('aggregate_seconds')
+    if aggregate_seconds is not None:
+        aggregate_seconds = _as_int(aggregate_seconds, 'aggregate_seconds', 10, MAX_AGGREGATE_SECONDS)
+        if aggregate_seconds < interval_seconds:
+            raise ValueError('aggregate_seconds must be at least interval_seconds')
+
+    probe_id = value('probe_id')
+    if probe_id is not None:
+        probe_id = _as_int(probe_id, 'probe_id', 1)
+        if probe_id not in probe_ids:
+            raise ValueError(f'probe_id {probe_id} does not exist')
+        if not probe_ids[probe_id]:
+            raise ValueError(f'probe_id {probe_id} is inactive')
+    elif value('probe'):
+        probe_id = probes_by_name.get(value('probe'))
+        if probe_id is None:
+            raise ValueError(f'probe "{value("probe")}" does not exist')
+        # Como no formulário, só probes ativos recebem jobs
+        if not probe_ids[probe_id]:
+            raise ValueError(f'probe "{value("probe")}" is inactive')
+    elif pool is not None:
+        probe_id = pool_probes[pool]
+    else:
+        raise ValueError('probe, probe_id or pool is required')
+
+    return {
+        'name': name,
+        'description': description,
+        'target_host': target_host,
+        'kuma_url': kuma_url,
+        'probe_id': probe_id,
+        'interval_seconds': interval_seconds,
+        'timeout_seconds': _as_int(value('timeout_seconds'), 'timeout_seconds', 1, 60),
+        'retries': _as_int(value('retries'), 'retries', 0, 5),
+        'priority': _as_int(value('priority'), 'priority', 0, 100),
+        'pool': pool,
+        'aggregate_seconds': aggregate_seconds,
+        'is_active': _as_bool(value('is_active')),
+        **_check_fields(value, target_host),
+    }
+
+
+def import_jobs(rows, allow_update=True):
+    """Validate and apply a batch of job rows in one transaction
+
+    Returns a dict with the number of created and updated jobs and the ids of
+    the probes whose configuration changed. Raises BulkImportError with the
+    per-row errors if anything is invalid.
+    """
+    # Uma única carga de probes e nomes de jobs para validar todo o lote em memória
+    probes = db.session.query(Probe.name, Probe.id, Probe.is_active).all()
+    probes_by_name = {name: probe_id for name, probe_id, _ in probes}
+    probe_ids = {probe_id: bool(is_active) for _, probe_id, is_active in probes}
+    existing = {name: (job_id, probe_id) for job_id, name, probe_id in
+                db.session.query(Job.id, Job.name, Job.probe_id).all()}
+
+    pool_probes = {}
+    errors = []
+    seen = set()
+    inserts, updates = [], []
+    affected_probes = set()
+    now = datetime.utcnow()
+    for number, row in enumerate(rows, start=1):
+        try:
+            values = _clean(row, probes_by_name, probe_ids, pool_probes)
+        except ValueError as e:
+            errors.append({'row': number, 'name': row.get('name'), 'error': str(e)})
+            continue
+        if values['name'] in seen:
+            errors.append({'row': number, 'name': values['name'], 'error': 'duplicate name in batch'})
+            continue
+        seen.add(values['name'])
+        affected_probes.add(values['probe_id'])
+        if values['name'] in existing:
+            if not allow_update:
+                errors.append({'row': number, 'name': values['name'], 'error': 'job already exists'})
+                continue
+            job_id, old_probe_id = existing[values['name']]
+            affected_probes.add(old_probe_id)
+            updates.append(dict(values, id=job_id, updated_at=now))
+        else:
+            inserts.append(dict(values, created_at=now, updated_at=now))
+
+    if errors:
+        raise BulkImportError(f'{len(errors)} invalid row(s), nothing was imported', errors)
+
+    try:
+        if inserts:
+            db.session.execute(insert(Job), inserts)
+        if updates:
+            db.session.execute(update(Job), updates)
+        if affected_probes:
+            Probe.query.filter(Probe.id.in_(affected_probes)).update(
+                {Probe.config_version: Probe.config_version + 1}, synchronize_session=False
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if pool_probes:
+        pool_assignment.rebalance(list(pool_probes))
+
+    return {
+        'created': len(inserts),
+        'updated': len(updates),
+        'probes': sorted(affected_probes),
+    }
+
+
+def export_jobs(session, fmt='csv', batch_size=1000):
+    """Yield the job list as CSV or JSON chunks without loading it all in memory"""
+    query = (
+        session.query(
+            Job.name, Job.description, Probe.name, Job.job_type, Job.target_host, Job.port, Job.http_method,
+            Job.expected_status, Job.verify_tls, Job.kuma_url, Job.interval_seconds, Job.timeout_seconds,
+            Job.retries, Job.priority, Job.pool, Job.aggregate_seconds, Job.is_active,
+        )
+        .join(Probe, Job.probe_id == Probe.id)
+        .order_by(Job.id)
+        .yield_per(batch_size)
+    )
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for number, row in enumerate(query, start=1):
+            writer.writerow(row)
+            if number % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        yield '['
+        for number, row in enumerate(query):
+            yield (',' if number else '') + json.dumps(dict(zip(EXPORT_FIELDS, row)))
+        yield ']'
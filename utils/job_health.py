@@ -0,0 +1,359 @@
+"""Streaming per-job health state (flapping, latency regression, loss).
+
+Every ingested result updates a fixed-size record for its job in O(1), with
+no database access, so detection costs the same however long the history is:
+
+* latency: fast EWMA (recent level) against a slow EWMA baseline with its
+  exponentially weighted variance -- ``latency regression`` when the recent
+  level is well above the baseline;
+* outcomes: current failure run and a bitmask of the last 32 outcomes, whose
+  state changes give the flap rate over the last ``FLAP_WINDOW`` checks
+  (with hysteresis, like Nagios flap detection) -- ``flapping``;
+* packet loss: bitmask over the last 32 checks marking the successful ones
+  that still lost packets, and a loss EWMA -- ``intermittent loss`` when
+  several recent checks did.
+
+Records live in an mmap'd file (``/dev/shm`` when available) indexed by job
+id and shared by all worker processes, like the rate limiter counters.
+Updates take ``flock`` plus a thread lock. The maintenance leader checkpoints
+the records to the ``job_health`` table (``JOB_HEALTH_CHECKPOINT_INTERVAL``),
+and they are restored from there when the file is recreated (reboot).
+"""
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+logger = logging.getLogger('uptime-monitor')
+
+FLAPPING = 1
+LATENCY_REGRESSION = 2
+INTERMITTENT_LOSS = 4
+FLAG_LABELS = {
+    FLAPPING: 'flapping',
+    LATENCY_REGRESSION: 'latency regression',
+    INTERMITTENT_LOSS: 'intermittent loss',
+}
+
+FAST_ALPHA = 0.3          # nível recente (~3 checagens)
+SLOW_ALPHA = 0.01         # linha de base (~100 checagens)
+LATENCY_WARMUP = 30       # checagens com latência antes de avaliar regressão
+REGRESSION_SIGMAS = 3.0
+REGRESSION_FACTOR = 1.5   # e pelo menos 50% acima da linha de base
+FLAP_WINDOW = 21
+FLAP_HIGH = 0.30
+FLAP_LOW = 0.20
+LOSS_HIGH = 3             # checagens com perda entre as últimas 32
+LOSS_LOW = 1
+
+_MAGIC = b'UPJH'
+_VERSION = 1
+_HEADER = struct.Struct('<4sII')         # magic, versão, capacidade (registros)
+# job_id, flags, count, latency_count, fail_run, outcomes, losses, reservado,
+# last_ts, fast, slow, variance, loss_ewma
+_RECORD = struct.Struct('<8I5d')
+_WINDOW_MASK = (1 << 32) - 1
+
+
+def default_state_path():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'uptime-job-health')
+
+
+def flag_labels(flags):
+    return [label for bit, label in FLAG_LABELS.items() if flags & bit]
+
+
+def _transitions(outcomes, window):
+    mask = (1 << (window - 1)) - 1
+    return bin((outcomes ^ (outcomes >> 1)) & mask).count('1')
+
+
+class HealthState:
+    """Health records shared by every process on the host"""
+
+    def __init__(self, path=None, initial_capacity=1024):
+        self.path = path or os.environ.get('JOB_HEALTH_PATH') or default_state_path()
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.pid = os.getpid()
+        self.fresh = False
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0)
+            valid = len(header) == _HEADER.size and _HEADER.unpack(header)[:2] == (_MAGIC, _VERSION)
+            if not valid:
+                os.ftruncate(self._fd, 0)
+                self._resize(initial_capacity)
+                self.fresh = True
+            self._map_file()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _resize(self, capacity):
+        os.ftruncate(self._fd, _HEADER.size + capacity * _RECORD.size)
+        os.pwrite(self._fd, _HEADER.pack(_MAGIC, _VERSION, capacity), 0)
+
+    def _map_file(self):
+        self.capacity = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))[2]
+        self._map = mmap.mmap(self._fd, _HEADER.size + self.capacity * _RECORD.size)
+
+    def _lock(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._thread_lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _remap(self):
+        self._map.close()
+        self._map_file()
+
+    def _ensure_capacity(self, job_id):
+        """Called with the lock held; grows (or remaps after another process grew) the file"""
+        if job_id < self.capacity:
+            return
+        capacity = _HEADER.unpack_from(self._map, 0)[2]
+        if job_id >= capacity:
+            self._resize(max(job_id + 1, capacity * 2))
+        self._remap()
+
+    def _offset(self, job_id):
+        return _HEADER.size + job_id * _RECORD.size
+
+    def observe(self, job_id, timestamp, success, response_time_ms=None,
+                packets_sent=None, packets_received=None):
+        """Fold one result into the job's state and return its flags
+
+        Results older than the last one folded (late batch uploads) are
+        skipped: the windows and averages assume time order.
+        """
+        self._lock()
+        try:
+            self._ensure_capacity(job_id)
+            offset = self._offset(job_id)
+            (stored_id, flags, count, latency_count, fail_run, outcomes, losses, _,
+             last_ts, fast, slow, variance, loss_ewma) = _RECORD.unpack_from(self._map, offset)
+            if stored_id != job_id:
+                # Registro vazio ou de um job apagado com o mesmo id
+                flags = count = latency_count = fail_run = outcomes = losses = 0
+                last_ts = fast = slow = variance = loss_ewma = 0.0
+            elif timestamp < last_ts:
+                return flags
+
+            count += 1
+            outcomes = ((outcomes << 1) | (1 if success else 0)) & _WINDOW_MASK
+            fail_run = 0 if success else fail_run + 1
+
+            if success and response_time_ms is not None:
+                latency_count += 1
+                if latency_count == 1:
+                    fast = slow = float(response_time_ms)
+                else:
+                    fast += FAST_ALPHA * (response_time_ms - fast)
+                    diff = response_time_ms - slow
+                    increment = SLOW_ALPHA * diff
+                    slow += increment
+                    variance = (1 - SLOW_ALPHA) * (variance + diff * increment)
+                if latency_count >= LATENCY_WARMUP:
+                    threshold = max(slow + REGRESSION_SIGMAS * math.sqrt(variance), slow * REGRESSION_FACTOR)
+                    if fast > threshold:
+                        flags |= LATENCY_REGRESSION
+                    elif fast <= slow + REGRESSION_SIGMAS / 2 * math.sqrt(variance):
+                        flags &= ~LATENCY_REGRESSION
+
+            if packets_sent:
+                lost = max(packets_sent - (packets_received or 0), 0) / packets_sent
+                # Perda "intermitente": pacotes perdidos em checagens que passaram
+                losses = ((losses << 1) | (1 if success and lost > 0 else 0)) & _WINDOW_MASK
+                loss_ewma += SLOW_ALPHA * (lost - loss_ewma)
+                recent_losses = bin(losses).count('1')
+                if recent_losses >= LOSS_HIGH:
+                    flags |= INTERMITTENT_LOSS
+                elif recent_losses <= LOSS_LOW:
+                    flags &= ~INTERMITTENT_LOSS
+
+            if count >= FLAP_WINDOW:
+                rate = _transitions(outcomes, FLAP_WINDOW) / (FLAP_WINDOW - 1)
+                if rate >= FLAP_HIGH:
+                    flags |= FLAPPING
+                elif rate < FLAP_LOW:
+                    flags &= ~FLAPPING
+
+            _RECORD.pack_into(self._map, offset, job_id, flags, count, latency_count, fail_run,
+                              outcomes, losses, 0, timestamp, fast, slow, variance, loss_ewma)
+            return flags
+        finally:
+            self._unlock()
+
+    def forget(self, job_id):
+        self._lock()
+        try:
+            if job_id < self.capacity:
+                self._map[self._offset(job_id):self._offset(job_id) + _RECORD.size] = bytes(_RECORD.size)
+        finally:
+            self._unlock()
+
+    def records(self):
+        """Raw (job_id, record bytes) of every tracked job"""
+        self._lock()
+        try:
+            if _HEADER.unpack_from(self._map, 0)[2] != self.capacity:
+                self._remap()
+            data = self._map[_HEADER.size:]
+        finally:
+            self._unlock()
+        result = []
+        for offset in range(0, len(data), _RECORD.size):
+            job_id = struct.unpack_from('<I', data, offset)[0]
+            if job_id:
+                result.append((job_id, data[offset:offset + _RECORD.size]))
+        return result
+
+    def restore(self, records):
+        """Load checkpointed (job_id, record bytes); jobs already tracked are kept"""
+        self._lock()
+        try:
+            for job_id, record in records:
+                if len(record) != _RECORD.size:
+                    continue
+                self._ensure_capacity(job_id)
+                offset = self._offset(job_id)
+                if struct.unpack_from('<I', self._map, offset)[0] != job_id:
+                    self._map[offset:offset + _RECORD.size] = record
+        finally:
+            self._unlock()
+
+    def snapshot(self, job_ids=None):
+        """Readable state per job id: flags, latency levels, flap rate, loss"""
+        result = {}
+        wanted = set(job_ids) if job_ids is not None else None
+        for job_id, record in self.records():
+            if wanted is not None and job_id not in wanted:
+                continue
+            (_, flags, count, latency_count, fail_run, outcomes, losses, _,
+             last_ts, fast, slow, variance, loss_ewma) = _RECORD.unpack(record)
+            window = min(count, FLAP_WINDOW)
+            result[job_id] = {
+                'flags': flag_labels(flags),
+                'samples': count,
+                'failure_run': fail_run,
+                'flap_rate': round(_transitions(outcomes, window) / (window - 1), 3) if window > 1 else 0.0,
+                'latency_ms': round(fast, 3) if latency_count else None,
+                'baseline_ms': round(slow, 3) if latency_count else None,
+                'baseline_stddev_ms': round(math.sqrt(variance), 3) if latency_count else None,
+                'loss_pct': round(loss_ewma * 100, 2),
+                'recent_losses': bin(losses).count('1'),
+                'updated_at': datetime.utcfromtimestamp(last_ts).isoformat() if last_ts else None,
+            }
+        return result
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """This process' handle on the shared state, opened on first use (fork safe)
+
+    When the file had to be created it is filled from the last checkpoint,
+    which needs an application context.
+    """
+    global _state
+    if _state is not None and _state.pid == os.getpid():
+        return _state
+    with _state_lock:
+        if _state is None or _state.pid != os.getpid():
+            state = HealthState()
+            if state.fresh:
+                try:
+                    from app import db
+                    from models import JobHealth
+                    state.restore(db.session.query(JobHealth.job_id, JobHealth.state).all())
+                except Exception as e:
+                    logger.warning(f"Could not restore job health state: {str(e)}")
+            _state = state
+    return _state
+
+
+def observe_result(job_id, timestamp, success, response_time_ms=None,
+                   packets_sent=None, packets_received=None):
+    """Update the health state with an ingested result (never raises)
+
+    Takes plain values so the caller does not reload the committed JobResult.
+    """
+    try:
+        return get_state().observe(
+            int(job_id),
+            (timestamp - datetime(1970, 1, 1)).total_seconds(),
+            bool(success),
+            None if response_time_ms is None else float(response_time_ms),
+            None if packets_sent is None else int(packets_sent),
+            None if packets_received is None else int(packets_received),
+        )
+    except Exception as e:
+        logger.warning(f"Error updating health state of job {job_id}: {str(e)}")
+        return 0
+
+
+def observe_aggregate(job_id, window_end, count, successes, latency_avg_ms=None,
+                      packets_sent=None, packets_received=None):
+    """Update the health state with a window of a job in aggregate mode
+
+    The window counts as one check, failed if any of its checks failed.
+    """
+    return observe_result(job_id, window_end, successes == count, latency_avg_ms, packets_sent, packets_received)
+
+
+def checkpoint():
+    """Save every tracked record to the job_health table"""
+    from sqlalchemy.dialects.sqlite import insert
+    from app import db
+    from models import Job, JobHealth
+
+    records = get_state().records()
+    if not records:
+        return 0
+    existing = {job_id for (job_id,) in db.session.query(Job.id).all()}
+    now = datetime.utcnow()
+    rows = [
+        {'job_id': job_id, 'flags': struct.unpack_from('<I', record, 4)[0], 'state': record, 'updated_at': now}
+        for job_id, record in records if job_id in existing
+    ]
+    if rows:
+        statement = insert(JobHealth)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[JobHealth.job_id],
+            set_={'flags': statement.excluded.flags, 'state': statement.excluded.state,
+                  'updated_at': statement.excluded.updated_at},
+        ), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def health_snapshot(job_ids=None):
+    """State per job for pages; empty if the shared state is unavailable"""
+    try:
+        return get_state().snapshot(job_ids)
+    except Exception as e:
+        logger.warning(f"Error reading job health state: {str(e)}")
+        return {}
+
+
+def forget_job(job_id):
+    try:
+        get_state().forget(job_id)
+    except Exception as e:
+        logger.warning(f"Error clearing health state of job {job_id}: {str(e)}")
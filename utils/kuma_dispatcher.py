@@ -0,0 +1,297 @@
+"""Server-side Uptime Kuma push dispatcher.
+
+For probes in ``server`` Kuma push mode, the probe only reports results to the
+server and the pushes to each job's ``kuma_url`` are made here, off the
+request path:
+
+* one ``requests.Session`` (keep-alive pool) per Kuma host, and at most
+  ``KUMA_MAX_PER_HOST`` concurrent pushes to the same host;
+* a fixed number of sender threads (``KUMA_DISPATCH_WORKERS``);
+* failed pushes are retried with exponential backoff (``KUMA_MAX_RETRIES``);
+* only the latest status of a job is kept: a pending or retrying push is
+  dropped when a newer result for the same job arrives;
+* outcomes are written back to the ``kuma_success`` flag and ``kuma_error``
+  message of the result in batches by a single recorder thread.
+
+Results waiting for their push keep ``FLAG_KUMA_PENDING`` in ``job_results``,
+which is the queue: whichever process received a result only writes the row.
+One process, elected with a lock file like the maintenance runner, reads the
+pending rows every ``KUMA_POLL_INTERVAL`` seconds (default 1, through a
+partial index) and runs the dispatcher, so deduplication and the per-host
+limits hold across all gunicorn workers and the ingest listener. Pushes left
+by a leader that died or was recycled are picked up by the next one.
+"""
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import text
+
+from models import FLAG_KUMA_PENDING, FLAG_KUMA_SUCCESS, FLAG_SUCCESS
+from utils import metrics
+
+logger = logging.getLogger('uptime-monitor')
+
+SUPERSEDED_ERROR = 'Superseded by a newer status before it could be pushed'
+NO_URL_ERROR = 'Job has no Uptime Kuma URL'
+
+POLL_INTERVAL = float(os.environ.get('KUMA_POLL_INTERVAL', 1))
+
+# Resultados aguardando push, mais antigos primeiro em cada job (índice parcial ix_job_results_kuma_pending)
+PENDING_QUERY = text(
+    "SELECT r.job_id, r.timestamp, r.flags, r.response_time_us, m.text, j.kuma_url "
+    "FROM job_results r JOIN jobs j ON j.id = r.job_id "
+    "LEFT JOIN result_messages m ON m.id = r.error_id "
+    f"WHERE (r.flags & {FLAG_KUMA_PENDING}) != 0 "
+    "ORDER BY r.job_id, r.timestamp"
+)
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_runner = None
+
+
+def kuma_push_params(success, response_time_ms=None, error_message=None):
+    """Query parameters for an Uptime Kuma push, same format the probe uses"""
+    params = {
+        'status': 'up' if success else 'down',
+        'msg': error_message or ('OK' if success else 'Failed'),
+    }
+    if success and response_time_ms is not None:
+        params['ping'] = str(response_time_ms)
+    return params
+
+
+class _Push:
+    __slots__ = ('job_id', 'timestamp', 'url', 'params', 'attempt')
+
+    def __init__(self, job_id, timestamp, url, params):
+        self.job_id = job_id
+        self.timestamp = timestamp
+        self.url = url.split('?')[0]
+        self.params = params
+        self.attempt = 0
+
+
+class KumaDispatcher:
+    """Bounded, deduplicating, retrying pusher of job statuses to Uptime Kuma"""
+
+    def __init__(self, app, workers=8, per_host=4, max_retries=3, timeout=5, backoff=1.0):
+        self.app = app
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.pid = os.getpid()
+
+        self._latest = {}               # job_id -> _Push mais recente ainda não enviado
+        self._newest = {}               # job_id -> timestamp do resultado mais novo já recebido
+        self._tracked = set()           # (job_id, timestamp) recebidos e ainda pendentes no banco
+        self._queue = []                # heap de (quando, seq, _Push)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._sessions = {}
+        self._host_slots = {}
+        self._outcomes = []
+        self._outcomes_cond = threading.Condition()
+        self._stop = False
+
+        self._threads = [
+            threading.Thread(target=self._send_loop, name=f'kuma-dispatch-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        self._threads.append(threading.Thread(target=self._record_loop, name='kuma-recorder', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job_id, timestamp, kuma_url, params):
+        """Queue a push for the result identified by (job_id, timestamp)"""
+        push = _Push(job_id, timestamp, kuma_url or '', params)
+        rejected = []
+        with self._cond:
+            if (job_id, timestamp) in self._tracked:
+                return
+            self._tracked.add((job_id, timestamp))
+            if timestamp <= self._newest.get(job_id, -1):
+                # Chegou depois de um status mais novo do mesmo job: nunca enviar
+                rejected.append((push, SUPERSEDED_ERROR))
+            else:
+                self._newest[job_id] = timestamp
+                previous = self._latest.pop(job_id, None)
+                if previous is not None:
+                    rejected.append((previous, SUPERSEDED_ERROR))
+                if kuma_url:
+                    self._latest[job_id] = push
+                    heapq.heappush(self._queue, (time.monotonic(), next(self._seq), push))
+                    self._cond.notify()
+                else:
+                    rejected.append((push, NO_URL_ERROR))
+        for rejected_push, error in rejected:
+            self._record(rejected_push, False, error)
+
+    def poll(self, executor):
+        """Queue the pending results of every process (and the ones a previous leader left)"""
+        rows = executor.execute(PENDING_QUERY).fetchall()
+        with self._cond:
+            # Esquecer os resultados cujo desfecho já foi gravado
+            self._tracked &= {(row[0], row[1]) for row in rows}
+        for job_id, timestamp, flags, response_time_us, error, kuma_url in rows:
+            success = bool(flags & FLAG_SUCCESS)
+            response_time_ms = None if response_time_us is None else response_time_us / 1000
+            self.submit(job_id, timestamp, kuma_url, kuma_push_params(success, response_time_ms, error))
+        return len(rows)
+
+    def _next_push(self):
+        with self._cond:
+            while not self._stop:
+                if self._queue:
+                    due, _, push = self._queue[0]
+                    wait = due - time.monotonic()
+                    if wait <= 0:
+                        heapq.heappop(self._queue)
+                        if self._latest.get(push.job_id) is push:
+                            return push
+                        continue  # superado por um status mais novo
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._cond:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_host)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._sessions[host], self._host_slots[host]
+
+    def _send_loop(self):
+        while True:
+            push = self._next_push()
+            if push is None:
+                return
+            session, slots = self._host(push.url)
+            error = None
+            with slots:
+                try:
+                    response = session.get(push.url, params=push.params, timeout=self.timeout)
+                    if response.status_code != 200:
+                        error = f"HTTP Error {response.status_code}: {response.text[:200]}"
+                except Exception as e:
+                    error = f"Connection error: {str(e)}"
+
+            with self._cond:
+                if error and push.attempt < self.max_retries and self._latest.get(push.job_id) is push:
+                    push.attempt += 1
+                    delay = self.backoff * (2 ** (push.attempt - 1)) * random.uniform(0.8, 1.2)
+                    heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), push))
+                    self._cond.notify()
+                    continue
+                if self._latest.get(push.job_id) is push:
+                    del self._latest[push.job_id]
+            if error:
+                logger.warning(f"Error pushing job {push.job_id} status to Uptime Kuma: {error}")
+            self._record(push, error is None, error)
+
+    def _record(self, push, success, error):
+        metrics.kuma_pushes.inc('server', 'success' if success else 'failure')
+        with self._outcomes_cond:
+            self._outcomes.append({
+                'job_id': push.job_id,
+                'timestamp': push.timestamp,
+                'kuma_bits': FLAG_KUMA_SUCCESS if success else 0,
+                'kuma_error': error,
+            })
+            self._outcomes_cond.notify()
+
+    def _record_loop(self):
+        from app import db
+        from models import intern_message_id
+        while not self._stop:
+            with self._outcomes_cond:
+                while not self._outcomes and not self._stop:
+                    self._outcomes_cond.wait()
+            # Pequena espera para agrupar várias atualizações em uma transação
+            time.sleep(0.2)
+            with self._outcomes_cond:
+                batch, self._outcomes = self._outcomes, []
+            if not batch:
+                continue
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as conn:
+                        conn.execute(
+                            text("UPDATE job_results SET flags = (flags & :keep) | :kuma_bits, "
+                                 "kuma_error_id = :kuma_error_id "
+                                 "WHERE job_id = :job_id AND timestamp = :timestamp"),
+                            [{'job_id': item['job_id'], 'timestamp': item['timestamp'],
+                              'kuma_bits': item['kuma_bits'], 'keep': ~(FLAG_KUMA_SUCCESS | FLAG_KUMA_PENDING),
+                              'kuma_error_id': intern_message_id(conn, item['kuma_error'])} for item in batch],
+                        )
+            except Exception as e:
+                logger.error(f"Error recording Uptime Kuma push results: {str(e)}")
+                # Os resultados continuam pendentes no banco: tentar gravar de novo
+                with self._outcomes_cond:
+                    self._outcomes[:0] = batch
+                time.sleep(1)
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        with self._outcomes_cond:
+            self._outcomes_cond.notify_all()
+
+
+def get_dispatcher(app):
+    """Return this process' dispatcher, creating it on first use (fork safe)"""
+    global _dispatcher
+    if _dispatcher is not None and _dispatcher.pid == os.getpid():
+        return _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher.pid != os.getpid():
+            _dispatcher = KumaDispatcher(
+                app,
+                workers=int(os.environ.get('KUMA_DISPATCH_WORKERS', 8)),
+                per_host=int(os.environ.get('KUMA_MAX_PER_HOST', 4)),
+                max_retries=int(os.environ.get('KUMA_MAX_RETRIES', 3)),
+                timeout=float(os.environ.get('KUMA_TIMEOUT', 5)),
+            )
+    return _dispatcher
+
+
+def dispatch_task():
+    """Leader task: queue the results waiting for their Uptime Kuma push"""
+    from flask import current_app
+    from app import db
+    dispatcher = get_dispatcher(current_app._get_current_object())
+    with db.engine.connect() as conn:
+        dispatcher.poll(conn)
+
+
+def start_dispatch_runner(app):
+    """Compete for the dispatcher lock in this process (once); only the leader pushes"""
+    global _runner
+    if _runner is not None and _runner.is_alive():
+        return _runner
+    from app import db
+    from utils.maintenance import MaintenanceRunner, default_lock_path
+    with app.app_context():
+        lock_path = os.environ.get('KUMA_DISPATCH_LOCK_FILE') or default_lock_path(db.engine, 'kuma-dispatch')
+    _runner = MaintenanceRunner(
+        app, lock_path, poll_interval=int(os.environ.get('MAINTENANCE_POLL_INTERVAL', 15)),
+        tasks={'kuma_dispatch': (POLL_INTERVAL, dispatch_task)}, name='kuma-dispatch',
+    )
+    _runner.start()
+    return _runner
@@ -1,14 +1,26 @@
 from datetime import datetime, timedelta
 from app import db
-from models import JobResult, ProbeLog
+from models import Job, JobResult, JobResultAggregate, ProbeLog, to_epoch_us
+from utils import result_archive
+from sqlalchemy import text
 import logging
+import os
 from flask import current_app
 import time
 
 logger = logging.getLogger('uptime-monitor')
 
+def aggregate_retention_days():
+    """Days the windowed aggregates of jobs in aggregate mode are kept (they are not archived)"""
+    return int(os.environ.get('RESULT_AGGREGATE_RETENTION_DAYS', 90))
+
 def cleanup_old_logs():
-    """Remove logs older than 24 hours"""
+    """Archive job results and remove probe logs older than 24 hours
+
+    Job results go to the columnar archive (see utils/result_archive.py), or
+    are deleted when RESULT_ARCHIVE=off. Result aggregates are deleted after
+    aggregate_retention_days().
+    """
     try:
         start_time = time.time()
         # Verificar se estamos em um contexto de aplicação
@@ -23,25 +35,47 @@ def cleanup_old_logs():
         db.session.begin()
         
         # Fazer a remoção por lotes para reduzir o impacto no banco de dados
-        # Primeiro, obter os IDs dos registros que serão excluídos
-        job_results_ids = [r.id for r in JobResult.query.filter(JobResult.timestamp < cutoff_time).limit(10000).all()]
+        # job_results é agrupada por (job_id, timestamp): apagar por job é uma varredura
+        # de intervalo na chave primária, sem precisar buscar ids antes
+        job_ids = [job_id for (job_id,) in db.session.query(Job.id).all()]
         probe_logs_ids = [p.id for p in ProbeLog.query.filter(ProbeLog.timestamp < cutoff_time).limit(10000).all()]
         
-        # Remover em lotes para evitar sobrecarga do banco de dados
         job_results_count = 0
         probe_logs_count = 0
+        archive = result_archive.archive_enabled()
+        archive_root = result_archive.archive_dir(db.engine)
+        cutoff_us = to_epoch_us(cutoff_time)
+        aggregate_cutoff = datetime.utcnow() - timedelta(days=aggregate_retention_days())
+        aggregates_count = 0
         
-        # Remover JobResults em lotes de 1000
         batch_size = 1000
-        for i in range(0, len(job_results_ids), batch_size):
-            batch = job_results_ids[i:i+batch_size]
-            if batch:
-                JobResult.query.filter(JobResult.id.in_(batch)).delete(synchronize_session='fetch')
-                job_results_count += len(batch)
-                
-                # Fazer commit a cada lote para liberar a transação
-                db.session.commit()
-                db.session.begin()
+        jobs_per_batch = 50
+        if archive:
+            # Um job por vez: os arquivos são gravados sem transação aberta e cada job
+            # apaga suas linhas em uma transação curta (ver archive_job_results)
+            db.session.commit()
+            for job_id in job_ids:
+                job_results_count += result_archive.archive_job_results(
+                    db.session, archive_root, job_id, cutoff_us
+                )
+            db.session.begin()
+        
+        # Remover JobResults (sem arquivo) e agregados em lotes de 50 jobs por transação
+        for i in range(0, len(job_ids), jobs_per_batch):
+            for job_id in job_ids[i:i+jobs_per_batch]:
+                if not archive:
+                    job_results_count += JobResult.query.filter(
+                        JobResult.job_id == job_id,
+                        JobResult.timestamp < cutoff_time
+                    ).delete(synchronize_session=False)
+                aggregates_count += JobResultAggregate.query.filter(
+                    JobResultAggregate.job_id == job_id,
+                    JobResultAggregate.window_start < aggregate_cutoff
+                ).delete(synchronize_session=False)
+            
+            # Fazer commit a cada lote para liberar a transação
+            db.session.commit()
+            db.session.begin()
         
         # Remover ProbeLogs em lotes de 1000
         for i in range(0, len(probe_logs_ids), batch_size):
@@ -57,9 +91,13 @@ def cleanup_old_logs():
         # Commit final (se necessário)
         db.session.commit()
         
+        purge_unused_messages()
+        if archive:
+            result_archive.purge_archive(archive_root, set(job_ids), result_archive.retention_days())
+        
         end_time = time.time()
         duration = end_time - start_time
-        logger.info(f"Cleaned up {job_results_count} job results and {probe_logs_count} probe logs older than 24 hours in {duration:.2f} seconds")
+        logger.info(f"{'Archived' if archive else 'Cleaned up'} {job_results_count} job results, cleaned up {probe_logs_count} probe logs older than 24 hours and {aggregates_count} result aggregates in {duration:.2f} seconds")
         return job_results_count, probe_logs_count
     except Exception as e:
         logger.error(f"Error cleaning up old logs: {str(e)}")
@@ -68,3 +106,19 @@ def cleanup_old_logs():
         except:
             pass  # Ignore errors during rollback
         return 0, 0
+
+def purge_unused_messages(min_age_hours=24):
+    """Delete interned result messages no longer referenced by any job result
+
+    Only messages not interned for min_age_hours are removed, so ids still held
+    in a process' message cache (see models.MESSAGE_CACHE_TTL) stay valid.
+    """
+    cutoff = int(time.time() - min_age_hours * 3600)
+    result = db.session.execute(text("""
+        DELETE FROM result_messages
+        WHERE last_used < :cutoff
+          AND NOT EXISTS (SELECT 1 FROM job_results WHERE error_id = result_messages.id)
+          AND NOT EXISTS (SELECT 1 FROM job_results WHERE kuma_error_id = result_messages.id)
+    """), {'cutoff': cutoff})
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,180 @@
+"""Leader-elected maintenance runner.
+
+Background jobs (log cleanup, WAL checkpoints, job health checkpoints and any compaction tasks
+registered with ``register_task``) must run in exactly one process, no matter
+how ``run.py``, ``wsgi.py`` or gunicorn (with or without ``preload_app``)
+build the application. Every process that starts a ``MaintenanceRunner``
+competes for an exclusive ``flock`` on a lock file next to the database; the
+winner runs the tasks and the others keep retrying, so if the leader dies (or
+a worker is recycled) the kernel releases the lock and another process takes
+over within ``MAINTENANCE_POLL_INTERVAL`` seconds.
+
+``MAINTENANCE_MODE`` controls where it runs:
+
+* ``embedded`` (default): inside the web processes, as a daemon thread;
+* ``external``: web processes never run it; start ``python maintenance.py``
+  as its own process (with lowered CPU and IO priority);
+* ``off``: disabled.
+
+The same runner, with its own task set and lock file, elects the process that
+pushes server-side Uptime Kuma statuses (see ``utils/kuma_dispatcher.py``); it
+follows ``MAINTENANCE_MODE`` too, so with ``off`` those pushes stay pending.
+"""
+import ctypes
+import fcntl
+import logging
+import os
+import platform
+import tempfile
+import threading
+import time
+
+from utils import metrics
+
+logger = logging.getLogger('uptime-monitor')
+
+# Tarefas registradas: nome -> (intervalo em segundos, função executada no app context)
+TASKS = {}
+
+
+def register_task(name, interval, func):
+    """Register func to run every interval seconds in the maintenance leader"""
+    TASKS[name] = (interval, func)
+
+
+def maintenance_mode():
+    return os.environ.get('MAINTENANCE_MODE', 'embedded').lower()
+
+
+def default_lock_path(engine, role='maintenance'):
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and database not in (None, '', ':memory:'):
+        return f"{os.path.abspath(database)}.{role}.lock"
+    return os.path.join(tempfile.gettempdir(), f'uptime-{role}.lock')
+
+
+def lower_priority(nice=10):
+    """Best effort: lower CPU priority and move IO to the idle class (Linux)"""
+    try:
+        os.nice(nice)
+    except OSError as e:
+        logger.warning(f"Could not change CPU priority: {str(e)}")
+    syscall_numbers = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314}
+    number = syscall_numbers.get(platform.machine())
+    if number is None:
+        return
+    ioprio_class_idle, ioprio_who_process = 3, 1
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(number, ioprio_who_process, 0, ioprio_class_idle << 13) != 0:
+            logger.warning(f"Could not change IO priority: errno {ctypes.get_errno()}")
+    except Exception as e:
+        logger.warning(f"Could not change IO priority: {str(e)}")
+
+
+class MaintenanceRunner(threading.Thread):
+    """Run registered tasks (or the given ones) while holding the lock"""
+
+    def __init__(self, app, lock_path, poll_interval=15, tasks=None, name='maintenance'):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.tasks = TASKS if tasks is None else tasks
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self.is_leader = False
+        self._fd = None
+        self._next_run = {}
+        self._stop_event = threading.Event()
+
+    def try_acquire(self):
+        if self._fd is None:
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, str(os.getpid()).encode(), 0)
+        self.is_leader = True
+        # Não executar tudo imediatamente ao assumir, para não sobrecarregar o início
+        now = time.monotonic()
+        self._next_run = {name: now + interval for name, (interval, _) in self.tasks.items()}
+        logger.info(f"Process {os.getpid()} is now the {self.name} leader")
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+            finally:
+                self._fd = None
+                self.is_leader = False
+
+    def run_due_tasks(self):
+        now = time.monotonic()
+        for name, (interval, func) in list(self.tasks.items()):
+            next_run = self._next_run.setdefault(name, now + interval)
+            if now < next_run or self._stop_event.is_set():
+                continue
+            started = time.monotonic()
+            metrics.task_lag.observe(started - next_run, name)
+            try:
+                with self.app.app_context():
+                    func()
+            except Exception as e:
+                metrics.task_failures.inc(name)
+                logger.error(f"Error in maintenance task {name}: {str(e)}")
+            finally:
+                self._next_run[name] = time.monotonic() + interval
+            elapsed = time.monotonic() - started
+            metrics.task_duration.observe(elapsed, name)
+            logger.debug(f"Maintenance task {name} took {elapsed:.2f}s")
+
+    def _wait_time(self):
+        if not self.is_leader:
+            return self.poll_interval
+        soonest = min(self._next_run.values(), default=time.monotonic() + self.poll_interval)
+        return max(0.5, min(self.poll_interval, soonest - time.monotonic()))
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                if not self.is_leader:
+                    self.try_acquire()
+                if self.is_leader:
+                    self.run_due_tasks()
+                self._stop_event.wait(self._wait_time())
+        finally:
+            self.release()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def cleanup_task():
+    from utils.log_cleaner import cleanup_old_logs
+    cleanup_old_logs()
+
+
+def checkpoint_task():
+    from app import db
+    from utils.sqlite_profile import is_file_database, wal_checkpoint
+    if is_file_database(db.engine):
+        wal_checkpoint(db.engine)
+
+
+def health_checkpoint_task():
+    from utils.job_health import checkpoint
+    checkpoint()
+
+
+def pool_rebalance_task():
+    from utils.pool_assignment import rebalance
+    rebalance()
+
+
+register_task('cleanup_logs', int(os.environ.get('MAINTENANCE_CLEANUP_INTERVAL', 3600)), cleanup_task)
+register_task('wal_checkpoint', int(os.environ.get('SQLITE_CHECKPOINT_INTERVAL', 60)), checkpoint_task)
+register_task('job_health_checkpoint', int(os.environ.get('JOB_HEALTH_CHECKPOINT_INTERVAL', 60)), health_checkpoint_task)
+register_task('pool_rebalance', int(os.environ.get('POOL_REBALANCE_INTERVAL', 60)), pool_rebalance_task)
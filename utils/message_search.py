@@ -0,0 +1,141 @@
+"""Full-text search over failure messages.
+
+Error and Kuma error texts are interned in ``result_messages``, so the FTS5
+index (``result_messages_fts``, external content) only holds each distinct
+message once. Triggers keep it in sync when a message is interned and when
+the cleanup task purges unused ones. A search first resolves the matching
+message ids through the index, then reads the results of each message with
+the partial ``(error_id, timestamp)`` / ``(kuma_error_id, timestamp)``
+indexes, so the cost depends on the number of matches in the time range, not
+on the size of ``job_results``.
+
+When the SQLite build has no FTS5 the messages are matched with ``LIKE``
+(still only over the distinct messages).
+"""
+import heapq
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger('uptime-monitor')
+
+FIELDS = {
+    'error': 'error_id',
+    'kuma': 'kuma_error_id',
+}
+MAX_MESSAGES = 1000
+
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS result_messages_fts USING fts5("
+    "text, content='result_messages', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS result_messages_fts_insert AFTER INSERT ON result_messages BEGIN "
+    "INSERT INTO result_messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS result_messages_fts_delete AFTER DELETE ON result_messages BEGIN "
+    "INSERT INTO result_messages_fts (result_messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS result_messages_fts_update AFTER UPDATE OF text ON result_messages BEGIN "
+    "INSERT INTO result_messages_fts (result_messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO result_messages_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+
+class SearchError(ValueError):
+    """Raised for queries the index cannot parse"""
+
+
+def create_index(conn):
+    """Create the FTS5 table and triggers and index the existing messages"""
+    try:
+        for statement in FTS_DDL:
+            conn.execute(text(statement))
+    except OperationalError as e:
+        logger.warning(f"FTS5 not available, message search will use LIKE: {str(e)}")
+        return False
+    conn.execute(text("INSERT INTO result_messages_fts (result_messages_fts) VALUES ('rebuild')"))
+    return True
+
+
+def has_index(session):
+    return session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'result_messages_fts'"
+    )).first() is not None
+
+
+def fts_query(query, raw=False):
+    """User text -> FTS5 query: a phrase whose last word also matches as a prefix"""
+    if raw:
+        return query
+    words = re.findall(r'\w+', query)
+    if not words:
+        raise SearchError('Search text must contain at least one word')
+    return '"' + ' '.join(words) + '" *'
+
+
+def matching_messages(session, query, raw=False):
+    """{message id: text} for the messages matching query"""
+    if has_index(session):
+        statement = text("SELECT rowid, text FROM result_messages_fts WHERE result_messages_fts MATCH :query "
+                         "ORDER BY rank LIMIT :limit")
+        params = {'query': fts_query(query, raw), 'limit': MAX_MESSAGES}
+    else:
+        statement = text("SELECT id, text FROM result_messages WHERE text LIKE :query LIMIT :limit")
+        params = {'query': f'%{query}%', 'limit': MAX_MESSAGES}
+    try:
+        return dict(session.execute(statement, params).all())
+    except OperationalError as e:
+        raise SearchError(f'Invalid search: {e.orig}')
+
+
+def search_failures(session, query, start_us, end_us=None, probe_id=None, fields=('error', 'kuma'),
+                    raw=False, limit=100):
+    """Jobs and latest results whose messages match query in [start_us, end_us)
+
+    Returns ``{'jobs': [...], 'results': [...]}``; ``jobs`` aggregates per job
+    and field (matches, first/last timestamp in microseconds) and ``results``
+    holds the latest ``limit`` matches.
+    """
+    messages = matching_messages(session, query, raw)
+    if not messages:
+        return {'jobs': [], 'results': [], 'messages': 0}
+
+    scope = "r.timestamp >= :start"
+    params = {'start': start_us}
+    if end_us is not None:
+        scope += " AND r.timestamp < :end"
+        params['end'] = end_us
+    join = ''
+    if probe_id is not None:
+        join = ' JOIN jobs j ON j.id = r.job_id AND j.probe_id = :probe_id'
+        params['probe_id'] = probe_id
+
+    jobs, latest = [], []
+    for field in fields:
+        column = FIELDS[field]
+        found_ids = set()
+        for job_id, message_id, matches, first, last in session.execute(text(
+            f"SELECT r.job_id, r.{column}, count(*), min(r.timestamp), max(r.timestamp) "
+            f"FROM job_results r{join} "
+            f"WHERE r.{column} IN ({', '.join(str(int(i)) for i in messages)}) AND {scope} "
+            f"GROUP BY r.job_id, r.{column}"
+        ), params):
+            jobs.append({'job_id': job_id, 'field': field, 'message': messages[message_id],
+                         'matches': matches, 'first': first, 'last': last})
+            found_ids.add(message_id)
+
+        # Últimos resultados: leitura em ordem decrescente do índice de cada mensagem
+        statement = text(
+            f"SELECT r.timestamp, r.job_id, r.{column} FROM job_results r{join} "
+            f"WHERE r.{column} = :message_id AND {scope} ORDER BY r.timestamp DESC LIMIT :limit"
+        )
+        for message_id in found_ids:
+            for timestamp, job_id, found in session.execute(
+                statement, dict(params, message_id=message_id, limit=limit)
+            ):
+                latest.append((timestamp, job_id, field, messages[found]))
+
+    results = [
+        {'timestamp': timestamp, 'job_id': job_id, 'field': field, 'message': message}
+        for timestamp, job_id, field, message in heapq.nlargest(limit, latest)
+    ]
+    return {'jobs': jobs, 'results': results, 'messages': len(messages)}
@@ -0,0 +1,366 @@
+"""Prometheus metrics shared by every server process.
+
+Each process appends its series to its own mmap'd file in ``METRICS_DIR``
+(``/dev/shm/uptime-metrics`` when available): a series is defined once (key
+plus a float64 slot) and then updated in place, so a hot-path update is a dict
+lookup and a struct read/write under a thread lock -- no cross-process lock
+and no syscall. ``GET /metrics`` reads every file and sums the series. Files of
+exited processes are kept, so counters survive gunicorn recycling workers
+(``max_requests``); the directory is cleared when a process starts and no
+other live process owns a file (server restart).
+
+Only counters and histograms are stored; gauges (database and WAL size) are
+computed when the metrics are collected. ``METRICS_ENABLED=false`` turns every
+update into a no-op.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+logger = logging.getLogger('uptime-monitor')
+
+_MAGIC = b'UPMT'
+_VERSION = 1
+_HEADER = struct.Struct('<4sII')   # magic, versão, bytes usados
+_KEY = struct.Struct('<H')
+_VALUE = struct.Struct('<d')
+FILE_SIZE = 1 << 20
+FILE_SUFFIX = '.metrics'
+# Separadores internos da chave: nome, rótulos e limite do bucket
+_SEP, _LABEL_SEP = '\x1e', '\x1f'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TASK_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0)
+
+# Endpoint da requisição corrente, usado para atribuir as instruções SQL
+current_endpoint = ContextVar('metrics_endpoint', default='background')
+
+
+def metrics_enabled():
+    return os.environ.get('METRICS_ENABLED', 'true').lower() not in ('false', '0', 'no', 'off')
+
+
+ENABLED = metrics_enabled()
+
+
+def metrics_dir():
+    configured = os.environ.get('METRICS_DIR')
+    if configured:
+        return configured
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'uptime-metrics')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _ProcessFile:
+    """Append-only series table of one process"""
+
+    def __init__(self, directory):
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        self._reset_stale(directory)
+        self.path = os.path.join(directory, f'{self.pid}{FILE_SUFFIX}')
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, FILE_SIZE)
+            self._map = mmap.mmap(fd, FILE_SIZE)
+        finally:
+            os.close(fd)
+        self._used = _HEADER.size
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self._used)
+        # (métrica, valores dos rótulos) -> offsets dos valores no arquivo
+        self.series = {}
+        self._full = False
+
+    def _reset_stale(self, directory):
+        names = [name for name in os.listdir(directory) if name.endswith(FILE_SUFFIX)]
+        pids = [int(name[:-len(FILE_SUFFIX)]) for name in names if name[:-len(FILE_SUFFIX)].isdigit()]
+        if any(pid != self.pid and _pid_alive(pid) for pid in pids):
+            return
+        # Nenhum outro processo vivo: é um novo início do servidor
+        for name in names:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+    def allocate(self, key):
+        """Offset of a new float64 slot for key, or None when the file is full"""
+        encoded = key.encode('utf-8')
+        entry = _KEY.size + len(encoded)
+        entry += -entry % 8
+        if self._used + entry + _VALUE.size > FILE_SIZE:
+            if not self._full:
+                logger.warning(f"Metrics file {self.path} is full, new series are dropped")
+                self._full = True
+            return None
+        _KEY.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _KEY.size:self._used + _KEY.size + len(encoded)] = encoded
+        offset = self._used + entry
+        _VALUE.pack_into(self._map, offset, 0.0)
+        # O cabeçalho só avança depois da entrada completa: leitores nunca veem metade
+        self._used = offset + _VALUE.size
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self._used)
+        return offset
+
+    def add(self, offset, amount):
+        _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + amount)
+
+
+_file = None
+_file_lock = threading.Lock()
+
+
+def _process_file():
+    global _file
+    if _file is None or _file.pid != os.getpid():
+        # Processo novo (ou filho de um fork): arquivo próprio
+        _file = _ProcessFile(metrics_dir())
+    return _file
+
+
+def _clean(value):
+    return str(value).replace(_SEP, ' ').replace(_LABEL_SEP, ' ')
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def _key(self, label_values):
+        return self.name + _SEP + _LABEL_SEP.join(
+            f'{label}={_clean(value)}' for label, value in zip(self.labels, label_values))
+
+    def _slots(self, label_values):
+        """Slot offsets of this series in the process file (allocated on first use)"""
+        target = _process_file()
+        offsets = target.series.get((self.name, label_values))
+        if offsets is None:
+            offsets = [target.allocate(key) for key in self._slot_keys(self._key(label_values))]
+            offsets = target.series[(self.name, label_values)] = None if None in offsets else offsets
+        return target, offsets
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _slot_keys(self, key):
+        return [key]
+
+    def inc(self, *label_values, amount=1.0):
+        if not ENABLED:
+            return
+        try:
+            with _file_lock:
+                target, offsets = self._slots(label_values)
+                if offsets is not None:
+                    target.add(offsets[0], amount)
+        except Exception as e:
+            logger.debug(f"Error updating metric {self.name}: {str(e)}")
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _slot_keys(self, key):
+        # Buckets não cumulativos (um incremento por observação); o acúmulo é feito na leitura
+        return [key + _SEP + repr(bound) for bound in self.buckets] + [key + _SEP + '+Inf', key + _SEP + 'sum']
+
+    def observe(self, value, *label_values):
+        if not ENABLED:
+            return
+        try:
+            with _file_lock:
+                target, offsets = self._slots(label_values)
+                if offsets is not None:
+                    target.add(offsets[bisect_left(self.buckets, value)], 1.0)
+                    target.add(offsets[-1], value)
+        except Exception as e:
+            logger.debug(f"Error updating metric {self.name}: {str(e)}")
+
+
+REGISTRY = {}
+
+http_requests = Counter('uptime_http_requests_total', 'HTTP requests by endpoint, method and status',
+                        ('endpoint', 'method', 'status'))
+http_duration = Histogram('uptime_http_request_duration_seconds', 'HTTP request latency by endpoint',
+                          ('endpoint',))
+db_statements = Counter('uptime_db_statements_total', 'SQL statements executed, by endpoint', ('endpoint',))
+db_seconds = Counter('uptime_db_statement_seconds_total', 'Time spent in SQL statements, by endpoint',
+                     ('endpoint',))
+probe_results = Counter('uptime_probe_results_total', 'Job results ingested, by probe', ('probe',))
+kuma_pushes = Counter('uptime_kuma_pushes_total',
+                      'Uptime Kuma pushes by who pushed (probe or server) and outcome', ('mode', 'outcome'))
+task_duration = Histogram('uptime_maintenance_task_duration_seconds', 'Maintenance task run time',
+                          ('task',), TASK_BUCKETS)
+task_lag = Histogram('uptime_maintenance_task_lag_seconds', 'How late maintenance tasks start after being due',
+                     ('task',), TASK_BUCKETS)
+task_failures = Counter('uptime_maintenance_task_failures_total', 'Maintenance task runs that raised', ('task',))
+
+
+def record_result(probe_name, kuma_success=None):
+    """Count an ingested result (and the probe's own Kuma push outcome, when known)"""
+    probe_results.inc(probe_name)
+    if kuma_success is not None:
+        kuma_pushes.inc('probe', 'success' if kuma_success else 'failure')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = perf_counter() - started.pop()
+    endpoint = current_endpoint.get()
+    db_statements.inc(endpoint)
+    db_seconds.inc(endpoint, amount=elapsed)
+
+
+def instrument_engine(engine):
+    """Count and time the statements of engine (idempotent)"""
+    from sqlalchemy import event
+    if not ENABLED or event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app, engines=()):
+    """Time every request and the SQL statements it issues"""
+    from flask import g, request
+
+    for engine in engines:
+        instrument_engine(engine)
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_started = perf_counter()
+        g.metrics_token = current_endpoint.set(request.endpoint or 'unmatched')
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            http_duration.observe(perf_counter() - started, endpoint)
+            http_requests.inc(endpoint, request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _reset_endpoint(exception=None):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            current_endpoint.reset(token)
+
+
+def collect(directory=None):
+    """{key: summed value} over the files of every process"""
+    directory = directory or metrics_dir()
+    totals = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return totals
+    for name in names:
+        if not name.endswith(FILE_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        if len(data) < _HEADER.size:
+            continue
+        magic, version, used = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            continue
+        position = _HEADER.size
+        while position + _KEY.size <= used:
+            (length,) = _KEY.unpack_from(data, position)
+            key = data[position + _KEY.size:position + _KEY.size + length].decode('utf-8')
+            entry = _KEY.size + length
+            position += entry + (-entry % 8)
+            totals[key] = totals.get(key, 0.0) + _VALUE.unpack_from(data, position)[0]
+            position += _VALUE.size
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _render_labels(labels, extra=None):
+    pairs = [pair.split('=', 1) for pair in labels.split(_LABEL_SEP) if pair]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+def render(gauges=None):
+    """Prometheus text exposition of the summed series plus the given gauges
+
+    gauges is a list of (name, help, value).
+    """
+    totals = collect()
+    series = {}
+    for key, value in totals.items():
+        parts = key.split(_SEP)
+        labels = parts[1] if len(parts) > 1 else ''
+        series.setdefault(parts[0], {}).setdefault(labels, {})[parts[2] if len(parts) > 2 else None] = value
+
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, values in sorted(series.get(name, {}).items()):
+            if metric.kind == 'histogram':
+                cumulative = 0.0
+                for bound in metric.buckets:
+                    cumulative += values.get(repr(bound), 0.0)
+                    lines.append(f'{name}_bucket{_render_labels(labels, ("le", repr(bound)))} {_number(cumulative)}')
+                cumulative += values.get('+Inf', 0.0)
+                lines.append(f'{name}_bucket{_render_labels(labels, ("le", "+Inf"))} {_number(cumulative)}')
+                lines.append(f'{name}_sum{_render_labels(labels)} {_number(values.get("sum", 0.0))}')
+                lines.append(f'{name}_count{_render_labels(labels)} {_number(cumulative)}')
+            else:
+                lines.append(f'{name}{_render_labels(labels)} {_number(values.get(None, 0.0))}')
+    for name, help, value in gauges or ():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
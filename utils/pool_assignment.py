@@ -0,0 +1,158 @@
+"""Automatic placement of pool jobs on probes.
+
+A job with a ``pool`` is not pinned by hand: the server picks its probe among
+the active, online probes of that pool (``Probe.pool``; online means a
+heartbeat within ``POOL_PROBE_TIMEOUT`` seconds, default 180). Placement uses
+consistent hashing with bounded loads:
+
+* every probe owns points on a hash ring in proportion to its spare capacity
+  -- the capacity it reports in its heartbeat minus the demand of its pinned
+  jobs -- (``VNODES`` for an average probe), and a job goes to the first
+  probe clockwise from the job's hash that still has room;
+* "room" is the probe's share of the pool's demand (checks/s, ``1 / interval``)
+  in proportion to its spare capacity, plus ``LOAD_SLACK``.
+
+A probe joining or leaving only moves the jobs whose ring segment changes
+(about 1/N of them), and capacity changes only move the jobs at the edge of
+an overfull probe. ``rebalance`` runs as a maintenance task every
+``POOL_REBALANCE_INTERVAL`` seconds (and right after a pool job is saved); it
+rewrites ``jobs.probe_id`` for moved jobs and bumps ``config_version`` of the
+probes that lost or gained jobs.
+"""
+import hashlib
+import logging
+import os
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from statistics import median
+
+from sqlalchemy import func, update
+
+from app import db
+from models import Job, Probe
+from utils import metrics
+
+logger = logging.getLogger('uptime-monitor')
+
+VNODES = 64
+LOAD_SLACK = 0.25
+# Fração mínima da capacidade considerada livre, mesmo com jobs fixos acima dela
+MIN_SPARE_FRACTION = 0.05
+
+reassignments = metrics.Counter('uptime_pool_reassignments_total', 'Pool jobs moved to another probe', ('pool',))
+
+
+def probe_timeout():
+    return int(os.environ.get('POOL_PROBE_TIMEOUT', 180))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def spare_capacity(capacities, pinned_demand):
+    """probe id -> capacity left for pool jobs (checks/s)
+
+    Probes that never reported a capacity count as the median of the others
+    (or 1.0 when none did), so placement stays proportional.
+    """
+    known = [value for value in capacities.values() if value]
+    default = median(known) if known else 1.0
+    spare = {}
+    for probe_id, capacity in capacities.items():
+        capacity = capacity or default
+        spare[probe_id] = max(capacity - pinned_demand.get(probe_id, 0.0), capacity * MIN_SPARE_FRACTION)
+    return spare
+
+
+def assign(jobs, spare):
+    """{job id: probe id} for jobs [(job id, demand)] over probes {probe id: spare capacity}"""
+    if not spare:
+        return {}
+    # Pontos fixos por probe: a capacidade só acrescenta/remove pontos, sem mover os demais
+    mean_spare = sum(spare.values()) / len(spare)
+    ring = sorted((_hash(f'probe:{probe_id}:{replica}'), probe_id) for probe_id, value in spare.items()
+                  for replica in range(max(1, round(VNODES * value / mean_spare))))
+    points = [point for point, _ in ring]
+    total_demand = sum(demand for _, demand in jobs)
+    total_spare = sum(spare.values())
+    limit = {probe_id: (1 + LOAD_SLACK) * total_demand * value / total_spare for probe_id, value in spare.items()}
+    load = dict.fromkeys(spare, 0.0)
+
+    placement = {}
+    for job_id, demand in sorted(jobs):
+        start = bisect_left(points, _hash(f'job:{job_id}'))
+        chosen = None
+        for step in range(len(ring)):
+            probe_id = ring[(start + step) % len(ring)][1]
+            if load[probe_id] + demand <= limit[probe_id]:
+                chosen = probe_id
+                break
+        if chosen is None:
+            # Nenhum probe com folga (arredondamento): o de menor carga relativa
+            chosen = min(load, key=lambda probe_id: (load[probe_id] + demand) / spare[probe_id])
+        load[chosen] += demand
+        placement[job_id] = chosen
+    return placement
+
+
+def online_probes(pool, now=None):
+    """(id, capacity) of the active probes of pool with a recent heartbeat"""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=probe_timeout())
+    return db.session.query(Probe.id, Probe.capacity).filter(
+        Probe.pool == pool, Probe.is_active.is_(True), Probe.last_seen >= cutoff
+    ).all()
+
+
+def provisional_probe(pool):
+    """Some probe of pool to hold a new job until the pool is rebalanced, or None"""
+    probes = online_probes(pool)
+    if probes:
+        return min(probes)[0]
+    row = db.session.query(Probe.id).filter(Probe.pool == pool, Probe.is_active.is_(True)).order_by(Probe.id).first()
+    return row[0] if row else None
+
+
+def rebalance_pool(pool, now=None):
+    """Re-place the jobs of one pool; returns the number of jobs moved (not committed)"""
+    probes = online_probes(pool, now)
+    if not probes:
+        logger.warning(f"Pool {pool}: no online probes, keeping the current job assignments")
+        return 0
+    probe_ids = [probe_id for probe_id, _ in probes]
+    pinned = dict(db.session.query(Job.probe_id, func.sum(1.0 / Job.interval_seconds)).filter(
+        Job.probe_id.in_(probe_ids), Job.pool.is_(None), Job.is_active.is_(True)
+    ).group_by(Job.probe_id).all())
+    jobs = db.session.query(Job.id, Job.probe_id, Job.interval_seconds, Job.is_active).filter(Job.pool == pool).all()
+
+    # Jobs inativos ficam posicionados pelo hash, sem consumir capacidade
+    placement = assign([(job_id, 1.0 / interval if active else 0.0) for job_id, _, interval, active in jobs],
+                       spare_capacity(dict(probes), pinned))
+    moves = [(job_id, current, placement[job_id]) for job_id, current, _, _ in jobs if placement[job_id] != current]
+    if not moves:
+        return 0
+
+    db.session.execute(update(Job), [{'id': job_id, 'probe_id': new} for job_id, _, new in moves])
+    affected = {old for _, old, _ in moves} | {new for _, _, new in moves}
+    Probe.query.filter(Probe.id.in_(affected)).update(
+        {Probe.config_version: Probe.config_version + 1}, synchronize_session=False
+    )
+    reassignments.inc(pool, amount=len(moves))
+    logger.info(f"Pool {pool}: moved {len(moves)} of {len(jobs)} jobs across {len(probe_ids)} online probes")
+    return len(moves)
+
+
+def rebalance(pools=None):
+    """Rebalance the given pools (default: every pool with jobs) and commit"""
+    if pools is None:
+        pools = [pool for (pool,) in db.session.query(Job.pool).filter(Job.pool.isnot(None)).distinct()]
+    moved = 0
+    try:
+        for pool in pools:
+            if pool:
+                moved += rebalance_pool(pool)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return moved
@@ -0,0 +1,443 @@
+"""Probe ingest helpers shared by the Flask API and the asyncio fast path.
+
+* ``validate_result`` checks and normalizes a result payload (the same rules
+  for ``/api/probe/<key>/results`` on both servers); ``validate_batch`` does
+  the same for every item of a batch (``{"results": [...]}``, up to
+  ``MAX_BATCH_RESULTS``), whose results keep the time the probe checked them;
+  ``validate_aggregates`` checks the windowed aggregates of the same batch
+  (``{"aggregates": [...]}``) that jobs in aggregate mode upload instead;
+* ``ProbeCache`` maps API keys to the probe and its jobs with a short TTL, so
+  authenticating a result costs a dict lookup instead of two queries;
+* ``load_report`` validates the load section probes send in heartbeats;
+* ``result_row`` / ``aggregate_row`` / ``write_batch`` turn validated results
+  and aggregates into ``job_results`` and ``job_result_aggregates`` rows and
+  write a whole batch (results, aggregates, probe logs, ``last_seen`` and load
+  updates) with core ``executemany`` inserts in one transaction.
+
+Probe or job changes reach the cache within ``PROBE_CACHE_TTL`` seconds
+(default 30); the jobs endpoint always re-reads the probe.
+"""
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+
+from models import (EPOCH, JobResult, JobResultAggregate, Probe, ProbeLog, MAX_AGGREGATE_SECONDS, intern_message_id,
+                    pack_packets, result_flags, to_epoch_us, _message_ids)
+
+PROBE_QUERY = text("SELECT id, name, kuma_push_mode, config_version FROM probes "
+                   "WHERE api_key = :api_key AND is_active = 1")
+PROBE_JOBS_QUERY = text("SELECT id, kuma_url FROM jobs WHERE probe_id = :probe_id")
+JOBS_PAYLOAD_QUERY = text(
+    "SELECT id, name, job_type, target_host, port, http_method, expected_status, verify_tls, kuma_url, "
+    "interval_seconds, timeout_seconds, retries, priority, aggregate_seconds "
+    "FROM jobs WHERE probe_id = :probe_id AND is_active = 1"
+)
+LAST_SEEN_UPDATE = Probe.__table__.update().where(Probe.__table__.c.id == bindparam('probe_id')).values(
+    last_seen=bindparam('seen_at'))
+LOAD_UPDATE = Probe.__table__.update().where(Probe.__table__.c.id == bindparam('probe_id')).values(
+    overloaded=bindparam('overloaded'), utilization=bindparam('utilization'), capacity=bindparam('capacity'),
+    load_report=bindparam('load_report'), load_reported_at=bindparam('load_reported_at'))
+# Campos do relatório de carga guardados em probes.load_report
+LOAD_FIELDS = ('overloaded', 'policy', 'utilization', 'capacity', 'demand', 'slots', 'stretch_factor',
+               'skipped_jobs', 'schedule_lag_p95')
+
+# Uma chave desconhecida só provoca nova consulta ao job depois deste intervalo
+JOB_MISS_REFRESH = 1.0
+# Resultados aceitos em um único POST de lote
+MAX_BATCH_RESULTS = 500
+# Horários de check fora desta janela (relógio do probe errado) viram o horário de recebimento
+MAX_RESULT_AGE = timedelta(hours=1)
+
+
+class ValidationError(ValueError):
+    """Raised for result payloads that cannot be recorded"""
+
+
+def _optional_number(data, key, kind):
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValidationError(f'{key} must be a number')
+    return kind(value)
+
+
+def _optional_text(data, key):
+    value = data.get(key)
+    return None if value is None else str(value)
+
+
+def validate_result(data):
+    """Normalized copy of a result payload; raises ValidationError"""
+    if not data or not isinstance(data, dict) or 'job_id' not in data or 'success' not in data:
+        raise ValidationError('Invalid data format')
+    try:
+        job_id = int(data['job_id'])
+    except (TypeError, ValueError):
+        raise ValidationError('job_id must be an integer')
+    return {
+        'job_id': job_id,
+        'success': bool(data['success']),
+        'response_time_ms': _optional_number(data, 'response_time_ms', float),
+        'packets_sent': _optional_number(data, 'packets_sent', int),
+        'packets_received': _optional_number(data, 'packets_received', int),
+        'error_message': _optional_text(data, 'error_message'),
+        'kuma_success': bool(data.get('kuma_success', True)),
+        'kuma_error': _optional_text(data, 'kuma_error'),
+        'aggregated': bool(data.get('aggregated', False)),
+    }
+
+
+def is_batch(data):
+    return isinstance(data, dict) and ('results' in data or 'aggregates' in data)
+
+
+def _checked_at(data, key='timestamp'):
+    value = data.get(key)
+    if not isinstance(value, str):
+        return None
+    try:
+        checked_at = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    # Horário com fuso vira UTC ingênuo, como o resto do banco
+    if checked_at.tzinfo is not None:
+        checked_at = (checked_at - checked_at.utcoffset()).replace(tzinfo=None)
+    return checked_at
+
+
+def validate_batch(data):
+    """(results, errors) for a batch payload; raises ValidationError if the batch itself is invalid
+
+    Every valid item is normalized by validate_result and keeps its position in
+    ``index`` and the probe's check time in ``checked_at``; invalid items are
+    reported in errors as ``{'index': ..., 'message': ...}``.
+    """
+    items = data.get('results', [])
+    if not isinstance(items, list):
+        raise ValidationError('results must be a list')
+    if len(items) > MAX_BATCH_RESULTS:
+        raise ValidationError(f'At most {MAX_BATCH_RESULTS} results per batch')
+    results, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            result = validate_result(item)
+        except ValidationError as e:
+            errors.append({'index': index, 'message': str(e)})
+            continue
+        result['index'] = index
+        result['checked_at'] = _checked_at(item)
+        results.append(result)
+    return results, errors
+
+
+def _optional_latency(data, key):
+    value = _optional_number(data, key, float)
+    if value is not None and value < 0:
+        raise ValidationError(f'{key} cannot be negative')
+    return value
+
+
+def validate_aggregate(data):
+    """Normalized copy of a windowed aggregate; raises ValidationError"""
+    if not isinstance(data, dict) or not {'job_id', 'window_start', 'window_seconds', 'count'} <= data.keys():
+        raise ValidationError('Invalid aggregate format')
+    try:
+        job_id = int(data['job_id'])
+    except (TypeError, ValueError):
+        raise ValidationError('job_id must be an integer')
+    window_start = _checked_at(data, 'window_start')
+    if window_start is None:
+        raise ValidationError('window_start must be an ISO 8601 timestamp')
+    window_seconds = _optional_number(data, 'window_seconds', int)
+    if window_seconds is None or not 1 <= window_seconds <= MAX_AGGREGATE_SECONDS:
+        raise ValidationError(f'window_seconds must be between 1 and {MAX_AGGREGATE_SECONDS}')
+    count = _optional_number(data, 'count', int)
+    successes = _optional_number(data, 'successes', int) or 0
+    if count is None or count < 1 or not 0 <= successes <= count:
+        raise ValidationError('count must be positive and successes between 0 and count')
+    packets_sent = _optional_number(data, 'packets_sent', int)
+    packets_received = _optional_number(data, 'packets_received', int)
+    if (packets_sent or 0) < 0 or (packets_received or 0) < 0:
+        raise ValidationError('packet counts cannot be negative')
+    return {
+        'job_id': job_id,
+        'window_start': window_start,
+        'window_seconds': window_seconds,
+        'count': count,
+        'successes': successes,
+        'latency_min_ms': _optional_latency(data, 'latency_min_ms'),
+        'latency_avg_ms': _optional_latency(data, 'latency_avg_ms'),
+        'latency_max_ms': _optional_latency(data, 'latency_max_ms'),
+        'latency_p95_ms': _optional_latency(data, 'latency_p95_ms'),
+        'packets_sent': packets_sent,
+        'packets_received': packets_received,
+    }
+
+
+def validate_aggregates(data):
+    """(aggregates, errors) for the ``aggregates`` list of a batch, like validate_batch"""
+    items = data.get('aggregates', [])
+    if not isinstance(items, list):
+        raise ValidationError('aggregates must be a list')
+    if len(items) > MAX_BATCH_RESULTS:
+        raise ValidationError(f'At most {MAX_BATCH_RESULTS} aggregates per batch')
+    aggregates, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            aggregate = validate_aggregate(item)
+        except ValidationError as e:
+            errors.append({'index': index, 'message': str(e)})
+            continue
+        aggregate['index'] = index
+        aggregates.append(aggregate)
+    return aggregates, errors
+
+
+def window_start(aggregate, received_at):
+    """Window start to store: the probe's when plausible, else the window ending at received_at"""
+    start = aggregate['window_start']
+    length = timedelta(seconds=aggregate['window_seconds'])
+    if not received_at - MAX_RESULT_AGE - length <= start <= received_at:
+        return received_at - length
+    return start
+
+
+def result_time(result, received_at):
+    """Timestamp to store: the probe's check time when plausible, else received_at"""
+    checked_at = result.get('checked_at')
+    if checked_at is None or not received_at - MAX_RESULT_AGE <= checked_at <= received_at:
+        return received_at
+    return checked_at
+
+
+def _load_value(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return value if math.isfinite(value) else None
+    return str(value)[:32]
+
+
+def load_report(data, reported_at):
+    """probes column values for the ``load`` section of a heartbeat body, or None"""
+    load = data.get('load') if isinstance(data, dict) else None
+    if not isinstance(load, dict):
+        return None
+    report = {key: _load_value(load[key]) for key in LOAD_FIELDS if key in load}
+
+    def number(key):
+        value = report.get(key)
+        return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    return {
+        'overloaded': bool(report.get('overloaded')),
+        'utilization': number('utilization'),
+        'capacity': number('capacity'),
+        'load_report': json.dumps(report),
+        'load_reported_at': reported_at,
+    }
+
+
+def heartbeat_details(load):
+    """probe_logs details of a heartbeat"""
+    if load and load['overloaded']:
+        utilization = '?' if load['utilization'] is None else f"{load['utilization']:.2f}"
+        return f"Heartbeat received (overloaded, utilization {utilization})"
+    return "Heartbeat received"
+
+
+class ProbeInfo:
+    """Cached view of an active probe and the ids/Kuma URLs of its jobs"""
+    __slots__ = ('id', 'name', 'kuma_push_mode', 'config_version', 'jobs', 'loaded_at')
+
+    def __init__(self, id, name, kuma_push_mode, config_version, jobs, loaded_at):
+        self.id = id
+        self.name = name
+        self.kuma_push_mode = kuma_push_mode
+        self.config_version = config_version
+        self.jobs = jobs
+        self.loaded_at = loaded_at
+
+    @property
+    def server_push(self):
+        return self.kuma_push_mode == 'server'
+
+
+class ProbeCache:
+    """API key -> ProbeInfo (None for invalid keys) with a TTL"""
+
+    def __init__(self, ttl=None):
+        self.ttl = float(os.environ.get('PROBE_CACHE_TTL', 30) if ttl is None else ttl)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, executor, api_key):
+        row = executor.execute(PROBE_QUERY, {'api_key': api_key}).first()
+        if row is None:
+            return None
+        jobs = dict(executor.execute(PROBE_JOBS_QUERY, {'probe_id': row[0]}).all())
+        return ProbeInfo(row[0], row[1], row[2], row[3], jobs, time.monotonic())
+
+    def peek(self, api_key):
+        """(hit, info) without touching the database"""
+        entry = self._entries.get(api_key)
+        if entry is not None and entry[1] > time.monotonic():
+            return True, entry[0]
+        return False, None
+
+    def get(self, executor, api_key, refresh=False):
+        now = time.monotonic()
+        entry = self._entries.get(api_key)
+        if not refresh and entry is not None and entry[1] > now:
+            return entry[0]
+        info = self._load(executor, api_key)
+        with self._lock:
+            if len(self._entries) > 10000:
+                self._entries.clear()
+            self._entries[api_key] = (info, now + self.ttl)
+        return info
+
+    def job_url(self, executor, api_key, info, job_id):
+        """(found, kuma_url) for a job of the probe, reloading once for unknown ids"""
+        if job_id in info.jobs:
+            return True, info.jobs[job_id]
+        if time.monotonic() - info.loaded_at > JOB_MISS_REFRESH:
+            info = self.get(executor, api_key, refresh=True)
+            if info is not None and job_id in info.jobs:
+                return True, info.jobs[job_id]
+        return False, None
+
+    def invalidate(self, api_key=None):
+        with self._lock:
+            if api_key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(api_key, None)
+
+
+def jobs_payload(executor, info):
+    """Response body of /api/probe/<key>/jobs (same shape as the Flask route)"""
+    jobs = [{
+        'id': job_id,
+        'name': name,
+        'job_type': job_type,
+        'target_host': target_host,
+        'port': port,
+        'http_method': http_method,
+        'expected_status': expected_status,
+        'verify_tls': bool(verify_tls),
+        'kuma_url': kuma_url,
+        'interval_seconds': interval_seconds,
+        'timeout_seconds': timeout_seconds,
+        'retries': retries,
+        'priority': priority,
+        'aggregate_seconds': aggregate_seconds,
+        'kuma_push_mode': info.kuma_push_mode,
+    } for (job_id, name, job_type, target_host, port, http_method, expected_status, verify_tls, kuma_url,
+           interval_seconds, timeout_seconds, retries, priority, aggregate_seconds)
+        in executor.execute(JOBS_PAYLOAD_QUERY, {'probe_id': info.id})]
+    return {
+        'status': 'success',
+        'probe_id': info.id,
+        'probe_name': info.name,
+        'config_version': info.config_version,
+        'jobs': jobs,
+        'jobs_count': len(jobs),
+    }
+
+
+def result_row(result, timestamp_us, server_push):
+    """job_results row for a validated result; error texts are interned by write_batch"""
+    return {
+        'job_id': result['job_id'],
+        'timestamp': timestamp_us,
+        # No modo 'server' o status do Kuma é preenchido depois pelo dispatcher
+        'flags': result_flags(result['success'], None if server_push else result['kuma_success'],
+                              result['aggregated']),
+        'response_time_us': (None if result['response_time_ms'] is None
+                             else int(round(result['response_time_ms'] * 1000))),
+        'packets': pack_packets(result['packets_sent'], result['packets_received']),
+        'error': result['error_message'],
+        'kuma_error': None if server_push else result['kuma_error'],
+    }
+
+
+def _us(value_ms):
+    return None if value_ms is None else int(round(value_ms * 1000))
+
+
+def aggregate_row(aggregate, start):
+    """job_result_aggregates row for a validated aggregate starting at start (datetime)"""
+    return {
+        'job_id': aggregate['job_id'],
+        'window_start': to_epoch_us(start),
+        'window_seconds': aggregate['window_seconds'],
+        'count': aggregate['count'],
+        'successes': aggregate['successes'],
+        'latency_min_us': _us(aggregate['latency_min_ms']),
+        'latency_avg_us': _us(aggregate['latency_avg_ms']),
+        'latency_max_us': _us(aggregate['latency_max_ms']),
+        'latency_p95_us': _us(aggregate['latency_p95_ms']),
+        'packets_sent': aggregate['packets_sent'],
+        'packets_received': aggregate['packets_received'],
+    }
+
+
+def window_end(row):
+    """End of the window of an ``aggregate_row`` (naive UTC datetime)"""
+    return EPOCH + timedelta(microseconds=row['window_start'], seconds=row['window_seconds'])
+
+
+def log_row(probe_id, action, ip_address, details, timestamp):
+    return {'probe_id': probe_id, 'timestamp': timestamp, 'action': action,
+            'ip_address': ip_address, 'details': details}
+
+
+def write_rows(conn, results=(), logs=(), seen=None, loads=None, aggregates=()):
+    """Write a batch inside the transaction of conn; returns the number of results
+
+    results are ``result_row`` dicts, aggregates ``aggregate_row`` dicts, logs
+    ``log_row`` dicts, seen maps probe id -> last_seen and loads probe id ->
+    ``load_report`` values.
+    """
+    rows = [{
+        'job_id': row['job_id'],
+        'timestamp': row['timestamp'],
+        'flags': row['flags'],
+        'response_time_us': row['response_time_us'],
+        'packets': row['packets'],
+        'error_id': intern_message_id(conn, row['error']),
+        'kuma_error_id': intern_message_id(conn, row['kuma_error']),
+    } for row in results]
+    if rows:
+        # Dois resultados do mesmo job no mesmo microssegundo: mantém o primeiro
+        conn.execute(JobResult.__table__.insert().prefix_with('OR IGNORE'), rows)
+    if aggregates:
+        # Janela reenviada (upload repetido após um erro): mantém a primeira
+        conn.execute(JobResultAggregate.__table__.insert().prefix_with('OR IGNORE'), list(aggregates))
+    if logs:
+        conn.execute(ProbeLog.__table__.insert(), list(logs))
+    if seen:
+        conn.execute(LAST_SEEN_UPDATE, [{'probe_id': probe_id, 'seen_at': value}
+                                        for probe_id, value in seen.items()])
+    if loads:
+        conn.execute(LOAD_UPDATE, [dict(values, probe_id=probe_id) for probe_id, values in loads.items()])
+    return len(rows)
+
+
+def write_batch(engine, results=(), logs=(), seen=None, loads=None, aggregates=()):
+    """Write a batch in one transaction (see write_rows)"""
+    try:
+        with engine.begin() as conn:
+            return write_rows(conn, results, logs, seen, loads, aggregates)
+    except Exception:
+        # Mensagens inseridas nesta transação foram desfeitas
+        _message_ids.clear()
+        raise
+
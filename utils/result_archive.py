@@ -0,0 +1,329 @@
+"""Columnar archive of aged job results.
+
+Instead of being deleted after 24 hours, old ``job_results`` rows are moved to
+one file per job and UTC day (``<archive dir>/<job_id>/<YYYY-MM-DD>.col``).
+Each file stores the result columns as separately zlib-compressed arrays:
+
+* ``timestamp`` -- int64 microseconds, delta encoded (regular intervals
+  compress to almost nothing);
+* ``flags`` -- uint8 status bits (see ``models.FLAG_*``);
+* ``response_time_us`` / ``packets`` -- int64, ``-1`` for NULL;
+* ``error`` -- int32 index into the file's message table, ``-1`` for none.
+
+Files are memory-mapped on read and only the requested columns are
+decompressed, so a latency series never touches the error column. Writes go
+to a temporary file followed by ``os.replace``, so readers always see a
+complete file. ``iter_results`` and ``load_series`` combine the archive and the
+live table, callers do not need to know where the rows are.
+
+Settings: ``RESULT_ARCHIVE`` (``on``/``off``), ``RESULT_ARCHIVE_DIR`` (defaults
+to an ``archive`` directory next to the SQLite file) and
+``RESULT_ARCHIVE_RETENTION_DAYS`` (default 365, ``0`` keeps files forever).
+"""
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import text
+
+logger = logging.getLogger('uptime-monitor')
+
+MAGIC = b'UPRA'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHI')  # magic, versão, tamanho do cabeçalho JSON
+COLUMNS = {
+    'timestamp': 'q',
+    'flags': 'B',
+    'response_time_us': 'q',
+    'packets': 'q',
+    'error': 'i',
+}
+FILE_SUFFIX = '.col'
+EPOCH = datetime(1970, 1, 1)
+
+LIVE_COLUMNS = {
+    'timestamp': 'r.timestamp',
+    'flags': 'r.flags',
+    'response_time_us': 'r.response_time_us',
+    'packets': 'r.packets',
+    'error': 'm.text',
+}
+
+
+def archive_enabled():
+    return os.environ.get('RESULT_ARCHIVE', 'on').lower() not in ('off', 'false', '0', 'no')
+
+
+def retention_days():
+    return int(os.environ.get('RESULT_ARCHIVE_RETENTION_DAYS', 365))
+
+
+def archive_dir(engine):
+    configured = os.environ.get('RESULT_ARCHIVE_DIR')
+    if configured:
+        return configured
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and database not in (None, '', ':memory:'):
+        return os.path.join(os.path.dirname(os.path.abspath(database)), 'archive')
+    return os.path.join(tempfile.gettempdir(), 'uptime-archive')
+
+
+def _day_of(timestamp_us):
+    return (EPOCH + timedelta(microseconds=timestamp_us)).date()
+
+
+def day_path(root, job_id, day):
+    return os.path.join(root, str(int(job_id)), f'{day.isoformat()}{FILE_SUFFIX}')
+
+
+def _encode(name, values):
+    data = array(COLUMNS[name], values)
+    if name == 'timestamp':
+        data = array('q', np.diff(np.frombuffer(data, dtype=np.int64), prepend=0).tobytes())
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return zlib.compress(data.tobytes(), 6)
+
+
+def _decode(name, payload):
+    data = array(COLUMNS[name])
+    data.frombytes(zlib.decompress(payload))
+    if sys.byteorder != 'little':
+        data.byteswap()
+    if name == 'timestamp':
+        data = array('q', np.cumsum(np.frombuffer(data, dtype=np.int64)).tobytes())
+    return data
+
+
+def write_day(path, rows):
+    """Write rows (timestamp, flags, response_time_us, packets, error text) to path"""
+    messages = {}
+    columns = {name: [] for name in COLUMNS}
+    for timestamp, flags, response_time_us, packets, error in rows:
+        columns['timestamp'].append(timestamp)
+        columns['flags'].append(flags & 0xFF)
+        columns['response_time_us'].append(-1 if response_time_us is None else response_time_us)
+        columns['packets'].append(-1 if packets is None else packets)
+        columns['error'].append(-1 if error is None else messages.setdefault(error, len(messages)))
+
+    blocks, layout, offset = [], {}, 0
+    for name in COLUMNS:
+        block = _encode(name, columns[name])
+        layout[name] = [offset, len(block)]
+        blocks.append(block)
+        offset += len(block)
+    header = json.dumps({
+        'rows': len(rows),
+        'columns': layout,
+        'messages': list(messages),
+    }).encode('utf-8')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def read_day(path, columns=None):
+    """Read the given columns of an archive file (memory-mapped)
+
+    Returns a dict of arrays, plus ``messages`` (the error texts indexed by
+    the ``error`` column).
+    """
+    wanted = list(columns or COLUMNS)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, header_size = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a result archive (version {FORMAT_VERSION})')
+        header = json.loads(mm[HEADER.size:HEADER.size + header_size])
+        base = HEADER.size + header_size
+        view = memoryview(mm)
+        try:
+            result = {}
+            for name in wanted:
+                offset, size = header['columns'][name]
+                result[name] = _decode(name, view[base + offset:base + offset + size])
+        finally:
+            view.release()
+    result['messages'] = header['messages']
+    return result
+
+
+def _read_rows(path):
+    data = read_day(path)
+    messages = data['messages']
+    return [
+        (timestamp, flags,
+         None if response_time_us < 0 else response_time_us,
+         None if packets < 0 else packets,
+         None if error < 0 else messages[error])
+        for timestamp, flags, response_time_us, packets, error in zip(
+            data['timestamp'], data['flags'], data['response_time_us'], data['packets'], data['error'])
+    ]
+
+
+def append_rows(root, job_id, rows):
+    """Merge rows into the job's day files; rows already archived are kept once"""
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(_day_of(row[0]), []).append(row)
+    for day, day_rows in by_day.items():
+        path = day_path(root, job_id, day)
+        merged = {row[0]: row for row in (_read_rows(path) if os.path.exists(path) else [])}
+        merged.update((row[0], row) for row in day_rows)
+        write_day(path, [merged[timestamp] for timestamp in sorted(merged)])
+    return len(rows)
+
+
+def _live_query(columns, start_us, end_us):
+    select = ', '.join(LIVE_COLUMNS[name] for name in columns)
+    join = ' LEFT JOIN result_messages m ON m.id = r.error_id' if 'error' in columns else ''
+    where = 'r.job_id = :job_id AND r.timestamp >= :start'
+    if end_us is not None:
+        where += ' AND r.timestamp < :end'
+    return text(f"SELECT {select} FROM job_results r{join} WHERE {where} ORDER BY r.timestamp")
+
+
+def archive_job_results(session, root, job_id, cutoff_us):
+    """Move the job's results older than cutoff_us to the archive
+
+    Commits the session: the files are written while no transaction is open
+    and the rows are then deleted in a short transaction of their own, so the
+    ingest writers never wait for archive I/O.
+    """
+    rows = session.execute(
+        _live_query(list(COLUMNS), 0, cutoff_us), {'job_id': job_id, 'start': 0, 'end': cutoff_us}
+    ).fetchall()
+    session.commit()
+    if not rows:
+        return 0
+    # Os arquivos são gravados (fsync) antes de apagar: uma falha no meio só gera
+    # linhas repetidas, que append_rows deduplica na próxima execução
+    append_rows(root, job_id, [tuple(row) for row in rows])
+    session.execute(
+        text("DELETE FROM job_results WHERE job_id = :job_id AND timestamp <= :last"),
+        {'job_id': job_id, 'last': rows[-1][0]},
+    )
+    session.commit()
+    return len(rows)
+
+
+def _archived_days(root, job_id, start_us, end_us):
+    directory = os.path.join(root, str(int(job_id)))
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    # Nomes ISO (AAAA-MM-DD) ordenam como datas
+    first = _day_of(start_us).isoformat()
+    last = _day_of(end_us - 1).isoformat() if end_us is not None else None
+    return [
+        os.path.join(directory, name) for name in names
+        if name.endswith(FILE_SUFFIX) and len(name) == 10 + len(FILE_SUFFIX)
+        and name[:10] >= first and (last is None or name[:10] <= last)
+    ]
+
+
+def _slice(timestamps, start_us, end_us):
+    low = bisect_left(timestamps, start_us)
+    high = len(timestamps) if end_us is None else bisect_left(timestamps, end_us)
+    return low, high
+
+
+def iter_results(session, root, job_id, start_us=0, end_us=None, batch_size=1000):
+    """Yield (timestamp_us, flags, response_time_us, packets, error) in time order
+
+    Archived days come first, then the live table (rows already yielded from
+    the archive are skipped).
+    """
+    last = -1
+    for path in _archived_days(root, job_id, start_us, end_us):
+        rows = _read_rows(path)
+        low, high = _slice([row[0] for row in rows], start_us, end_us)
+        for row in rows[low:high]:
+            yield row
+            last = row[0]
+    query = _live_query(list(COLUMNS), max(start_us, last + 1), end_us)
+    params = {'job_id': job_id, 'start': max(start_us, last + 1), 'end': end_us}
+    result = session.execute(query.execution_options(yield_per=batch_size), params)
+    for row in result:
+        yield tuple(row)
+
+
+def read_range(root, job_id, start_us=0, end_us=None, columns=('timestamp',)):
+    """Yield the given columns (arrays) of each archived day, sliced to the range
+
+    ``columns`` must include ``timestamp``.
+    """
+    for path in _archived_days(root, job_id, start_us, end_us):
+        data = read_day(path, columns)
+        low, high = _slice(data['timestamp'], start_us, end_us)
+        if high > low:
+            yield {name: data[name][low:high] for name in columns}
+
+
+def load_series(session, root, job_id, start_us=0, end_us=None):
+    """Timestamp, flags and latency columns for a job over a time range
+
+    Returns a dict of arrays (``response_time_us`` uses -1 for NULL). Only
+    those three columns are read from the archive files.
+    """
+    names = ('timestamp', 'flags', 'response_time_us')
+    series = {name: array(COLUMNS[name]) for name in names}
+    for data in read_range(root, job_id, start_us, end_us, names):
+        for name in names:
+            series[name].extend(data[name])
+    start = max(start_us, series['timestamp'][-1] + 1) if series['timestamp'] else start_us
+    rows = session.execute(_live_query(names, start, end_us),
+                           {'job_id': job_id, 'start': start, 'end': end_us})
+    for timestamp, flags, response_time_us in rows:
+        series['timestamp'].append(timestamp)
+        series['flags'].append(flags & 0xFF)
+        series['response_time_us'].append(-1 if response_time_us is None else response_time_us)
+    return series
+
+
+def remove_job_archive(root, job_id):
+    shutil.rmtree(os.path.join(root, str(int(job_id))), ignore_errors=True)
+
+
+def purge_archive(root, job_ids, retention):
+    """Delete day files past the retention and directories of deleted jobs"""
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    oldest = (datetime.utcnow() - timedelta(days=retention)).date().isoformat() if retention > 0 else None
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+        if not name.isdigit() or not os.path.isdir(directory):
+            continue
+        if int(name) not in job_ids:
+            shutil.rmtree(directory, ignore_errors=True)
+            continue
+        for filename in os.listdir(directory):
+            # Nomes ISO ordenam como datas
+            if oldest and filename.endswith(FILE_SUFFIX) and filename[:-len(FILE_SUFFIX)] < oldest:
+                os.unlink(os.path.join(directory, filename))
+                removed += 1
+    return removed
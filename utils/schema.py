@@ -0,0 +1,258 @@
+"""Versioned schema management.
+
+Process start used to issue speculative ``ALTER TABLE`` statements (which
+normally fail and roll back) followed by ``db.create_all()``. Instead, the
+current version is kept in the ``schema_version`` table: when it matches
+``SCHEMA_VERSION`` startup costs a single ``SELECT``. Otherwise the process
+takes a file lock, creates missing tables and runs the pending migrations.
+
+A database whose version is newer than ``SCHEMA_VERSION`` (written by a newer
+release) is refused: running older code on it could corrupt the new layout.
+
+Migrations must be idempotent (use the helpers below) because a fresh database
+gets ``create_all()`` with the current models and then every migration.
+To change the schema, append a function to ``MIGRATIONS``.
+"""
+import fcntl
+import logging
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+logger = logging.getLogger('uptime-monitor')
+
+
+def column_exists(conn, table, column):
+    rows = conn.execute(text(f"PRAGMA table_info({table})")).fetchall()
+    return any(row[1] == column for row in rows)
+
+
+def add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN only when the column is missing"""
+    if not column_exists(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        logger.info(f"Added {column} column to {table} table")
+
+
+def _001_user_lockout_columns(conn):
+    add_column(conn, 'users', 'failed_login_attempts', 'INTEGER DEFAULT 0')
+    add_column(conn, 'users', 'last_failed_login', 'TIMESTAMP')
+    add_column(conn, 'users', 'locked_until', 'TIMESTAMP')
+
+
+def _002_probe_kuma_push_mode(conn):
+    add_column(conn, 'probes', 'kuma_push_mode', "VARCHAR(10) NOT NULL DEFAULT 'probe'")
+
+
+def _003_probe_config_version(conn):
+    add_column(conn, 'probes', 'config_version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def _004_compact_job_results(conn):
+    """Rewrite job_results into the compact WITHOUT ROWID layout"""
+    if not column_exists(conn, 'job_results', 'id'):
+        return  # banco novo: create_all já criou o layout compacto
+    from models import JobResult, _message_hash
+
+    def column(name):
+        return name if column_exists(conn, 'job_results_old', name) else 'NULL'
+
+    conn.execute(text("ALTER TABLE job_results RENAME TO job_results_old"))
+    JobResult.__table__.create(conn)
+
+    # Internar as mensagens distintas (o hash é calculado em Python)
+    conn.execute(text("CREATE TEMP TABLE message_map (text TEXT PRIMARY KEY, id INTEGER)"))
+    texts = set()
+    for name in ('error_message', 'kuma_error'):
+        if column(name) != 'NULL':
+            texts.update(row[0] for row in conn.execute(text(
+                f"SELECT DISTINCT {name} FROM job_results_old WHERE {name} IS NOT NULL")))
+    for value in texts:
+        conn.execute(text(
+            "INSERT INTO result_messages (hash, text, last_used) VALUES (:hash, :text, strftime('%s','now')) "
+            "ON CONFLICT (hash) DO NOTHING"
+        ), {'hash': _message_hash(value), 'text': value})
+        conn.execute(text(
+            "INSERT OR IGNORE INTO message_map (text, id) SELECT :text, id FROM result_messages WHERE hash = :hash"
+        ), {'hash': _message_hash(value), 'text': value})
+
+    # Timestamps 'YYYY-MM-DD HH:MM:SS[.ffffff]' -> microssegundos exatos
+    timestamp_us = (
+        "CAST(strftime('%s', substr(o.timestamp, 1, 19)) AS INTEGER) * 1000000"
+        " + CAST(substr(substr(o.timestamp, 21) || '000000', 1, 6) AS INTEGER)"
+    )
+    sent, received = column('packets_sent'), column('packets_received')
+
+    def copy(timestamp, where, params=None):
+        return conn.execute(text(f"""
+            INSERT OR IGNORE INTO job_results
+                (job_id, timestamp, flags, response_time_us, packets, error_id, kuma_error_id)
+            SELECT o.job_id, {timestamp},
+                   (CASE WHEN o.success THEN 1 ELSE 0 END)
+                   -- kuma_success NULL no esquema antigo = status desconhecido, nunca pendente
+                   | (CASE WHEN coalesce({column('kuma_success')}, 1) THEN 2 ELSE 0 END),
+                   CAST(ROUND({column('response_time_ms')} * 1000) AS INTEGER),
+                   CASE WHEN {sent} IS NULL AND {received} IS NULL THEN NULL
+                        ELSE (min(coalesce({sent}, 65535), 65535) << 16) | min(coalesce({received}, 65535), 65535) END,
+                   e.id, k.id
+            FROM job_results_old o
+            LEFT JOIN message_map e ON e.text = {column('error_message')}
+            LEFT JOIN message_map k ON k.text = {column('kuma_error')}
+            WHERE {where}
+        """), params or {}).rowcount
+
+    # Resultados do mesmo job no mesmo microssegundo colidem na chave primária nova:
+    # o primeiro fica, os demais vão para o próximo microssegundo livre do job
+    conn.execute(text(f"""
+        CREATE TEMP TABLE moved_results AS
+        SELECT id, job_id, ts FROM (
+            SELECT o.id, o.job_id, {timestamp_us} AS ts,
+                   ROW_NUMBER() OVER (PARTITION BY o.job_id, {timestamp_us} ORDER BY o.id) AS n
+            FROM job_results_old o WHERE o.timestamp IS NOT NULL)
+        WHERE n > 1
+    """))
+    total = conn.execute(text("SELECT COUNT(*) FROM job_results_old")).scalar()
+    migrated = copy(timestamp_us, "o.timestamp IS NOT NULL AND o.id NOT IN (SELECT id FROM moved_results)")
+    moved = conn.execute(text("SELECT id, job_id, ts FROM moved_results ORDER BY job_id, ts, id")).fetchall()
+    for old_id, job_id, timestamp in moved:
+        while conn.execute(text("SELECT 1 FROM job_results WHERE job_id = :job_id AND timestamp = :timestamp"),
+                           {'job_id': job_id, 'timestamp': timestamp}).first():
+            timestamp += 1
+        migrated += copy(':timestamp', 'o.id = :id', {'timestamp': timestamp, 'id': old_id})
+    conn.execute(text("DROP TABLE moved_results"))
+    if moved:
+        logger.warning(f"{len(moved)} job results shared their job and timestamp with another result; "
+                       f"moved them to the next free microsecond")
+    if migrated != total:
+        logger.warning(f"{total - migrated} of {total} job results had no timestamp or job and were not migrated")
+    conn.execute(text("DROP TABLE message_map"))
+    conn.execute(text("DROP TABLE job_results_old"))
+
+
+def _005_job_health(conn):
+    from models import JobHealth
+    JobHealth.__table__.create(conn, checkfirst=True)
+
+
+def _006_message_search(conn):
+    """FTS5 index over result messages; Kuma error index also ordered by time"""
+    from utils.message_search import create_index
+    conn.execute(text("DROP INDEX IF EXISTS ix_job_results_kuma_error_id"))
+    conn.execute(text("CREATE INDEX ix_job_results_kuma_error_id ON job_results (kuma_error_id, timestamp) "
+                      "WHERE kuma_error_id IS NOT NULL"))
+    create_index(conn)
+
+
+def _007_probe_load_and_job_priority(conn):
+    add_column(conn, 'jobs', 'priority', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'probes', 'overloaded', 'BOOLEAN NOT NULL DEFAULT 0')
+    add_column(conn, 'probes', 'utilization', 'FLOAT')
+    add_column(conn, 'probes', 'capacity', 'FLOAT')
+    add_column(conn, 'probes', 'load_report', 'TEXT')
+    add_column(conn, 'probes', 'load_reported_at', 'TIMESTAMP')
+
+
+def _008_probe_pools(conn):
+    add_column(conn, 'probes', 'pool', 'VARCHAR(64)')
+    add_column(conn, 'jobs', 'pool', 'VARCHAR(64)')
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_probes_pool ON probes (pool)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_pool ON jobs (pool)"))
+
+
+def _009_job_check_types(conn):
+    add_column(conn, 'jobs', 'port', 'INTEGER')
+    add_column(conn, 'jobs', 'http_method', 'VARCHAR(8)')
+    add_column(conn, 'jobs', 'expected_status', 'VARCHAR(64)')
+    add_column(conn, 'jobs', 'verify_tls', 'BOOLEAN NOT NULL DEFAULT 1')
+
+
+def _010_result_aggregates(conn):
+    from models import JobResultAggregate
+    add_column(conn, 'jobs', 'aggregate_seconds', 'INTEGER')
+    JobResultAggregate.__table__.create(conn, checkfirst=True)
+
+
+
+def _011_kuma_pending_index(conn):
+    """Partial index over the results waiting for a server-side Kuma push"""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_job_results_kuma_pending ON job_results (job_id, timestamp) "
+                      "WHERE (flags & 4) != 0"))
+
+
+MIGRATIONS = [
+    _001_user_lockout_columns,
+    _002_probe_kuma_push_mode,
+    _003_probe_config_version,
+    _004_compact_job_results,
+    _005_job_health,
+    _006_message_search,
+    _007_probe_load_and_job_priority,
+    _008_probe_pools,
+    _009_job_check_types,
+    _010_result_aggregates,
+    _011_kuma_pending_index,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def current_version(conn):
+    try:
+        return conn.execute(text("SELECT version FROM schema_version")).scalar()
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+def _check_not_newer(version):
+    if version is not None and version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this release supports "
+                           f"({SCHEMA_VERSION}); upgrade the application instead")
+
+
+@contextmanager
+def _migration_lock(engine):
+    """Serialize migrations between processes sharing the same SQLite file"""
+    database = engine.url.database
+    if engine.dialect.name != 'sqlite' or database in (None, '', ':memory:'):
+        yield
+        return
+    fd = os.open(f"{os.path.abspath(database)}.migrate.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def ensure_schema(db):
+    """Bring the database up to SCHEMA_VERSION; returns the version found at start"""
+    import models  # noqa: F401 -- registra as tabelas no metadata
+
+    engine = db.engine
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version == SCHEMA_VERSION:
+        return version
+    _check_not_newer(version)
+
+    with _migration_lock(engine):
+        with engine.begin() as conn:
+            # Outro processo pode ter migrado enquanto esperávamos o lock
+            version = current_version(conn)
+            if version == SCHEMA_VERSION:
+                return version
+            _check_not_newer(version)
+            if version is None:
+                conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+            db.metadata.create_all(conn)
+            for number, migration in enumerate(MIGRATIONS, start=1):
+                if version is None or number > version:
+                    logger.info(f"Applying schema migration {number}: {migration.__name__}")
+                    migration(conn)
+            conn.execute(text("DELETE FROM schema_version"))
+            conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"),
+                         {'version': SCHEMA_VERSION})
+        logger.info(f"Database schema upgraded from version {version} to {SCHEMA_VERSION}")
+    return version
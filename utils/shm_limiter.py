@@ -0,0 +1,262 @@
+"""Shared-memory storage backend for Flask-Limiter.
+
+The default ``memory://`` storage keeps one set of counters per process, so
+with several gunicorn workers every limit is effectively multiplied by the
+worker count. This backend keeps the counters in a fixed-size hash table inside
+an mmap'd file (``/dev/shm`` when available), shared by every process on the
+host. Updates are serialized with ``flock`` on the file plus a thread lock, so
+each hit costs a hash, a couple of struct reads/writes and one lock round trip.
+
+``flock`` locks belong to the open file description, which a forked child
+shares with its parent (gunicorn creates the storage in the master with
+``preload_app``), so each process reopens the file on its first access.
+
+Usage::
+
+    Limiter(storage_uri="shm:///dev/shm/uptime-ratelimit", ...)
+
+The path is optional (``shm://`` uses the default location).
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from math import floor
+from urllib.parse import urlparse
+
+from limits.storage.base import (
+    SlidingWindowCounterSupport,
+    Storage,
+    TimestampedSlidingWindow,
+)
+
+_MAGIC = b'UPRL'
+_VERSION = 1
+_HEADER = struct.Struct('<4sII')       # magic, version, number of slots
+_SLOT = struct.Struct('<Qqd')          # key hash, counter, expiry (epoch seconds)
+_MAX_PROBE = 8                         # slots inspected before evicting
+
+_reopen_lock = threading.Lock()
+
+
+def default_storage_path():
+    """Location of the shared counters file when the URI does not set one"""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'uptime-ratelimit')
+
+
+def _key_hash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    # 0 marks an empty slot
+    return int.from_bytes(digest, 'little') or 1
+
+
+class SharedMemoryStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """Cross-process fixed/sliding window counters in an mmap'd file"""
+
+    STORAGE_SCHEME = ['shm']
+
+    def __init__(self, uri=None, wrap_exceptions=False, slots=65536, **options):
+        parsed = urlparse(uri or 'shm://')
+        self.path = parsed.path or default_storage_path()
+        self.slots = int(slots)
+        self._thread_lock = threading.Lock()
+        self._open()
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    def _open(self):
+        size = _HEADER.size + self.slots * _SLOT.size
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0)
+            valid = False
+            if len(header) == _HEADER.size:
+                magic, version, slots = _HEADER.unpack(header)
+                valid = magic == _MAGIC and version == _VERSION and slots == self.slots
+            if not valid or os.fstat(self._fd).st_size != size:
+                # Novo arquivo (ou layout incompatível): recriar a tabela zerada
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, _VERSION, self.slots), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_fd', '_map', '_thread_lock', '_pid'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_lock = threading.Lock()
+        self._open()
+
+    # Low level helpers -------------------------------------------------
+
+    def _reopen_after_fork(self):
+        """Own file description (and map) for this process"""
+        if self._pid == os.getpid():
+            return
+        with _reopen_lock:
+            if self._pid != os.getpid():
+                # Descritor herdado do pai: fechar só a cópia do filho
+                self._map.close()
+                os.close(self._fd)
+                self._thread_lock = threading.Lock()
+                self._open()
+
+    def _lock(self):
+        self._reopen_after_fork()
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._thread_lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _offset(self, index):
+        return _HEADER.size + index * _SLOT.size
+
+    def _find(self, key, now, create=False):
+        """Return (offset, count, expiry) for key; offset is None if absent"""
+        key_hash = _key_hash(key)
+        start = key_hash % self.slots
+        free = None
+        victim = None
+        victim_expiry = None
+        for i in range(_MAX_PROBE):
+            offset = self._offset((start + i) % self.slots)
+            slot_hash, count, expiry = _SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                if expiry <= now:
+                    return offset, 0, 0.0
+                return offset, count, expiry
+            if free is None and (slot_hash == 0 or expiry <= now):
+                free = offset
+            if victim_expiry is None or expiry < victim_expiry:
+                victim, victim_expiry = offset, expiry
+        if not create:
+            return None, 0, 0.0
+        offset = free if free is not None else victim
+        _SLOT.pack_into(self._map, offset, key_hash, 0, 0.0)
+        return offset, 0, 0.0
+
+    # Storage interface -------------------------------------------------
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        """Increment the counter for key, starting a new window when expired"""
+        now = time.time()
+        self._lock()
+        try:
+            offset, count, current_expiry = self._find(key, now, create=True)
+            count += amount
+            if count == amount or elastic_expiry:
+                current_expiry = now + expiry
+            _SLOT.pack_into(self._map, offset, _key_hash(key), count, current_expiry)
+            return count
+        finally:
+            self._unlock()
+
+    def decr(self, key, amount=1):
+        now = time.time()
+        self._lock()
+        try:
+            offset, count, expiry = self._find(key, now)
+            if offset is None:
+                return 0
+            count = max(count - amount, 0)
+            _SLOT.pack_into(self._map, offset, _key_hash(key), count, expiry)
+            return count
+        finally:
+            self._unlock()
+
+    def get(self, key):
+        # Leitura sem lock: um valor ligeiramente desatualizado é aceitável
+        self._reopen_after_fork()
+        return self._find(key, time.time())[1]
+
+    def get_expiry(self, key):
+        self._reopen_after_fork()
+        now = time.time()
+        offset, _, expiry = self._find(key, now)
+        return expiry if offset is not None and expiry else now
+
+    def check(self):
+        return not self._map.closed
+
+    def reset(self):
+        self._lock()
+        try:
+            used = 0
+            for index in range(self.slots):
+                offset = self._offset(index)
+                if _SLOT.unpack_from(self._map, offset)[0]:
+                    used += 1
+                    _SLOT.pack_into(self._map, offset, 0, 0, 0.0)
+            return used
+        finally:
+            self._unlock()
+
+    def clear(self, key):
+        self._lock()
+        try:
+            offset, _, _ = self._find(key, time.time())
+            if offset is not None:
+                _SLOT.pack_into(self._map, offset, 0, 0, 0.0)
+        finally:
+            self._unlock()
+
+    # Sliding window counter support ------------------------------------
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count, previous_ttl, _, _ = self._get_sliding_window_info(
+            previous_key, current_key, expiry, now
+        )
+        current_count = self.incr(current_key, 2 * expiry, amount=amount)
+        if floor(previous_count * previous_ttl / expiry + current_count) > limit:
+            self.decr(current_key, amount)
+            return False
+        return True
+
+    def _get_sliding_window_info(self, previous_key, current_key, expiry, now):
+        previous_count = self.get(previous_key)
+        current_count = self.get(current_key)
+        if previous_count == 0:
+            previous_ttl = 0.0
+        else:
+            previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        return self._get_sliding_window_info(previous_key, current_key, expiry, now)
+
+    def clear_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        self.clear(previous_key)
+        self.clear(current_key)
@@ -0,0 +1,86 @@
+"""SQLite performance profile and read-only connection pool.
+
+The pragmas below are applied through a ``connect`` event listener, so every
+pooled connection gets them (not only the first session of the process).
+Dashboard and reporting routes use a separate read-only engine
+(``mode=ro`` + ``PRAGMA query_only``) so long reads never queue behind the
+ingest writer, and WAL checkpoints are driven by the maintenance runner
+(``utils.maintenance``) instead of landing on whichever request happens to
+cross the autocheckpoint threshold.
+"""
+import os
+
+from sqlalchemy import create_engine, event, text
+
+# Valores padrão; cada pragma pode ser sobrescrito por SQLITE_<NOME> no ambiente
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 30000,          # ms
+    'cache_size': -65536,           # KiB (negativo) -> 64 MiB por conexão
+    'mmap_size': 268435456,         # 256 MiB
+    'wal_autocheckpoint': 10000,    # páginas; a manutenção faz checkpoints periódicos
+    'journal_size_limit': 67108864, # trunca o WAL para 64 MiB após checkpoint
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+READ_ONLY_PRAGMAS = ('busy_timeout', 'cache_size', 'mmap_size', 'temp_store')
+
+
+def sqlite_pragmas():
+    """Return the pragma profile, honouring SQLITE_<PRAGMA> overrides"""
+    pragmas = {}
+    for name, value in DEFAULT_PRAGMAS.items():
+        pragmas[name] = os.environ.get(f'SQLITE_{name.upper()}', value)
+    return pragmas
+
+
+def is_file_database(engine):
+    database = engine.url.database
+    return engine.dialect.name == 'sqlite' and database not in (None, '', ':memory:')
+
+
+def apply_sqlite_profile(engine, read_only=False):
+    """Apply the pragma profile to every new DBAPI connection of engine"""
+    pragmas = sqlite_pragmas()
+    if read_only:
+        pragmas = {name: pragmas[name] for name in READ_ONLY_PRAGMAS}
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            if read_only:
+                cursor.execute('PRAGMA query_only=ON')
+            else:
+                cursor.execute('PRAGMA journal_mode=WAL')
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    return engine
+
+
+def create_read_engine(engine):
+    """Build a read-only engine for the same database file as engine
+
+    Returns engine itself for in-memory or non-SQLite databases, where a
+    second pool would not see the same data.
+    """
+    if not is_file_database(engine):
+        return engine
+
+    path = os.path.abspath(engine.url.database)
+    read_engine = create_engine(
+        f'sqlite:///file:{path}?mode=ro&uri=true',
+        connect_args={'timeout': 30, 'check_same_thread': False},
+        pool_size=int(os.environ.get('SQLITE_READ_POOL_SIZE', 8)),
+        max_overflow=4,
+    )
+    return apply_sqlite_profile(read_engine, read_only=True)
+
+
+def wal_checkpoint(engine):
+    """Run a PASSIVE WAL checkpoint; returns (busy, log frames, checkpointed frames)"""
+    with engine.connect() as conn:
+        return tuple(conn.execute(text('PRAGMA wal_checkpoint(PASSIVE)')).fetchone())
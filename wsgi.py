@@ -1,6 +1,6 @@
 from app import create_app
 
-# Cria a instância da aplicação - o scheduler é gerenciado internamente agora
+# Cria a instância da aplicação - a manutenção é gerenciada internamente (ver utils/maintenance.py)
 app = create_app()
 
 if __name__ == "__main__":